@@ -205,10 +205,12 @@ echo "
 ENV_PATH PATH=$PATH
 " > /etc/login.defs
 
-# Wait just a little while... this has to do with some
-# fun race conditions in resolving host names for commands
-# because of adding the container to a network AFTER it's been started.
-sleep 0.05
+# Networks are normally attached when the container is created. With older Docker versions
+# link networks of commands are added AFTER the container has been started. Wait just a little
+# while in this case... this has to do with some fun race conditions in resolving host names.
+if [ -n "$RIPTIDE__DOCKER_NETWORK_LINK_DELAY" ]; then
+    sleep "$RIPTIDE__DOCKER_NETWORK_LINK_DELAY"
+fi
 
 # Run original entrypoint and/or cmd
 if [ -z "RIPTIDE__DOCKER_DONT_RUN_CMD" ]; then
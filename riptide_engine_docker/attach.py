@@ -0,0 +1,279 @@
+"""
+Interactive sessions with containers, without the Docker CLI.
+
+The exec start and attach endpoints of the Docker API "hijack" the HTTP connection: After the response headers,
+the connection is a raw bidirectional stream between the client and the process in the container. With a TTY,
+the stream contains the terminal output as it is. This module relays it to the terminal of the user: The local
+terminal is put into raw mode (the terminal of the container does the line editing), input is forwarded as it
+is typed and size changes of the local terminal (SIGWINCH) are forwarded to the terminal of the container.
+
+If stdin or stdout is not a terminal (eg. 'riptide cmd mysql < dump.sql'), sessions run without TTY instead,
+which passes the bytes through unchanged (see relay). Without TTY, Ctrl-C is not handled by the terminal of the
+container: It is forwarded to containers as SIGINT, like 'docker run -i' does. The Docker API can't send signals
+to exec processes, so for execs Ctrl-C only ends the local session, like 'docker exec -i'.
+
+Connections to the Docker Engine via TLS are supported. Python's ssl module can't close only the sending direction
+of TLS connections though, so the end of the input is not forwarded via TLS, see relay.
+
+Only available on POSIX systems, on Windows the Docker CLI is used instead.
+"""
+import os
+import select
+import signal
+import socket
+import ssl
+import struct
+import sys
+from contextlib import contextmanager
+from time import sleep, time
+from typing import Callable, List, Dict, Union
+
+from docker import DockerClient
+from docker.errors import APIError
+
+from riptide.engine.abstract import ExecError
+
+try:
+    import termios
+    import tty
+except ImportError:
+    termios = None
+
+# Size of reads from the terminal and the connection, in bytes.
+BUFFER_SIZE = 64 * 1024
+# Size of reads and of the socket buffers in pipe mode, in bytes.
+PIPE_BUFFER_SIZE = 1024 * 1024
+# Header of the frames of the multiplexed stream (without TTY).
+FRAME_HEADER = struct.Struct('>BxxxL')
+STREAM_STDERR = 2
+# Time to wait for an exec to be reported as exited after it's stream ended, in seconds.
+EXIT_CODE_TIMEOUT = 5
+# Errors of non-blocking sockets that have to wait for the socket to become readable or writable.
+WOULD_BLOCK_ERRORS = (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError)
+
+
+def supported() -> bool:
+    """Whether interactive sessions can be run in-process on this platform."""
+    return termios is not None and hasattr(signal, 'SIGWINCH')
+
+
+def is_tty() -> bool:
+    """Whether input and output are a terminal. If not (eg. piped), sessions should run without TTY."""
+    return sys.stdin.isatty() and sys.stdout.isatty()
+
+
+def exec_interactive(client: DockerClient, container: str, command: List[str], user: str = '',
+                     environment: Dict[str, str] = None, workdir: str = None, size=None, tty=True) -> int:
+    """
+    Runs command in the running container, attached to stdin/stdout/stderr. Returns the exit code.
+
+    :param size: (lines, columns) to use if the size of the local terminal can't be determined.
+    :param tty:  Run with a TTY. Without, input and output are passed through as they are, see relay.
+    """
+    exec_instance = client.api.exec_create(
+        container, command, stdin=True, tty=tty, user=user, environment=environment, workdir=workdir
+    )
+    sock = client.api.exec_start(exec_instance, tty=tty, socket=True)
+    relay(sock, lambda lines, columns: client.api.exec_resize(exec_instance, height=lines, width=columns), size, tty)
+    return _exec_exit_code(client, exec_instance)
+
+
+def relay(sock, resize: Callable[[int, int], None], size=None, tty=True,
+          interrupt: Callable[[], None] = None) -> None:
+    """
+    Relays between the local terminal and the hijacked connection sock until the connection is closed.
+    resize is called with (lines, columns) on start and whenever the size of the local terminal changes.
+
+    Without tty (pipe mode), the connection carries stdout and stderr multiplexed, which are written to
+    stdout and stderr. Bytes are passed through unchanged, with larger buffers. When stdin ends,
+    the connection is half-closed, so that the process in the container receives the end of it's input
+    (not via TLS, where the process only receives the end of it's input when the session ends).
+    interrupt is called on Ctrl-C (SIGINT) in pipe mode, instead of ending the session. If it is not given,
+    Ctrl-C ends the local session with KeyboardInterrupt, the process in the container keeps running.
+    """
+    stdin_fd = sys.stdin.fileno()
+    stdout_fd = sys.stdout.fileno()
+    sys.stdout.flush()
+    if not tty:
+        sys.stderr.flush()
+        with _forward_interrupt(interrupt):
+            _pump(_raw_socket(sock), stdin_fd, stdout_fd, sys.stderr.fileno(), PIPE_BUFFER_SIZE)
+        return
+    with _raw_terminal(stdin_fd), _forward_resize(stdout_fd, resize, size):
+        _pump(_raw_socket(sock), stdin_fd, stdout_fd)
+
+
+def _pump(sock, stdin_fd: int, stdout_fd: int, stderr_fd: int = None, buffer_size: int = BUFFER_SIZE):
+    """
+    Copies stdin to the socket and the socket to stdout. Reading stdin pauses while the container doesn't
+    read it's input. Reading the socket pauses while writing to stdout blocks.
+    If stderr_fd is given, the socket output is multiplexed and the socket is half-closed after stdin ended.
+    """
+    sock.setblocking(False)
+    if stderr_fd is not None:
+        for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, option, buffer_size)
+            except OSError:
+                pass
+    to_container = b''
+    from_container = b''
+    stdin_open = True
+    write_open = True
+    while True:
+        readers = [sock]
+        if stdin_open and len(to_container) < buffer_size:
+            readers.append(stdin_fd)
+        writers = [sock] if len(to_container) > 0 else []
+        # Via TLS, decrypted bytes may already be buffered, without the socket becoming readable again
+        pending = _pending(sock)
+        readable, writable, _ = select.select(readers, writers, [], 0 if pending else None)
+        if pending:
+            readable.append(sock)
+        if sock in writable:
+            try:
+                to_container = to_container[sock.send(to_container):]
+            except WOULD_BLOCK_ERRORS:
+                pass
+            except (BrokenPipeError, ConnectionResetError):
+                # The container doesn't read input anymore
+                to_container = b''
+                stdin_open = False
+                write_open = False
+        if stdin_fd in readable:
+            data = os.read(stdin_fd, buffer_size)
+            if len(data) == 0:
+                stdin_open = False
+            to_container += data
+        if not stdin_open and write_open and len(to_container) == 0 and stderr_fd is not None:
+            # SSLSocket.shutdown would end TLS for reading as well
+            if not isinstance(sock, ssl.SSLSocket):
+                sock.shutdown(socket.SHUT_WR)
+            write_open = False
+        if sock in readable:
+            try:
+                data = sock.recv(buffer_size)
+            except WOULD_BLOCK_ERRORS:
+                continue
+            if len(data) == 0:
+                return
+            if stderr_fd is None:
+                _write_all(stdout_fd, data)
+            else:
+                from_container = _write_frames(from_container + data, stdout_fd, stderr_fd)
+
+
+def _write_frames(data: bytes, stdout_fd: int, stderr_fd: int) -> bytes:
+    """
+    Writes all complete frames of the multiplexed stream (8 byte header: stream type, 3 bytes padding,
+    4 bytes big endian length) to stdout or stderr. Returns the incomplete rest.
+    """
+    view = memoryview(data)
+    offset = 0
+    while len(view) - offset >= FRAME_HEADER.size:
+        stream, length = FRAME_HEADER.unpack_from(view, offset)
+        end = offset + FRAME_HEADER.size + length
+        if end > len(view):
+            break
+        _write_all(stderr_fd if stream == STREAM_STDERR else stdout_fd, view[offset + FRAME_HEADER.size:end])
+        offset = end
+    return bytes(view[offset:])
+
+
+def _write_all(fd: int, data: bytes):
+    view = memoryview(data)
+    while len(view) > 0:
+        view = view[os.write(fd, view):]
+
+
+def _raw_socket(sock):
+    """The socket of the connection returned by the Docker client (which may be wrapped in a SocketIO)."""
+    return getattr(sock, '_sock', sock)
+
+
+def _pending(sock) -> int:
+    """Number of decrypted bytes buffered by TLS sockets, which can be read without waiting."""
+    return sock.pending() if isinstance(sock, ssl.SSLSocket) else 0
+
+
+def _exec_exit_code(client: DockerClient, exec_instance) -> int:
+    timeout = time() + EXIT_CODE_TIMEOUT
+    while True:
+        result = client.api.exec_inspect(exec_instance)
+        if not result['Running']:
+            return result['ExitCode']
+        if time() > timeout:
+            raise ExecError("The command did not exit after it's output ended.")
+        sleep(0.01)
+
+
+@contextmanager
+def _raw_terminal(fd: int):
+    if not os.isatty(fd):
+        yield
+        return
+    old_attributes = termios.tcgetattr(fd)
+    try:
+        tty.setraw(fd)
+        yield
+    finally:
+        termios.tcsetattr(fd, termios.TCSADRAIN, old_attributes)
+
+
+@contextmanager
+def _forward_resize(fd: int, resize: Callable[[int, int], None], size=None):
+    def do_resize(*args):
+        lines, columns = _terminal_size(fd, size)
+        if lines and columns:
+            try:
+                resize(lines, columns)
+            except APIError:
+                # The process already exited
+                pass
+
+    installed = False
+    try:
+        old_handler = signal.signal(signal.SIGWINCH, do_resize)
+        installed = True
+    except ValueError:
+        # Not the main thread, size changes are not forwarded.
+        old_handler = None
+    try:
+        do_resize()
+        yield
+    finally:
+        if installed:
+            signal.signal(signal.SIGWINCH, old_handler)
+
+
+@contextmanager
+def _forward_interrupt(interrupt: Callable[[], None] = None):
+    def do_interrupt(*args):
+        try:
+            interrupt()
+        except APIError:
+            # The process already exited
+            pass
+
+    installed = False
+    old_handler = None
+    if interrupt is not None:
+        try:
+            old_handler = signal.signal(signal.SIGINT, do_interrupt)
+            installed = True
+        except ValueError:
+            # Not the main thread, Ctrl-C is not forwarded.
+            pass
+    try:
+        yield
+    finally:
+        if installed:
+            signal.signal(signal.SIGINT, old_handler)
+
+
+def _terminal_size(fd: int, default=None) -> Union[tuple, None]:
+    try:
+        size = os.get_terminal_size(fd)
+        return size.lines, size.columns
+    except OSError:
+        return default if default is not None else (None, None)
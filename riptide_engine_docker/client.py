@@ -0,0 +1,98 @@
+"""
+Creation of the Docker client used by the engine.
+
+One client (and one connection pool) is shared by all threads of the engine: the service start and stop
+workers, readiness probes, image pulls and background threads like the warm container pool. Every
+thread takes its own connection from the pool, so the pool must be at least as large as the number of
+connections used at the same time. Otherwise connections are closed after use instead of being kept
+alive for the next request (and urllib3 warns with "Connection pool is full").
+
+The pool size is derived from the concurrency settings of the engine, unless it is set explicitly.
+"""
+import os
+from typing import NamedTuple, Union
+
+import docker
+from docker import DockerClient
+
+# Default timeout of API requests in seconds. The events and logs streams don't time out, exec and attach
+# streams do (the client keeps the timeout on the connection), read those with util.socket_output.
+DEFAULT_API_TIMEOUT = 60
+# Connections a single service start uses at the same time: API calls, the events stream of the
+# readiness check and exec calls of the readiness log probe.
+CONNECTIONS_PER_START = 3
+# Connections for everything else running at the same time (background threads, status, ...).
+EXTRA_CONNECTIONS = 4
+
+
+class ClientSettings(NamedTuple):
+    # Maximum number of connections kept open to the Docker API. None: Derived from the engine concurrency.
+    pool_size: Union[int, None] = None
+    # Whether connections are kept open and reused for the following requests.
+    keep_alive: bool = True
+    # Timeout of API requests in seconds.
+    timeout: int = DEFAULT_API_TIMEOUT
+
+
+class ConnectionStats(NamedTuple):
+    # Connections that were opened
+    connections: int
+    # Requests that were sent
+    requests: int
+
+    @property
+    def reused(self) -> int:
+        """Number of requests that were sent over an already open connection."""
+        return max(0, self.requests - self.connections)
+
+
+def pool_size_for(max_parallel_starts: int, max_parallel_pulls: int) -> int:
+    """
+    Connection pool size needed for the given engine concurrency settings.
+    Services are stopped in the default executor of the event loop, which also runs in parallel.
+    """
+    return max(
+        max_parallel_starts * CONNECTIONS_PER_START,
+        max_parallel_pulls,
+        _default_executor_workers()
+    ) + EXTRA_CONNECTIONS
+
+
+def _default_executor_workers() -> int:
+    # Same as the default of ThreadPoolExecutor, which is used by run_in_executor(None, ...).
+    return min(32, (os.cpu_count() or 1) + 4)
+
+
+def create_client(settings: ClientSettings, pool_size: int) -> DockerClient:
+    """
+    Creates a client from the environment (like docker.from_env).
+
+    :param settings:  Client settings. settings.pool_size overrides pool_size.
+    :param pool_size: Pool size derived from the concurrency of the engine.
+    """
+    client = docker.from_env(
+        timeout=settings.timeout,
+        max_pool_size=settings.pool_size if settings.pool_size is not None else pool_size
+    )
+    if not settings.keep_alive:
+        client.api.headers['Connection'] = 'close'
+    return client
+
+
+def connection_stats(client: DockerClient) -> ConnectionStats:
+    """Counts the connections opened and requests sent by the client so far."""
+    connections = 0
+    requests = 0
+    for adapter in client.api.adapters.values():
+        pools = getattr(adapter, 'pools', None)
+        if pools is None and hasattr(adapter, 'poolmanager'):
+            # TCP connections use the regular requests adapter
+            pools = adapter.poolmanager.pools
+        if pools is None:
+            continue
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                requests += pool.num_requests
+    return ConnectionStats(connections, requests)
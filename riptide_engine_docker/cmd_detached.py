@@ -1,38 +1,145 @@
+import functools
 import os
-from time import sleep
+import uuid
+from typing import Generator, Tuple, Union, Iterator
 
 from docker import DockerClient
-from docker.errors import NotFound, ContainerError
+from docker.errors import ContainerError
+from docker.models.containers import Container
 
 from riptide_engine_docker.container_builder import ContainerBuilder, get_network_name, EENV_USER, EENV_GROUP, \
     EENV_RUN_MAIN_CMD_AS_USER, EENV_NO_STDOUT_REDIRECT
 from riptide.lib.cross_platform.cpuser import getuid, getgid
-from riptide_engine_docker.network import add_network_links
+from riptide_engine_docker.image_cache import get_image_config, with_image
+from riptide_engine_docker.network import add_link_networks, with_project_network, create_container
+from riptide_engine_docker.util import socket_output
+from riptide_engine_docker.warm_pool import WarmPool, exec_command, exec_user, HOME_IN_CONTAINER
 
+STDOUT = 'stdout'
+STDERR = 'stderr'
+# Default number of bytes of each output stream kept for error messages by cmd_detached_stream.
+DEFAULT_TAIL_SIZE = 64 * 1024
 
-def cmd_detached(client: DockerClient, project: 'Project', command: 'Command', run_as_root=False) -> (int, str):
-    """See AbstractEngine.cmd_detached."""
-    name = get_container_name(project["name"])
 
-    # Pulling image
-    # Check if image exists
+def cmd_detached(client: DockerClient, project: 'Project', command: 'Command', run_as_root=False,
+                 warm_pool: WarmPool = None, link_groups=False) -> (int, str):
+    """See AbstractEngine.cmd_detached. Uses a warm container of the pool, if one is given."""
+    builder, name = _prepare(client, project, command, run_as_root, link_groups)
+
+    claimed = _claim(builder, project, command, name, warm_pool)
+    if claimed:
+        try:
+            return _exec_in_claimed(client, builder, name)
+        finally:
+            warm_pool.release(name)
+
     try:
-        client.images.get(command["image"])
-    except NotFound:
-        image_name_full = command['image'] if ":" in command['image'] else command['image'] + ":latest"
-        client.api.pull(image_name_full)
+        container = _create(client, project, command, builder)
+        try:
+            container.start()
+            exit_code = container.wait()
+            output = container.logs()
+            return exit_code['StatusCode'], output
+        finally:
+            # Names are unique, the container would never be reused
+            container.remove(force=True)
+    except ContainerError as err:
+        return err.exit_status, err.stderr
+
+
+def cmd_detached_stream(client: DockerClient, project: 'Project', command: 'Command', run_as_root=False,
+                        warm_pool: WarmPool = None, link_groups=False,
+                        tail_size: int = DEFAULT_TAIL_SIZE) -> 'DetachedOutput':
+    """
+    Like cmd_detached, but returns the output while the command runs, see DetachedOutput.
+    The command is started when iterating the output starts. The container is removed afterwards.
+    """
+    builder, name = _prepare(client, project, command, run_as_root, link_groups)
+
+    def run():
+        if _claim(builder, project, command, name, warm_pool):
+            try:
+                return (yield from _exec_in_claimed_stream(client, builder, name))
+            finally:
+                warm_pool.release(name)
+
+        container = _create(client, project, command, builder)
+        try:
+            # Attach before starting, to not miss any output
+            output = socket_output(
+                client.api.attach_socket(container.id, params={'stdout': 1, 'stderr': 1, 'stream': 1})
+            )
+            container.start()
+            yield from output
+            return container.wait()['StatusCode']
+        finally:
+            container.remove(force=True)
+
+    return DetachedOutput(run(), tail_size)
+
+
+class DetachedOutput:
+    """
+    Output of a detached command, while it runs.
+
+    Iterating yields (stream, data) tuples as the command writes output, stream is STDOUT or STDERR.
+    The output is not stored, only the last tail_size bytes of each stream (for error messages, see tail).
+    After the iteration ended, exit_code contains the exit code of the command.
+    """
+
+    def __init__(self, chunks: Generator[Tuple[bytes, bytes], None, int], tail_size: int = DEFAULT_TAIL_SIZE):
+        self.exit_code: Union[int, None] = None
+        self.tail_size = tail_size
+        self._chunks = chunks
+        self._tails = {STDOUT: bytearray(), STDERR: bytearray()}
+
+    def __iter__(self) -> Iterator[Tuple[str, bytes]]:
+        try:
+            while True:
+                stdout, stderr = next(self._chunks)
+                for stream, data in ((STDOUT, stdout), (STDERR, stderr)):
+                    if data:
+                        self._add_to_tail(stream, data)
+                        yield stream, data
+        except StopIteration as result:
+            self.exit_code = result.value
+
+    def wait(self) -> int:
+        """Consumes the remaining output and returns the exit code."""
+        for _ in self:
+            pass
+        return self.exit_code
+
+    def tail(self, stream: str = None) -> bytes:
+        """The last bytes of the stream, or of both streams (stdout first) if no stream is given."""
+        if stream is None:
+            return bytes(self._tails[STDOUT] + self._tails[STDERR])
+        return bytes(self._tails[stream])
 
-    image = client.images.get(command["image"])
-    image_config = client.api.inspect_image(command["image"])["Config"]
+    def _add_to_tail(self, stream: str, data: bytes):
+        tail = self._tails[stream]
+        tail += data
+        if len(tail) > self.tail_size:
+            del tail[:len(tail) - self.tail_size]
+
+
+def _prepare(client: DockerClient, project: 'Project', command: 'Command', run_as_root: bool,
+             link_groups: bool) -> (ContainerBuilder, str):
+    name = get_container_name(project["name"])
+
+    # Get image config, pulls the image if it doesn't exist
+    image_config = get_image_config(client, command["image"])
 
     builder = ContainerBuilder(
         command["image"],
         command["command"] if "command" in command else image_config["Cmd"]
     )
 
-    builder.set_name(get_container_name(project["name"]))
+    builder.set_name(name)
     builder.set_network(get_network_name(project["name"]))
 
+    add_link_networks(client, builder, None, project, link_groups)
+
     builder.set_env(EENV_NO_STDOUT_REDIRECT, "yes")
 
     builder.init_from_command(command, image_config)
@@ -40,17 +147,47 @@ def cmd_detached(client: DockerClient, project: 'Project', command: 'Command', r
         builder.set_env(EENV_RUN_MAIN_CMD_AS_USER, "yes")
         builder.set_env(EENV_USER, str(getuid()))
         builder.set_env(EENV_GROUP, str(getgid()))
+    return builder, name
 
-    try:
-        container = client.containers.create(**builder.build_docker_api())
-        add_network_links(client, container, None, project["links"])
-        container.start()
-        exit_code = container.wait()
-        output = container.logs()
-        return exit_code['StatusCode'], output
-    except ContainerError as err:
-        return err.exit_status, err.stderr
+
+def _claim(builder: ContainerBuilder, project: 'Project', command: 'Command', name: str,
+           warm_pool: Union[WarmPool, None]) -> bool:
+    """
+    Claims a warm container of the pool as name, if the pool is used. Returns whether one was claimed.
+    Only commands of the project use the pool: Ad-hoc commands (without name, eg. of path_utils) are configured
+    differently each time (eg. other mounts), warm containers would never match them.
+    """
+    if warm_pool is None or not warm_pool.enabled or "$name" not in command:
+        return False
+    pool_key = project["name"] + "/detached/" + command["$name"]
+    claimed = warm_pool.claim(builder, pool_key, name)
+    warm_pool.refill(builder, project["name"], pool_key)
+    return claimed
+
+
+def _exec_in_claimed(client: DockerClient, builder: ContainerBuilder, name: str) -> (int, str):
+    output = DetachedOutput(_exec_in_claimed_stream(client, builder, name))
+    data = b''.join(data for _, data in output)
+    return output.exit_code, data
+
+
+def _exec_in_claimed_stream(client: DockerClient, builder: ContainerBuilder,
+                            name: str) -> Generator[Tuple[bytes, bytes], None, int]:
+    user = exec_user(builder)
+    exec_instance = client.api.exec_create(
+        name, exec_command(builder),
+        user=user if user is not None else '',
+        environment={'HOME': HOME_IN_CONTAINER} if user is not None else None
+    )
+    yield from socket_output(client.api.exec_start(exec_instance, socket=True))
+    return client.api.exec_inspect(exec_instance)['ExitCode']
+
+
+def _create(client: DockerClient, project: 'Project', command: 'Command', builder: ContainerBuilder) -> Container:
+    create = functools.partial(create_container, client, builder.build_docker_api())
+    return with_image(client, command["image"], functools.partial(with_project_network, client, project["name"], create))
 
 
 def get_container_name(project_name: str):
-    return 'riptide__' + project_name + '__detached_cmd__' + str(os.getpid())
+    """Unique for each call, so that concurrent commands (even of the same process) don't collide."""
+    return 'riptide__' + project_name + '__detached_cmd__' + str(os.getpid()) + '_' + uuid.uuid4().hex[:12]
@@ -4,17 +4,19 @@ from collections import OrderedDict
 import os
 import platform
 from pathlib import PurePosixPath
-from typing import List, Union
+from typing import List, Union, TYPE_CHECKING
 
 from docker.types import Mount, Ulimit
 
 from riptide.config.document.command import Command
 from riptide.config.document.service import Service
 from riptide.config.hosts import get_localhost_hosts
-from riptide.config.service.ports import find_open_port_starting_at
 from riptide.lib.cross_platform.cpuser import getgid, getuid
 from riptide_engine_docker.assets import riptide_engine_docker_assets_dir
 
+if TYPE_CHECKING:
+    from riptide_engine_docker.ports import PortAllocator
+
 ENTRYPOINT_SH = 'entrypoint.sh'
 
 RIPTIDE_DOCKER_LABEL_IS_RIPTIDE = 'riptide'
@@ -36,6 +38,7 @@ EENV_NAMED_VOLUMES = "RIPTIDE__DOCKER_NAMED_VOLUMES"
 EENV_ON_LINUX = "RIPTIDE__DOCKER_ON_LINUX"
 EENV_HOST_SYSTEM_HOSTNAMES = "RIPTIDE__DOCKER_HOST_SYSTEM_HOSTNAMES"
 EENV_OVERLAY_TARGETS = "RIPTIDE__DOCKER_OVERLAY_TARGETS"
+EENV_NETWORK_LINK_DELAY = "RIPTIDE__DOCKER_NETWORK_LINK_DELAY"
 
 # For services map HTTP main port to a host port starting here
 DOCKER_ENGINE_HTTP_PORT_BND_START = 30000
@@ -54,6 +57,9 @@ class ContainerBuilder:
         self.mounts = OrderedDict()
         self.ports = OrderedDict()
         self.network = None
+        self.network_aliases = []
+        # Additional networks -> aliases
+        self.networks = OrderedDict()
         self.name = None
         self.entrypoint = None
         self.command = command
@@ -110,8 +116,18 @@ class ContainerBuilder:
         self.ports[cnt] = host
         return self
 
-    def set_network(self, network: str):
+    def set_network(self, network: str, aliases: List[str] = None):
+        """Set the main network of the container."""
         self.network = network
+        self.network_aliases = aliases if aliases is not None else []
+        return self
+
+    def add_network(self, network: str, aliases: List[str] = None):
+        """
+        Add an additional network. Only used if a main network is set.
+        The container is attached to all networks when it is created.
+        """
+        self.networks[network] = aliases if aliases is not None else []
         return self
 
     def set_name(self, name: str):
@@ -218,17 +234,13 @@ class ContainerBuilder:
             self.set_allow_full_memlock(True)
         return self
 
-    def service_add_main_port(self, service: Service):
+    def service_add_main_port(self, service: Service, port_allocator: 'PortAllocator'):
         """
-        Add main service port.
-        Not thread-safe!
-        If starting multiple services in multiple threads:
-            This has to be done separately, right before start,
-            and with a lock in place, so that multiple service starts don't reserve the
-            same port.
+        Add main service port. The host port is allocated with the given port allocator.
+        The port is reserved for a while, the container should be created right after this.
         """
         if "port" in service:
-            main_port = find_open_port_starting_at(DOCKER_ENGINE_HTTP_PORT_BND_START)
+            main_port = port_allocator.allocate(service.get_project()["name"], service["$name"])
             self.set_label(RIPTIDE_DOCKER_LABEL_HTTP_PORT, str(main_port))
             self.set_port(service["port"], main_port)
 
@@ -284,6 +296,9 @@ class ContainerBuilder:
             args['name'] = self.name
         if self.network:
             args['network'] = self.network
+            args['networking_config'] = {self.network: _endpoint_config(self.network_aliases)}
+            for network, aliases in self.networks.items():
+                args['networking_config'][network] = _endpoint_config(aliases)
         if self.entrypoint:
             args['entrypoint'] = [self.entrypoint]
         if self.work_dir:
@@ -322,7 +337,9 @@ class ContainerBuilder:
         if self.name:
             shell += ["--name", self.name]
         if self.network:
-            shell += ["--network", self.network]
+            shell += ["--network", _cli_network(self.network, self.network_aliases)]
+            for network, aliases in self.networks.items():
+                shell += ["--network", _cli_network(network, aliases)]
         if self.entrypoint:
             shell += ["--entrypoint", self.entrypoint]
         if self.work_dir:
@@ -367,6 +384,17 @@ class ContainerBuilder:
             if self.on_linux:
                 shell += ['--security-opt', 'apparmor:unconfined']
 
+        shell += [
+            self.image,
+            self.build_command_string()
+        ]
+        return shell
+
+    def build_command_string(self) -> str:
+        """
+        Build the command and arguments as one string, in the form the Riptide entrypoint
+        receives it when the container is run via the Docker CLI.
+        """
         command = self.command
         if command is None:
             command = ""
@@ -377,17 +405,23 @@ class ContainerBuilder:
             if len(self.command) > 1:
                 command += " " + " ".join(f'"{w}"' for w in self.command[1:])
 
-        shell += [
-            self.image,
-            (command + " " + " ".join(f'"{w}"' for w in self.args)).rstrip()
-        ]
-        return shell
+        return (command + " " + " ".join(f'"{w}"' for w in self.args)).rstrip()
 
 
 def get_cmd_container_name(project_name: str, command_name: str):
     return 'riptide__' + project_name + '__cmd__' + command_name + '__' + str(os.getpid())
 
 
+def _endpoint_config(aliases: List[str]) -> dict:
+    return {'Aliases': aliases} if len(aliases) > 0 else {}
+
+
+def _cli_network(network: str, aliases: List[str]) -> str:
+    if len(aliases) == 0:
+        return network
+    return f'name={network},' + ','.join(f'alias={alias}' for alias in aliases)
+
+
 def get_network_name(project_name: str):
     return 'riptide__' + project_name
 
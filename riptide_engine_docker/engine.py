@@ -1,8 +1,6 @@
 import asyncio
+import functools
 
-import docker
-import json
-from json import JSONDecodeError
 from typing import Tuple, Dict, Union, List
 
 from docker.errors import APIError
@@ -11,19 +9,105 @@ from riptide.config.document.command import Command
 from riptide.config.document.config import Config
 from riptide.config.document.project import Project
 from riptide.engine.abstract import AbstractEngine, ServiceStoppedException
-from riptide_engine_docker import network, service, path_utils, named_volumes
-from riptide_engine_docker.cmd_detached import cmd_detached
-from riptide_engine_docker.container_builder import get_service_container_name, RIPTIDE_DOCKER_LABEL_HTTP_PORT
+from riptide_engine_docker import network, service, path_utils, named_volumes, images
+from riptide_engine_docker.client import ClientSettings, ConnectionStats, create_client, pool_size_for, \
+    connection_stats
+from riptide_engine_docker.cmd_detached import cmd_detached, cmd_detached_stream, DetachedOutput, DEFAULT_TAIL_SIZE
+from riptide_engine_docker.container_builder import get_service_container_name, RIPTIDE_DOCKER_LABEL_HTTP_PORT, \
+    get_network_name
 from riptide.engine.project_start_ctx import riptide_start_project_ctx
 from riptide.engine.results import StartStopResultStep, MultiResultQueue, ResultQueue, ResultError
+from riptide_engine_docker.helper import HelperService, DEFAULT_HELPER_IDLE_TIMEOUT
+from riptide_engine_docker.images import DEFAULT_MAX_PARALLEL_PULLS
+from riptide_engine_docker.named_volumes import NamedVolumeUsage, DEFAULT_VOLUME_USAGE_TTL
+from riptide_engine_docker.path_utils import PathResult
+from riptide_engine_docker.readiness import ReadinessSettings
+from riptide_engine_docker.state import StateTracker, StateSnapshot
+from riptide_engine_docker.volume_archive import SnapshotResult
+from riptide_engine_docker.volume_sync import ProgressCallback, SyncResult
+from riptide_engine_docker.scheduler import DependencyScheduler, StartReport, DEFAULT_MAX_PARALLEL_STARTS, \
+    service_dependencies
+from riptide_engine_docker.warm_pool import WarmPool, DEFAULT_WARM_POOL_SIZE, DEFAULT_WARM_POOL_TTL
 from riptide_engine_docker.fg import exec_fg, cmd_fg, service_fg, DEFAULT_EXEC_FG_CMD, cmd_in_service_fg
 
 
 class DockerEngine(AbstractEngine):
 
-    def __init__(self):
-        self.client = docker.from_env()
+    def __init__(self,
+                 readiness_settings: ReadinessSettings = None,
+                 max_parallel_starts: int = DEFAULT_MAX_PARALLEL_STARTS,
+                 service_dependencies: Dict[str, List[str]] = None,
+                 start_db_first: bool = False,
+                 max_parallel_pulls: int = DEFAULT_MAX_PARALLEL_PULLS,
+                 batch_pre_start: bool = False,
+                 post_start_parallel_groups: Dict[str, List[List[str]]] = None,
+                 warm_pool_size: int = DEFAULT_WARM_POOL_SIZE,
+                 warm_pool_ttl: int = DEFAULT_WARM_POOL_TTL,
+                 client_settings: ClientSettings = None,
+                 track_state: bool = False,
+                 use_link_groups: bool = False,
+                 volume_usage_ttl: int = DEFAULT_VOLUME_USAGE_TTL,
+                 use_helper_containers: bool = False,
+                 helper_idle_timeout: int = DEFAULT_HELPER_IDLE_TIMEOUT):
+        """
+        Engine settings can be passed to the constructor or changed on the instance afterwards,
+        eg. by plugins in after_load_engine.
+
+        :param readiness_settings:      Settings for the checks whether services are ready after start.
+        :param max_parallel_starts:     Maximum number of services of a project that are started at the same time.
+        :param service_dependencies:    Services that must be started before a service (service name ->
+                                        list of service names). Services not listed here don't wait
+                                        for other services, unless start_db_first is set.
+        :param start_db_first:          Services not listed in service_dependencies depend on the services
+                                        with the 'db' role: They are only started after those were started
+                                        successfully, and skipped if one of them failed.
+        :param max_parallel_pulls:      Maximum number of images that are pulled at the same time by pull_images.
+        :param batch_pre_start:         Run all pre_start commands of a service in one container, instead of
+                                        one container per command. Commands then share the container file system.
+        :param post_start_parallel_groups: Groups of post_start commands that don't depend on each other
+                                        (service name -> list of groups of commands). Consecutive
+                                        post_start commands of the same group are run concurrently.
+        :param warm_pool_size:          Number of pre-started containers kept for each command, used by cmd and
+                                        cmd_detached (for commands of projects only, not for ad-hoc commands).
+                                        0 (default) disables the warm container pool.
+        :param warm_pool_ttl:           Time in seconds after which unused pre-started containers exit.
+        :param client_settings:         Settings for the Docker API client (connection pool size, keep-alive,
+                                        timeout). By default the pool is sized for max_parallel_starts
+                                        and max_parallel_pulls.
+        :param track_state:             Keep a model of all Riptide containers, networks and volumes in memory,
+                                        kept up to date via Docker events. Status and address lookups are then
+                                        answered from memory. Meant for long-lived processes.
+        :param use_link_groups:         Linked projects share one network per group of linked projects, instead of
+                                        containers joining the networks of all linked projects (see link_groups).
+        :param volume_usage_ttl:        Time in seconds the sizes of named volumes are cached for
+                                        list_named_volumes(with_usage=True).
+        :param use_helper_containers:   Keep a helper container per project and run path_rm and path_copy in it
+                                        via exec, instead of starting a new container for each call (see helper).
+        :param helper_idle_timeout:     Time in seconds after which unused helper containers remove themselves.
+        """
+        if client_settings is None:
+            client_settings = ClientSettings()
+        self.client = create_client(client_settings, pool_size_for(max_parallel_starts, max_parallel_pulls))
+        self.readiness_settings = readiness_settings if readiness_settings is not None else ReadinessSettings()
+        self.max_parallel_starts = max_parallel_starts
+        self.service_dependencies = service_dependencies if service_dependencies is not None else {}
+        self.start_db_first = start_db_first
+        self.max_parallel_pulls = max_parallel_pulls
+        self.batch_pre_start = batch_pre_start
+        self.post_start_parallel_groups = post_start_parallel_groups if post_start_parallel_groups is not None else {}
+        self.warm_pool = WarmPool(self.client, warm_pool_size, warm_pool_ttl)
+        self.use_link_groups = use_link_groups
+        self.volume_usage = named_volumes.VolumeUsageCache(volume_usage_ttl)
+        self.helpers = None
+        if use_helper_containers and HelperService.supported():
+            self.helpers = HelperService(self.client, path_utils.IMAGE, helper_idle_timeout)
+        # Project name -> StartReport of the last start_project call for that project
+        self.last_start_reports: Dict[str, StartReport] = {}
         self.ping()
+        self.state_tracker = None
+        if track_state:
+            self.state_tracker = StateTracker(self.client)
+            self.state_tracker.start()
 
     def start_project(self,
                       project: Project,
@@ -31,31 +115,44 @@ class DockerEngine(AbstractEngine):
                       quick=False) -> MultiResultQueue[StartStopResultStep]:
         with riptide_start_project_ctx(project):
             # Start network
-            network.start(self.client, project["name"])
+            self.__start_network(project)
+            # Forget the network if it is removed while the project is running
+            network.NetworkRegistry.watch(self.client)
 
-            # Start all services
+            # Start all services, ordered by their dependencies
             queues = {}
-            loop = asyncio.get_event_loop()
+            scheduler = DependencyScheduler(self.max_parallel_starts)
             for service_name in services:
                 # Create queue and add to queues
                 queue = ResultQueue()
                 queues[queue] = service_name
                 if service_name in project["app"]["services"]:
-                    # Run start task
-                    loop.run_in_executor(
-                        None,
-                        service.start,
-
-                        project["name"],
-                        project["app"]["services"][service_name],
-                        self.client,
-                        queue,
-                        quick
+                    # Add start task
+                    scheduler.add(
+                        service_name,
+                        functools.partial(
+                            service.start,
+
+                            project["name"],
+                            project["app"]["services"][service_name],
+                            self.client,
+                            queue,
+                            quick,
+                            self.readiness_settings,
+                            self.batch_pre_start,
+                            self.post_start_parallel_groups.get(service_name, []),
+                            self.use_link_groups
+                        ),
+                        service_dependencies(project, service_name, self.service_dependencies,
+                                             self.start_db_first),
+                        functools.partial(self.__skip_start, queue)
                     )
                 else:
                     # Services not found :(
                     queue.end_with_error(ResultError("Service not found."))
 
+            asyncio.get_event_loop().run_in_executor(None, self.__run_start_scheduler, project["name"], scheduler)
+
             return MultiResultQueue(queues)
 
     def stop_project(self, project: Project, services: List[str]) -> MultiResultQueue[StartStopResultStep]:
@@ -81,13 +178,26 @@ class DockerEngine(AbstractEngine):
         return MultiResultQueue(queues)
 
     def status(self, project: Project) -> Dict[str, bool]:
+        running = service.status_by_project(
+            self.client, project["name"], self.__snapshot()
+        ).get(project["name"], {})
         services = {}
-        for service_name, service_obj in project["app"]["services"].items():
-            services[service_name] = service.status(project["name"], service_obj, self.client, project.parent())
+        for service_name in project["app"]["services"].keys():
+            services[service_name] = running.get(service_name, False)
         return services
 
-    def service_status(self, project: Project, service_name: str) -> Dict[str, bool]:
-        return service.status(project["name"], project["app"]["services"][service_name], self.client, project.parent())
+    def service_status(self, project: Project, service_name: str) -> bool:
+        running = service.status_by_project(
+            self.client, project["name"], self.__snapshot()
+        ).get(project["name"], {})
+        return running.get(service_name, False)
+
+    def status_all_projects(self) -> Dict[str, Dict[str, bool]]:
+        """
+        Returns the status of the services of all projects that currently have service containers,
+        indexed by project name and then service name. Only requires one request to the Docker API.
+        """
+        return service.status_by_project(self.client, snapshot=self.__snapshot())
 
     def container_name_for(self, project: 'Project', service_name: str):
         return get_service_container_name(project["name"], service_name)
@@ -97,6 +207,13 @@ class DockerEngine(AbstractEngine):
             return None
 
         container_name = get_service_container_name(project["name"], service_name)
+        snapshot = self.__snapshot()
+        if snapshot is not None:
+            container = snapshot.container_by_name(container_name)
+            if container is None or container['State'] != "running":
+                return None
+            port = (container['Labels'] or {}).get(RIPTIDE_DOCKER_LABEL_HTTP_PORT)
+            return ("127.0.0.1", port) if port is not None else None
         try:
             container = self.client.containers.get(container_name)
             if container.status != "running":
@@ -114,9 +231,9 @@ class DockerEngine(AbstractEngine):
             arguments: List[str],
             unimportant_paths_unsynced=False) -> int:
         # Start network
-        network.start(self.client, project["name"])
+        self.__start_network(project)
 
-        return cmd_fg(self.client, project, command_name, arguments)
+        return cmd_fg(self.client, project, command_name, arguments, self.warm_pool, self.use_link_groups)
 
     def cmd_in_service(self,
                        project: 'Project',
@@ -135,10 +252,10 @@ class DockerEngine(AbstractEngine):
                    arguments: List[str],
                    unimportant_paths_unsynced=False) -> None:
         # Start network
-        network.start(self.client, project["name"])
+        self.__start_network(project)
 
         with riptide_start_project_ctx(project):
-            service_fg(self.client, project, service_name, arguments)
+            service_fg(self.client, project, service_name, arguments, self.use_link_groups)
 
     def exec(self, project: Project, service_name: str, cols=None, lines=None, root=False) -> None:
         exec_fg(self.client, project, service_name, DEFAULT_EXEC_FG_CMD, cols, lines, root)
@@ -152,27 +269,39 @@ class DockerEngine(AbstractEngine):
         except Exception as err:
             raise ConnectionError("Connection with Docker Daemon failed") from err
 
+    def migrate_link_networks(self, project: 'Project') -> None:
+        """
+        Moves the running service containers of the link group of the project to the link group network.
+        Only used with use_link_groups. Happens automatically when link groups change.
+        """
+        network.migrate_link_group(self.client, project["name"])
+
+    def connection_stats(self) -> ConnectionStats:
+        """Returns how many connections to the Docker API were opened and how many requests reused them."""
+        return connection_stats(self.client)
+
     def cmd_detached(self, project: 'Project', command: 'Command', run_as_root=False):
         # Start network
-        network.start(self.client, project["name"])
+        self.__start_network(project)
         command.parent_doc = project["app"]
 
-        return cmd_detached(self.client, project, command, run_as_root)
+        return cmd_detached(self.client, project, command, run_as_root, self.warm_pool, self.use_link_groups)
 
-    def pull_images(self, project: 'Project', line_reset='\n', update_func=lambda msg: None) -> None:
-        if "services" in project["app"]:
-            for name, service in project["app"]["services"].items():
-                update_func(f"[service/{name}] Pulling '{service['image']}':\n")
-                self.__pull_image(service['image'] if ":" in service['image'] else service['image'] + ":latest",
-                                  line_reset, update_func)
-
-        if "commands" in project["app"]:
-            for name, command in project["app"]["commands"].items():
-                if "image" in command:
-                    update_func(f"[command/{name}] Pulling '{command['image']}':\n")
-                    self.__pull_image(command['image'] if ":" in command['image'] else command['image'] + ":latest",
-                                      line_reset, update_func)
+    def cmd_detached_stream(self, project: 'Project', command: 'Command', run_as_root=False,
+                            tail_size: int = DEFAULT_TAIL_SIZE) -> DetachedOutput:
+        """
+        Like cmd_detached, but the output (separated into stdout and stderr) can be processed while the command
+        runs, without keeping all of it in memory. The last tail_size bytes are kept for error messages.
+        See cmd_detached.DetachedOutput.
+        """
+        self.__start_network(project)
+        command.parent_doc = project["app"]
+
+        return cmd_detached_stream(self.client, project, command, run_as_root, self.warm_pool,
+                                   self.use_link_groups, tail_size)
 
+    def pull_images(self, project: 'Project', line_reset='\n', update_func=lambda msg: None) -> None:
+        images.pull_all(self.client, images.collect_images(project), self.max_parallel_pulls, line_reset, update_func)
         update_func("Done!\n\n")
 
     def path_rm(self, path, project: 'Project'):
@@ -181,42 +310,97 @@ class DockerEngine(AbstractEngine):
     def path_copy(self, fromm, to, project: 'Project'):
         return path_utils.copy(self, fromm, to, project)
 
+    def path_rm_many(self, paths: List[str], project: 'Project') -> List[PathResult]:
+        """Removes all paths using one container. Returns a result for each path, see path_utils.rm_many."""
+        return path_utils.rm_many(self, paths, project)
+
+    def path_copy_many(self, copies: List[Tuple[str, str]], project: 'Project') -> List[PathResult]:
+        """Copies all (from, to) pairs using one container. Returns a result for each pair, see path_utils.copy_many."""
+        return path_utils.copy_many(self, copies, project)
+
     def performance_value_for_auto(self, key: str, platform: str) -> bool:
         if platform != 'linux':
             if key == 'dont_sync_named_volumes_with_host' or key == 'dont_sync_unimportant_src':
                 return True
         return False
 
-    def list_named_volumes(self) -> List[str]:
+    def list_named_volumes(self, with_usage: bool = False) -> Union[List[str], List[NamedVolumeUsage]]:
+        """
+        Names of all named volumes. With with_usage, the size, last use and containers of each volume
+        are returned instead (see named_volumes.usage). Those are cached for volume_usage_ttl seconds.
+        """
+        if with_usage:
+            return self.volume_usage.get(self.client)
         return named_volumes.list(self.client)
 
     def delete_named_volume(self, name: str) -> None:
         named_volumes.delete(self.client, name)
+        self.__record_volume(name, False)
+        self.volume_usage.invalidate()
 
     def exists_named_volume(self, name: str) -> bool:
+        snapshot = self.__snapshot()
+        if snapshot is not None:
+            return named_volumes.NAMED_VOLUME_INTERNAL_PREFIX + name in snapshot.volumes
         return named_volumes.exists(self.client, name)
 
-    def copy_named_volume(self, from_name: str, target_name: str) -> None:
-        named_volumes.copy(self.client, from_name, target_name)
+    def copy_named_volume(self, from_name: str, target_name: str, progress: ProgressCallback = None) -> None:
+        named_volumes.copy(self.client, from_name, target_name, progress)
+        self.__record_volume(target_name, True)
+        self.volume_usage.invalidate()
+
+    def sync_named_volume(self, from_name: str, target_name: str, progress: ProgressCallback = None) -> SyncResult:
+        """
+        Updates the named volume target_name to have the same content as from_name, only copying changed files.
+        Creates target_name if it doesn't exist. Progress is reported to the optional callback.
+        """
+        try:
+            result = named_volumes.sync(self.client, from_name, target_name, progress)
+            self.__record_volume(target_name, True)
+            return result
+        finally:
+            self.volume_usage.invalidate()
+
+    def snapshot_named_volume(self, name: str, path: str) -> SnapshotResult:
+        """
+        Writes the content of the named volume into the file path, compressed with zstd if path ends
+        with .zst and gzip otherwise. A checksum file (path + '.sha256') is written next to it.
+        """
+        return named_volumes.snapshot(self.client, name, path)
+
+    def restore_named_volume(self, name: str, path: str) -> None:
+        """Creates the named volume from a file written by snapshot_named_volume. The volume must not exist."""
+        named_volumes.restore(self.client, name, path)
+        self.__record_volume(name, True)
+        self.volume_usage.invalidate()
 
     def create_named_volume(self, name: str) -> None:
         named_volumes.create(self.client, name)
+        self.__record_volume(name, True)
+        self.volume_usage.invalidate()
 
-    def __pull_image(self, image_name, line_reset, update_func):
-        try:
-            for line in self.client.api.pull(image_name, stream=True):
-                try:
-                    status = json.loads(line)
-                    if "progress" in status:
-                        update = status["status"] + " : " + status[ "progress"]
-                    else:
-                        update = status["status"]
-                except JSONDecodeError:
-                    update = line
-                update_func(f"{line_reset}    {update}")
-            update_func(f"{line_reset}    Done!\n")
-        except APIError as ex:
-            if "404 Client Error: Not Found " in str(ex):
-                update_func(f"{line_reset}    Warning: Image not found in repository.\n")
-            else:
-                raise
+    def __snapshot(self) -> Union[StateSnapshot, None]:
+        """Current state of the state tracker, None if it's not used or not ready."""
+        if self.state_tracker is None:
+            return None
+        return self.state_tracker.snapshot()
+
+    def __record_volume(self, name: str, exists: bool):
+        """Applies a change of a named volume to the state tracker, events of it may arrive later."""
+        if self.state_tracker is not None:
+            self.state_tracker.record_volume(named_volumes.NAMED_VOLUME_INTERNAL_PREFIX + name, exists)
+
+    def __start_network(self, project: 'Project'):
+        if self.use_link_groups:
+            network.start_link_group(self.client, project)
+        snapshot = self.__snapshot()
+        if snapshot is not None and get_network_name(project["name"]) in snapshot.networks:
+            return
+        network.start(self.client, project["name"])
+
+    def __run_start_scheduler(self, project_name: str, scheduler: DependencyScheduler):
+        self.last_start_reports[project_name] = scheduler.run()
+
+    @staticmethod
+    def __skip_start(queue: ResultQueue, reason: str):
+        queue.end_with_error(ResultError(reason))
@@ -1,5 +1,5 @@
+import functools
 import sys
-from time import sleep
 
 import riptide.lib.cross_platform.cppty as pty
 from typing import List, Union
@@ -14,12 +14,22 @@ from riptide.engine.abstract import ExecError
 
 from riptide_engine_docker.container_builder import get_cmd_container_name, get_network_name, \
     get_service_container_name, ContainerBuilder, EENV_USER, EENV_GROUP, EENV_RUN_MAIN_CMD_AS_USER, \
-    EENV_NO_STDOUT_REDIRECT
+    EENV_NO_STDOUT_REDIRECT, EENV_NETWORK_LINK_DELAY
 from riptide.lib.cross_platform.cpuser import getuid, getgid
+from riptide_engine_docker.image_cache import ImageConfigCache, normalize_image_name, with_image
+from riptide_engine_docker import network, attach
 from riptide_engine_docker.network import add_network_links
+from riptide_engine_docker.ports import PortAllocator
+from riptide_engine_docker.warm_pool import WarmPool, docker_cli_exec, exec_command, exec_user, HOME_IN_CONTAINER
 import threading
 
 DEFAULT_EXEC_FG_CMD = "if command -v bash >> /dev/null; then bash; else sh; fi"
+# Exit code of the Docker CLI if the container could not be created or started.
+DOCKER_CLI_ERROR_EXIT_CODE = 125
+# Time the entrypoint waits for link networks, if they can't be attached when the container is created.
+LINK_DELAY = "0.05"
+# Time to wait for the container to be created by 'docker run', before giving up adding link networks.
+ADD_NET_LINKS_TIMEOUT = 60
 
 
 def exec_fg(client,
@@ -49,18 +59,30 @@ def exec_fg(client,
             container.remove()
             raise ExecError('The service is not running. Try starting it first.')
 
-        # TODO: The Docker Python API doesn't seem to support interactive exec - use pty.spawn for now
-        shell = ["docker", "exec", "-it"]
-        if not root:
-            shell += ["-u", str(user) + ":" + str(user_group)]
+        environment = {}
         if cols and lines:
             # Add COLUMNS and LINES env variables
-            shell += ['-e', 'COLUMNS=' + str(cols), '-e', 'LINES=' + str(lines)]
-        for key, value in environment_variables.items():
-            shell += ['-e', key + '=' + value]
+            environment.update({'COLUMNS': str(cols), 'LINES': str(lines)})
+        environment.update(environment_variables)
+        workdir = None
         if "src" in service_obj["roles"]:
             # Service has source code, set workdir in container to current workdir
-            shell += ["-w", CONTAINER_SRC_PATH + "/" + get_current_relative_src_path(project)]
+            workdir = CONTAINER_SRC_PATH + "/" + get_current_relative_src_path(project)
+
+        if attach.supported():
+            return attach.exec_interactive(
+                client, container.id, ["sh", "-c", cmd],
+                user='' if root else str(user) + ":" + str(user_group),
+                environment=environment, workdir=workdir, size=(lines, cols), tty=attach.is_tty()
+            )
+
+        shell = ["docker", "exec", "-it"]
+        if not root:
+            shell += ["-u", str(user) + ":" + str(user_group)]
+        for key, value in environment.items():
+            shell += ['-e', key + '=' + value]
+        if workdir is not None:
+            shell += ["-w", workdir]
         shell += [container_name, "sh", "-c", cmd]
 
         return _spawn(shell)
@@ -71,7 +93,7 @@ def exec_fg(client,
         raise ExecError('Error communicating with the Docker Engine.') from err
 
 
-def service_fg(client, project: Project, service_name: str, arguments: List[str]) -> None:
+def service_fg(client, project: Project, service_name: str, arguments: List[str], link_groups=False) -> None:
     """Run a service in foreground"""
     if service_name not in project["app"]["services"]:
         raise ExecError("Service not found.")
@@ -79,18 +101,19 @@ def service_fg(client, project: Project, service_name: str, arguments: List[str]
     container_name = get_service_container_name(project['name'], service_name)
     command_obj = project["app"]["services"][service_name]
 
-    fg(client, project, container_name, command_obj, arguments)
+    fg(client, project, container_name, command_obj, arguments, link_groups=link_groups)
 
 
-def cmd_fg(client, project: Project, command_name: str, arguments: List[str]) -> int:
-    """Run a command in foreground, returns the exit code"""
+def cmd_fg(client, project: Project, command_name: str, arguments: List[str], warm_pool: WarmPool = None,
+           link_groups=False) -> int:
+    """Run a command in foreground, returns the exit code. Uses a warm container of the pool, if one is given."""
     if command_name not in project["app"]["commands"]:
         raise ExecError("Command not found.")
 
     container_name = get_cmd_container_name(project['name'], command_name)
     command_obj = project["app"]["commands"][command_name]
 
-    return fg(client, project, container_name, command_obj, arguments)
+    return fg(client, project, container_name, command_obj, arguments, warm_pool, link_groups)
 
 
 def cmd_in_service_fg(client, project: Project, command_name: str, service_name: str, arguments: List[str]) -> int:
@@ -100,20 +123,21 @@ def cmd_in_service_fg(client, project: Project, command_name: str, service_name:
                    environment_variables=command_obj.collect_environment())
 
 
-def fg(client, project: Project, container_name: str, exec_object: Union[Command, Service], arguments: List[str]) -> int:
-    # TODO: Piping | <
+def fg(client, project: Project, container_name: str, exec_object: Union[Command, Service], arguments: List[str],
+       warm_pool: WarmPool = None, link_groups=False) -> int:
+    # Without in-process attach (Windows), the Docker CLI fallback always runs with -it,
+    # so commands can't be used with pipes or redirects there.
     # TODO: Not only /src into container but everything
 
-    # Check if image exists
+    # Check if image exists (and get it's config)
     try:
-        image = client.images.get(exec_object["image"])
-        image_config = client.api.inspect_image(exec_object["image"])["Config"]
+        image_config = ImageConfigCache.get(client, exec_object["image"])
     except NotFound:
         print("Riptide: Pulling image... Your command will be run after that.", file=sys.stderr)
         try:
-            client.api.pull(exec_object['image'] if ":" in exec_object['image'] else exec_object['image'] + ":latest")
-            image = client.images.get(exec_object["image"])
-            image_config = client.api.inspect_image(exec_object["image"])["Config"]
+            client.api.pull(normalize_image_name(exec_object['image']))
+            ImageConfigCache.invalidate(exec_object["image"])
+            image_config = ImageConfigCache.get(client, exec_object["image"])
         except ImageNotFound as ex:
             print("Riptide: Could not pull. The image was not found. Your command will not run :(", file=sys.stderr)
             return
@@ -134,45 +158,169 @@ def fg(client, project: Project, container_name: str, exec_object: Union[Command
     builder.set_env(EENV_NO_STDOUT_REDIRECT, "yes")
     builder.set_args(arguments)
 
+    link_networks = network.link_network_names(client, project, link_groups)
+    # In-process, the container is created via the API, which attaches all networks before the container starts.
+    in_process = attach.supported()
+    links_on_create = in_process or network.supports_multiple_networks(client)
+    if links_on_create:
+        for link_network in link_networks:
+            builder.add_network(link_network)
+    else:
+        # The link networks are connected after 'docker run' started the container,
+        # the entrypoint waits a little while to avoid race conditions in resolving host names.
+        builder.set_env(EENV_NETWORK_LINK_DELAY, LINK_DELAY)
+
     if isinstance(exec_object, Service):
         builder.init_from_service(exec_object, image_config)
-        builder.service_add_main_port(exec_object)
+        builder.service_add_main_port(exec_object, PortAllocator(client))
     else:
         builder.init_from_command(exec_object, image_config)
         builder.set_env(EENV_RUN_MAIN_CMD_AS_USER, "yes")
         builder.set_env(EENV_USER, str(getuid()))
         builder.set_env(EENV_GROUP, str(getgid()))
 
-    # Using a new thread:
-    # Add the container link networks after docker run started... I tried a combo of Docker API create and Docker CLI
-    # start to make it cleaner, but 'docker start' does not work well for interactive commands at all,
-    # so that's the best we can do
-    AddNetLinks(container_name, client, project["links"]).start()
-
-    return _spawn(builder.build_docker_cli())
+        if warm_pool is not None and warm_pool.enabled:
+            pool_key = project["name"] + "/" + exec_object["$name"]
+            claimed = warm_pool.claim(builder, pool_key, container_name)
+            # Replace the claimed container (or fill the pool for the next run)
+            warm_pool.refill(builder, project["name"], pool_key)
+            if claimed:
+                try:
+                    if not links_on_create:
+                        add_network_links(client, client.containers.get(container_name), None, link_networks)
+                    if attach.supported():
+                        user = exec_user(builder)
+                        return attach.exec_interactive(
+                            client, container_name, exec_command(builder),
+                            user=user if user is not None else '',
+                            environment={'HOME': HOME_IN_CONTAINER} if user is not None else None,
+                            workdir=builder.work_dir, tty=attach.is_tty()
+                        )
+                    return _spawn(docker_cli_exec(builder, container_name))
+                finally:
+                    warm_pool.release(container_name)
+
+    if in_process:
+        try:
+            return _run_attached(client, project["name"], builder, attach.is_tty())
+        except APIError as err:
+            raise ExecError('Error communicating with the Docker Engine.') from err
+
+    if not links_on_create:
+        # Using a new thread:
+        # Add the container link networks after docker run started... I tried a combo of Docker API create and Docker CLI
+        # start to make it cleaner, but 'docker start' does not work well for interactive commands at all,
+        # so that's the best we can do
+        net_links = AddNetLinks(container_name, client, link_networks)
+        net_links.start()
 
+    try:
+        exit_code = _spawn(builder.build_docker_cli())
+        if exit_code == DOCKER_CLI_ERROR_EXIT_CODE and not network.check_exists(client, project["name"]):
+            # The project network was removed since it was last used, the container was not created.
+            network.start(client, project["name"])
+            exit_code = _spawn(builder.build_docker_cli())
+        return exit_code
+    finally:
+        if not links_on_create:
+            net_links.stop()
+
+
+def _run_attached(client, project_name: str, builder: ContainerBuilder, tty=True) -> int:
+    """
+    Runs the container of the builder like 'docker run --rm -it', but in-process: The container is created
+    (attached to all networks), attached to, started and the terminal is relayed until it exits.
+    Without tty, like 'docker run --rm -i': Input and output are piped through unchanged and Ctrl-C is
+    forwarded to the container.
+    If the image was removed since it's config was cached, it is pulled again.
+    """
+    config = builder.build_docker_api()
+    # Like the Docker CLI, the entrypoint receives the command as one string
+    config['command'] = [builder.build_command_string()]
+    config.update(tty=tty, stdin_open=True)
+    create = functools.partial(
+        with_image, client, builder.image,
+        functools.partial(network.with_project_network, client, project_name,
+                          functools.partial(network.create_container, client, config))
+    )
+    try:
+        container = create()
+    except APIError as err:
+        if err.status_code != 409 or not _remove_if_stopped(client, builder.name):
+            raise
+        # A container of an earlier run was left behind
+        container = create()
 
-def _spawn(shell: List[str]) -> int:
-    # XXX: Needs to be shifted by 1 byte because the return value of os.waitpid is shifted for some reason???
-    return pty.spawn(shell, win_repeat_argv0=True) >> 8
+    try:
+        # Attach before starting, to not miss any output
+        sock = client.api.attach_socket(container.id, params={'stdin': 1, 'stdout': 1, 'stderr': 1, 'stream': 1})
+        container.start()
+        attach.relay(sock, lambda lines, columns: client.api.resize(container.id, height=lines, width=columns),
+                     tty=tty, interrupt=lambda: client.api.kill(container.id, 'SIGINT'))
+        return client.api.wait(container.id)['StatusCode']
+    finally:
+        try:
+            container.remove(force=True)
+        except NotFound:
+            pass
 
 
-def _wait_until_container_exists(client, container_name):
+def _remove_if_stopped(client, name: str) -> bool:
+    """Removes the container, if it's not running. Returns whether it was removed."""
     try:
-        container = client.containers.get(container_name)
+        container = client.containers.get(name)
     except NotFound:
-        sleep(0.0025)
-        return _wait_until_container_exists(client, container_name)
-    return container
+        return True
+    if container.status == 'running':
+        return False
+    container.remove(force=True)
+    return True
+
+
+def _spawn(shell: List[str]) -> int:
+    # XXX: Needs to be shifted by 1 byte because the return value of os.waitpid is shifted for some reason???
+    return pty.spawn(shell, win_repeat_argv0=True) >> 8
 
 
 class AddNetLinks(threading.Thread):
-    def __init__(self, container_name, client, links):
+    """
+    Adds the link networks to a container as soon as it was created.
+
+    Subscribes to the Docker events of the container when constructed, so it must be constructed
+    before the container is created. The networks are added once, on the first create or start event.
+    Gives up after the timeout or when stop is called.
+    """
+    def __init__(self, container_name, client, networks, timeout=ADD_NET_LINKS_TIMEOUT):
         threading.Thread.__init__(self)
-        self.links = links
+        self.networks = networks
         self.client = client
         self.container_name = container_name
+        self.events = client.events(decode=True, filters={
+            'type': 'container',
+            'container': container_name,
+            'event': ['create', 'start']
+        })
+        self.timer = threading.Timer(timeout, self.stop)
+        self.timer.daemon = True
+
+    def start(self):
+        self.timer.start()
+        super().start()
+
+    def stop(self):
+        """Stop waiting for the container."""
+        self.events.close()
 
     def run(self):
-        container = _wait_until_container_exists(self.client, self.container_name)
-        add_network_links(self.client, container, None, self.links)
\ No newline at end of file
+        try:
+            for event in self.events:
+                if event.get('Actor', {}).get('Attributes', {}).get('name') != self.container_name:
+                    continue
+                self.stop()
+                add_network_links(self.client, self.client.containers.get(event['Actor']['ID']), None, self.networks)
+                return
+        except (APIError, OSError, ValueError):
+            # Stream was closed or the container was removed again
+            pass
+        finally:
+            self.timer.cancel()
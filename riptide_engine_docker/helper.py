@@ -0,0 +1,195 @@
+"""
+Optional long-lived helper containers for file operations of projects (path_rm, path_copy and their batch variants).
+
+Without helpers, each operation starts a new container running as root. With helpers, one idle helper container
+is kept per project, with the project directory mounted. Operations are run in it via exec, which is a lot
+faster than creating and starting a container.
+
+Operations of one project are queued: Only one operation per project runs at a time in this process.
+Operations of other processes use their own exec in the same helper, they don't interfere with each other.
+
+Helpers remove themselves after they were not used for the idle timeout, even if the process that started
+them is gone. The main process of the helper checks the time of the last use, which every exec updates.
+Every exec registers itself in HELPER_RUNNING_DIR while it runs. To exit, the main process renames that directory
+(which no exec can register in afterwards) and only exits if it is empty, else it renames it back. An exec that
+can't register in the meantime waits until the directory is back, or exits with HELPER_EXITED_EXIT_CODE if the
+helper exits. The exec is then run again in a new helper.
+
+Only available on POSIX systems. Paths outside the project directory are not available in the helper,
+operations on them use a new container.
+"""
+import os
+import threading
+from typing import Dict, List
+
+from docker import DockerClient
+from docker.errors import NotFound, APIError
+from docker.types import Mount
+
+from riptide.config.files import path_in_project
+from riptide_engine_docker.cmd_detached import DetachedOutput
+from riptide_engine_docker.container_builder import RIPTIDE_DOCKER_LABEL_IS_RIPTIDE
+from riptide_engine_docker.image_cache import get_image_config
+from riptide_engine_docker.util import socket_output
+
+RIPTIDE_DOCKER_LABEL_HELPER = 'riptide_helper'
+# Project directory mounted in the helper. Helpers of another directory (eg. a moved project) are replaced.
+RIPTIDE_DOCKER_LABEL_HELPER_FOLDER = 'riptide_helper_folder'
+# Default time in seconds after which unused helper containers remove themselves.
+DEFAULT_HELPER_IDLE_TIMEOUT = 300
+# Host paths are mounted below this path in the helper
+HELPER_HOST_ROOT = '/host'
+
+HELPER_USED_FILE = '/tmp/.riptide_helper_used'
+HELPER_RUNNING_DIR = '/tmp/.riptide_helper_running'
+HELPER_CLOSING_DIR = '/tmp/.riptide_helper_closing'
+HELPER_EXITED_FILE = '/tmp/.riptide_helper_exited'
+# Exit code of execs that didn't run their script, because the helper is exiting (EX_TEMPFAIL).
+# The scripts of path_utils never exit with it.
+HELPER_EXITED_EXIT_CODE = 75
+
+# Main process of helpers. Exits once no operation ran for $1 seconds and none is running.
+IDLE_SCRIPT = f'''mkdir -p {HELPER_RUNNING_DIR}
+touch {HELPER_USED_FILE}
+while true; do
+    if [ -n "$(ls -A {HELPER_RUNNING_DIR})" ]; then
+        touch {HELPER_USED_FILE}
+    elif [ $(( $(date +%s) - $(stat -c %Y {HELPER_USED_FILE}) )) -ge $1 ] && \\
+            mv {HELPER_RUNNING_DIR} {HELPER_CLOSING_DIR}; then
+        if [ -z "$(ls -A {HELPER_CLOSING_DIR})" ]; then
+            touch {HELPER_EXITED_FILE}
+            # Time for waiting execs to report that they didn't run
+            sleep 1
+            exit 0
+        fi
+        mv {HELPER_CLOSING_DIR} {HELPER_RUNNING_DIR}
+    fi
+    sleep 5
+done'''
+# Runs the script $1 and marks the helper as used while it runs.
+EXEC_SCRIPT = f'''until touch {HELPER_RUNNING_DIR}/$$ 2> /dev/null; do
+    if [ -e {HELPER_EXITED_FILE} ]; then
+        exit {HELPER_EXITED_EXIT_CODE}
+    fi
+    sleep 0.05
+done
+touch {HELPER_USED_FILE}
+sh -c "$1"
+code=$?
+rm -f {HELPER_RUNNING_DIR}/$$
+touch {HELPER_USED_FILE}
+exit $code'''
+
+
+class HelperService:
+    """Keeps one helper container per project, see module documentation. Thread-safe."""
+
+    def __init__(self, client: DockerClient, image: str, idle_timeout: int = DEFAULT_HELPER_IDLE_TIMEOUT):
+        self.client = client
+        self.image = image
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._project_locks: Dict[str, threading.Lock] = {}
+
+    @staticmethod
+    def supported() -> bool:
+        return os.name == 'posix'
+
+    def can_run(self, project: 'Project', paths: List[str]) -> bool:
+        """Whether all paths are available in the helper of the project."""
+        return self.supported() and all(path_in_project(p, project) for p in paths)
+
+    def exec(self, project: 'Project', script: str) -> DetachedOutput:
+        """
+        Runs the shell script as root in the helper of the project, after the operations queued before.
+        Paths in the script must be converted with container_path. The output is streamed, see DetachedOutput.
+        """
+        def run():
+            with self._project_lock(project["name"]):
+                for is_retry in (False, True):
+                    name = self._ensure_running(project)
+                    try:
+                        exec_instance = self.client.api.exec_create(name, ['sh', '-c', EXEC_SCRIPT, 'sh', script])
+                    except APIError as err:
+                        if is_retry or err.status_code not in (404, 409):
+                            raise
+                        # The helper just exited because of the idle timeout
+                        self._wait_removed(name)
+                        continue
+                    # Execs that didn't run their script don't have any output
+                    yield from socket_output(self.client.api.exec_start(exec_instance, socket=True))
+                    exit_code = self.client.api.exec_inspect(exec_instance)['ExitCode']
+                    if exit_code != HELPER_EXITED_EXIT_CODE or is_retry:
+                        return exit_code
+                    # The helper exited because of the idle timeout, right after the exec was created
+                    self._wait_removed(name)
+
+        return DetachedOutput(run())
+
+    def stop(self, project_name: str) -> None:
+        """Removes the helper of the project, if it runs."""
+        try:
+            self.client.api.remove_container(get_helper_name(project_name), force=True)
+        except NotFound:
+            pass
+
+    def _ensure_running(self, project: 'Project') -> str:
+        """
+        Starts the helper of the project, if it doesn't run or doesn't have the project directory mounted.
+        Returns it's name.
+        """
+        name = get_helper_name(project["name"])
+        folder = os.path.abspath(project.folder())
+        try:
+            container = self.client.containers.get(name)
+            if container.status == 'running' and container.labels.get(RIPTIDE_DOCKER_LABEL_HELPER_FOLDER) == folder:
+                return name
+            container.remove(force=True)
+        except NotFound:
+            pass
+        except APIError as err:
+            if err.status_code != 409:
+                raise
+            # The helper exited and is being removed
+            self._wait_removed(name)
+
+        get_image_config(self.client, self.image)
+        try:
+            self.client.containers.run(
+                self.image, ['sh', '-c', IDLE_SCRIPT, 'sh', str(self.idle_timeout)],
+                name=name,
+                detach=True,
+                auto_remove=True,
+                user='0',
+                labels={
+                    RIPTIDE_DOCKER_LABEL_IS_RIPTIDE: '1',
+                    RIPTIDE_DOCKER_LABEL_HELPER: project["name"],
+                    RIPTIDE_DOCKER_LABEL_HELPER_FOLDER: folder
+                },
+                mounts=[Mount(target=container_path(folder), source=folder, type='bind')]
+            )
+        except APIError as err:
+            if err.status_code != 409:
+                raise
+            # Another process started the helper at the same time
+        return name
+
+    def _wait_removed(self, name: str) -> None:
+        """Waits until the helper exited and was removed (helpers are started with auto_remove)."""
+        try:
+            self.client.api.wait(name, condition='removed')
+        except NotFound:
+            pass
+
+    def _project_lock(self, project_name: str) -> threading.Lock:
+        with self._lock:
+            return self._project_locks.setdefault(project_name, threading.Lock())
+
+
+def container_path(host_path: str) -> str:
+    """Path of the host path in helper containers."""
+    return HELPER_HOST_ROOT + os.path.abspath(host_path)
+
+
+def get_helper_name(project_name: str) -> str:
+    return 'riptide__' + project_name + '__helper'
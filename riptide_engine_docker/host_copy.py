@@ -0,0 +1,192 @@
+"""
+Copying directories on the host, without a container.
+
+path_utils.copy uses a root container because the files may belong to other users (eg. created by services
+running as root). Most of the time all files belong to the user running Riptide though, and the copy can be
+done directly on the host, which is a lot faster.
+
+Only entries owned by the current user (and existing target entries owned by the current user) are copied
+on the host, so that the result is the same as with cp -a in a root container: Copies get the group of the source
+and hard links between copied files are kept. Entries whose group the user can't set, and all other entries,
+are returned and must be copied with the container. Files are copied by a thread pool, using reflinks
+(copy-on-write clones) if the file system supports them, else copy_file_range, else regular reads and writes.
+
+Only used on Linux. There shutil.copystat also copies extended attributes, including POSIX ACLs, like cp -a.
+Attributes the user can't set (eg. security.* attributes, such as file capabilities) are skipped though.
+On macOS and Windows, the Docker VM shows other owners than the host and extended attributes are not copied,
+so the result would differ from the copy of the container.
+"""
+import errno
+import os
+import platform
+import shutil
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Number of files copied at the same time.
+HOST_COPY_WORKERS = 8
+# ioctl to clone a file on copy-on-write file systems (Linux, btrfs/XFS)
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def supported() -> bool:
+    """Whether copying on the host gives the same result as copying in a container. Only on Linux."""
+    return platform.system() == 'Linux'
+
+
+def copy_tree(fromm: str, to: str, workers: int = HOST_COPY_WORKERS) -> List[Tuple[str, str]]:
+    """
+    Copies the content of the directory fromm into the directory to (like cp -a fromm/. to/).
+    Returns (source, target) pairs of the entries that could not be copied and must be copied by root.
+    """
+    uid = os.getuid()
+    remaining = []
+    files = []
+    directories = []
+    # Further paths of files with multiple hard links: (path of the first copy, source, target)
+    links = []
+    first_copies = {}
+    try:
+        if not _owned_by(to, uid, True):
+            raise PermissionError()
+        os.makedirs(to, exist_ok=True)
+    except PermissionError:
+        return [(fromm, to)]
+    directories.append((fromm, to))
+    for root, dir_names, file_names in os.walk(fromm):
+        target_root = os.path.normpath(os.path.join(to, os.path.relpath(root, fromm)))
+        for dir_name in list(dir_names):
+            source = os.path.join(root, dir_name)
+            target = os.path.join(target_root, dir_name)
+            if os.path.islink(source):
+                # Not followed by os.walk, copied like a file
+                dir_names.remove(dir_name)
+                file_names.append(dir_name)
+            elif _owned_by(source, uid) and _owned_by(target, uid, True) and os.access(source, os.R_OK | os.X_OK) \
+                    and _make_dir(target):
+                directories.append((source, target))
+            else:
+                # The whole directory is copied by root
+                dir_names.remove(dir_name)
+                remaining.append((source, target))
+        for file_name in file_names:
+            source = os.path.join(root, file_name)
+            target = os.path.join(target_root, file_name)
+            source_stat = os.lstat(source)
+            mode = source_stat.st_mode
+            is_copyable = (stat.S_ISREG(mode) and os.access(source, os.R_OK)) or stat.S_ISLNK(mode)
+            if is_copyable and _owned_by(source, uid) and _owned_by(target, uid, True) and not os.path.isdir(target):
+                inode = (source_stat.st_dev, source_stat.st_ino)
+                if stat.S_ISREG(mode) and source_stat.st_nlink > 1 and inode in first_copies:
+                    links.append((first_copies[inode], source, target))
+                    continue
+                if stat.S_ISREG(mode) and source_stat.st_nlink > 1:
+                    first_copies[inode] = target
+                files.append((source, target))
+            else:
+                remaining.append((source, target))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for failed in executor.map(lambda pair: _copy_entry(*pair), files):
+            if failed is not None:
+                remaining.append(failed)
+    failed_targets = {target for _, target in remaining}
+    for first_copy, source, target in links:
+        if first_copy in failed_targets or not _link(first_copy, target):
+            remaining.append((source, target))
+    # Only after all files were copied, since copying files into a directory changes it's modification time
+    for source, target in reversed(directories):
+        try:
+            _copy_group(source, target)
+            shutil.copystat(source, target)
+        except PermissionError:
+            remaining.append((source, target))
+    return remaining
+
+
+def _copy_entry(source: str, target: str):
+    """Copies a file or symlink. Returns (source, target) if that's not possible."""
+    try:
+        if os.path.islink(source):
+            if os.path.lexists(target):
+                os.remove(target)
+            os.symlink(os.readlink(source), target)
+            _copy_group(source, target)
+            shutil.copystat(source, target, follow_symlinks=False)
+        else:
+            _copy_file(source, target)
+            # Before copystat, changing the group clears the setuid and setgid bits.
+            _copy_group(source, target)
+            shutil.copystat(source, target)
+        return None
+    except PermissionError:
+        return source, target
+
+
+def _copy_group(source: str, target: str):
+    """Gives the target the group of the source. Raises PermissionError if the user is not in the group."""
+    gid = os.lstat(source).st_gid
+    if os.lstat(target).st_gid != gid:
+        os.chown(target, -1, gid, follow_symlinks=False)
+
+
+def _link(existing: str, target: str) -> bool:
+    """Hard links target to the existing file. Returns False if that's not possible."""
+    try:
+        if os.path.lexists(target):
+            os.remove(target)
+        os.link(existing, target)
+        return True
+    except OSError:
+        return False
+
+
+def _copy_file(source: str, target: str):
+    with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+        if _reflink(source_file, target_file):
+            return
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while os.copy_file_range(source_file.fileno(), target_file.fileno(), COPY_CHUNK_SIZE) > 0:
+                    pass
+                return
+            except OSError as err:
+                if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                source_file.seek(0)
+                target_file.seek(0)
+                target_file.truncate()
+        shutil.copyfileobj(source_file, target_file, COPY_CHUNK_SIZE)
+
+
+def _reflink(source_file, target_file) -> bool:
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def _make_dir(path: str) -> bool:
+    try:
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        return True
+    except (PermissionError, FileExistsError):
+        return False
+
+
+def _owned_by(path: str, uid: int, missing_ok=False) -> bool:
+    try:
+        return os.lstat(path).st_uid == uid
+    except FileNotFoundError:
+        return missing_ok
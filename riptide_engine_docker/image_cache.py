@@ -0,0 +1,152 @@
+"""
+Cache for the configuration of images (Entrypoint, Cmd, User, ...), as returned by inspect_image.
+
+Containers for services and commands need the configuration of their image. The cache keeps it in memory
+and in a file in the Riptide configuration directory, keyed by image ID, with a mapping from image names to
+image IDs. This saves inspecting the image on every start and every command.
+
+Cached entries are trusted without asking the Docker daemon. The mapping of an image name is invalidated when
+a pull by Riptide downloaded a new version of the image, and at the point of use when the image could not be found
+anymore (see with_image): Creating the container fails then, the image is pulled and the creation is retried.
+Images that are re-tagged outside of Riptide (eg. by 'docker build -t') keep their cached config until Riptide
+pulls the image again.
+"""
+import copy
+import json
+import os
+import threading
+from typing import Dict, Callable, TypeVar
+
+from docker import DockerClient
+from docker.errors import NotFound, ImageNotFound
+
+from riptide.config.files import riptide_config_dir
+
+IMAGE_CACHE_FILE = 'docker_image_configs.json'
+# Only these keys of the image configuration are used by the engine and cached.
+CACHED_CONFIG_KEYS = ['Entrypoint', 'Cmd', 'User', 'Healthcheck']
+# Status line of a pull that didn't change the image.
+PULL_STATUS_UP_TO_DATE = 'Image is up to date'
+
+T = TypeVar('T')
+
+
+def normalize_image_name(image_name: str) -> str:
+    """Adds the 'latest' tag to image names without tag or digest."""
+    return image_name if ":" in image_name else image_name + ":latest"
+
+
+class ImageConfigCache:
+    """
+    Singleton (via class methods).
+
+    Thread-safe. Changes are written to disk immediately.
+    """
+
+    _lock = threading.Lock()
+    _images: Dict[str, dict] = None  # image id -> config
+    _names: Dict[str, str] = None  # normalized image name -> image id
+
+    @classmethod
+    def get(cls, client: DockerClient, image_name: str) -> dict:
+        """
+        Returns the configuration of the image. Only inspects the image if it's not cached.
+        Callers may modify the returned dict.
+
+        :raises: docker.errors.NotFound: If the image does not exist locally.
+        """
+        name = normalize_image_name(image_name)
+        with cls._lock:
+            cls._load()
+            if cls._names.get(name) in cls._images:
+                return copy.deepcopy(cls._images[cls._names[name]])
+
+        image = client.api.inspect_image(image_name)
+        config = {key: (image["Config"] or {}).get(key) for key in CACHED_CONFIG_KEYS}
+        with cls._lock:
+            cls._names[name] = image["Id"]
+            cls._images[image["Id"]] = config
+            cls._write()
+        return copy.deepcopy(config)
+
+    @classmethod
+    def invalidate(cls, image_name: str) -> None:
+        """Forget the image the image name refers to. The next get will inspect the image again."""
+        name = normalize_image_name(image_name)
+        with cls._lock:
+            cls._load()
+            if name in cls._names:
+                image_id = cls._names.pop(name)
+                if image_id not in cls._names.values():
+                    cls._images.pop(image_id, None)
+                cls._write()
+
+    @classmethod
+    def after_pull(cls, image_name: str, last_status: str) -> None:
+        """
+        Must be called after an image was pulled, with the last status line of the pull.
+        Invalidates the image, unless the pull reported it as already up to date.
+        """
+        if PULL_STATUS_UP_TO_DATE not in last_status:
+            cls.invalidate(image_name)
+
+    @classmethod
+    def _load(cls):
+        if cls._images is not None:
+            return
+        cls._images = {}
+        cls._names = {}
+        try:
+            with open(_cache_file(), mode='r') as file:
+                data = json.load(file)
+            cls._images = data["images"]
+            cls._names = data["names"]
+        except (OSError, ValueError, KeyError):
+            # No or broken cache file, start from scratch.
+            pass
+
+    @classmethod
+    def _write(cls):
+        path = _cache_file()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}'
+            with open(tmp_path, mode='w') as file:
+                json.dump({"images": cls._images, "names": cls._names}, file)
+            os.replace(tmp_path, path)
+        except OSError:
+            # The cache still works in memory.
+            pass
+
+
+def get_image_config(client: DockerClient, image_name: str) -> dict:
+    """
+    Returns the (cached) configuration of the image. Pulls the image if it doesn't exist locally.
+
+    :raises: docker.errors.APIError: If pulling failed
+    :raises: docker.errors.ImageNotFound: If the image was not found in the repository.
+    """
+    try:
+        return ImageConfigCache.get(client, image_name)
+    except NotFound:
+        client.api.pull(normalize_image_name(image_name))
+        ImageConfigCache.invalidate(image_name)
+        return ImageConfigCache.get(client, image_name)
+
+
+def with_image(client: DockerClient, image_name: str, func: Callable[[], T]) -> T:
+    """
+    Calls func, which uses the image (eg. creates a container of it).
+    If func fails because the image doesn't exist (anymore), the image is forgotten by the cache and pulled,
+    then func is called again.
+    """
+    try:
+        return func()
+    except ImageNotFound:
+        ImageConfigCache.invalidate(image_name)
+        get_image_config(client, image_name)
+        return func()
+
+
+def _cache_file() -> str:
+    return os.path.join(riptide_config_dir(), IMAGE_CACHE_FILE)
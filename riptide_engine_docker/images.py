@@ -0,0 +1,140 @@
+"""
+Pulling of the images of a project.
+
+Every image is only pulled once, even if multiple services or commands use it, and multiple images are
+pulled in parallel. Images whose local digest already matches the digest in the registry are not pulled.
+"""
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from json import JSONDecodeError
+from typing import Dict, List, Callable
+
+from docker import DockerClient
+from docker.errors import APIError, NotFound
+
+from riptide_engine_docker.image_cache import ImageConfigCache, normalize_image_name
+
+# Default number of images that are pulled at the same time.
+DEFAULT_MAX_PARALLEL_PULLS = 4
+# Interval in which the combined progress of all running pulls is updated, in seconds.
+PROGRESS_UPDATE_INTERVAL = 0.25
+
+LAYER_DONE_STATUSES = ['Pull complete', 'Already exists']
+
+
+class PullProgress:
+    """Combines the progress of all layers of one image pull into one line."""
+
+    def __init__(self):
+        self.layers = OrderedDict()  # layer id -> status
+        self.bytes = {}  # layer id -> (downloaded, total)
+        self.status = 'Waiting'
+
+    def update(self, status: dict):
+        if "id" not in status or "progressDetail" not in status:
+            # Status for the entire image, eg. "Pulling from ..."
+            self.status = status.get("status", self.status)
+            return
+        layer = status["id"]
+        self.layers[layer] = status.get("status", "")
+        detail = status["progressDetail"]
+        if self.layers[layer] == 'Downloading' and "total" in detail:
+            self.bytes[layer] = (detail.get("current", 0), detail["total"])
+        elif self.layers[layer] == 'Download complete' and layer in self.bytes:
+            self.bytes[layer] = (self.bytes[layer][1], self.bytes[layer][1])
+
+    def __str__(self):
+        if len(self.layers) == 0:
+            return self.status
+        done = sum(1 for status in self.layers.values() if status in LAYER_DONE_STATUSES)
+        text = f'{done}/{len(self.layers)} layers'
+        if len(self.bytes) > 0:
+            current = sum(b[0] for b in self.bytes.values()) / 1000000
+            total = sum(b[1] for b in self.bytes.values()) / 1000000
+            text += f', {current:.1f}/{total:.1f} MB'
+        return text
+
+
+def collect_images(project: 'Project') -> Dict[str, List[str]]:
+    """Returns all images used by services and commands of the project (normalized name -> list of users)."""
+    images = OrderedDict()
+    if "services" in project["app"]:
+        for name, service in project["app"]["services"].items():
+            images.setdefault(normalize_image_name(service['image']), []).append(f"service/{name}")
+    if "commands" in project["app"]:
+        for name, command in project["app"]["commands"].items():
+            if "image" in command:
+                images.setdefault(normalize_image_name(command['image']), []).append(f"command/{name}")
+    return images
+
+
+def pull_all(client: DockerClient, images: Dict[str, List[str]], max_workers: int,
+             line_reset: str, update_func: Callable[[str], None]) -> None:
+    """
+    Pulls all images in parallel. See AbstractEngine.pull_images for the output format.
+    While pulls are running, one line with the progress of all running pulls is shown.
+    The result of each image is shown as soon as it's pull is done.
+
+    :param images: Images to pull (normalized name -> list of services/commands using it)
+    """
+    progress = {image: PullProgress() for image in images.keys()}
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {executor.submit(pull, client, image, progress[image]): image for image in images.keys()}
+        last_line = None
+        while len(running) > 0:
+            done, _ = wait(running.keys(), timeout=PROGRESS_UPDATE_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                image = running.pop(future)
+                if last_line is not None:
+                    update_func(line_reset)
+                    last_line = None
+                if future.exception() is not None:
+                    errors.append(future.exception())
+                    result = f"Error: {future.exception()}"
+                else:
+                    result = future.result()
+                update_func(f"[{', '.join(images[image])}] Pulling '{image}':\n    {result}\n")
+            if len(running) > 0:
+                line = "    " + ", ".join(f"{image}: {progress[image]}" for image in running.values())
+                if line != last_line:
+                    update_func(f"{line_reset}{line}")
+                    last_line = line
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def pull(client: DockerClient, image_name: str, progress: PullProgress) -> str:
+    """Pull one image, unless it's up to date. Returns the result as text."""
+    if is_up_to_date(client, image_name):
+        return "Already up to date."
+    try:
+        last_status = ""
+        for line in client.api.pull(image_name, stream=True):
+            try:
+                status = json.loads(line)
+                last_status = status.get("status", "")
+                progress.update(status)
+            except JSONDecodeError:
+                pass
+        ImageConfigCache.after_pull(image_name, last_status)
+        return "Done!"
+    except APIError as ex:
+        if "404 Client Error: Not Found " in str(ex):
+            return "Warning: Image not found in repository."
+        raise
+
+
+def is_up_to_date(client: DockerClient, image_name: str) -> bool:
+    """Whether the local image has the same digest as the image in the registry."""
+    try:
+        repo_digests = client.api.inspect_image(image_name).get("RepoDigests") or []
+        if len(repo_digests) == 0:
+            # Image exists only locally or not at all
+            return False
+        remote_digest = client.api.inspect_distribution(image_name)["Descriptor"]["digest"]
+    except (APIError, NotFound, KeyError):
+        # Missing image, registry not reachable or not supported, just try to pull.
+        return False
+    return any(digest.endswith("@" + remote_digest) for digest in repo_digests)
@@ -0,0 +1,147 @@
+"""
+Link groups: An optional network topology for linked projects.
+
+Normally every container of a project joins the network of every project in it's links. With many
+mutually linked projects this means many networks per container and a lot of work for the daemon.
+
+With link groups, all projects that are (directly or indirectly) linked with each other share one
+network riptide__link__<group>. Every container then joins at most two networks: The network of it's project
+and the network of it's link group. Containers of linked projects reach each other by container name.
+Service name aliases are only set in the project network, since they would be ambiguous in the group.
+
+The link graph is only known partially: Each project only knows it's own links. The links of all projects
+that were used are collected in a file in the Riptide configuration directory; the groups are the
+connected components of this graph. A group is named after it's alphabetically first project.
+
+If a group changes (eg. because a new link connects two groups), the running service containers of the group
+are migrated: They are connected to the new group network and disconnected from old group networks and from
+networks of other projects (from the normal topology). Unused old group networks are removed.
+"""
+import json
+import os
+import threading
+from typing import Dict, List, Union, Set
+
+from docker import DockerClient
+from docker.errors import APIError
+
+from riptide.config.files import riptide_config_dir
+from riptide_engine_docker.container_builder import RIPTIDE_DOCKER_LABEL_PROJECT, get_network_name
+
+LINK_GRAPH_FILE = 'docker_link_graph.json'
+LINK_GROUP_NETWORK_PREFIX = 'riptide__link__'
+RIPTIDE_DOCKER_LABEL_LINK_GROUP = 'riptide_link_group'
+
+
+class LinkGraph:
+    """
+    Links of all known projects (project name -> linked project names).
+
+    Singleton (via class methods). Thread-safe. Changes are written to disk immediately.
+    """
+
+    _lock = threading.Lock()
+    _links: Dict[str, List[str]] = None
+
+    @classmethod
+    def update(cls, project_name: str, links: List[str]) -> bool:
+        """Sets the links of a project. Returns whether they changed."""
+        links = sorted(set(links) - {project_name})
+        with cls._lock:
+            cls._load()
+            if cls._links.get(project_name) == links:
+                return False
+            cls._links[project_name] = links
+            cls._write()
+            return True
+
+    @classmethod
+    def group_of(cls, project_name: str) -> Set[str]:
+        """All projects linked with the project, directly or indirectly, including the project itself."""
+        with cls._lock:
+            cls._load()
+            neighbours = {}
+            for project, links in cls._links.items():
+                for link in links:
+                    neighbours.setdefault(project, set()).add(link)
+                    neighbours.setdefault(link, set()).add(project)
+        group = {project_name}
+        todo = [project_name]
+        while len(todo) > 0:
+            for neighbour in neighbours.get(todo.pop(), set()):
+                if neighbour not in group:
+                    group.add(neighbour)
+                    todo.append(neighbour)
+        return group
+
+    @classmethod
+    def _load(cls):
+        if cls._links is not None:
+            return
+        cls._links = {}
+        try:
+            with open(_graph_file(), mode='r') as file:
+                cls._links = json.load(file)
+        except (OSError, ValueError):
+            pass
+
+    @classmethod
+    def _write(cls):
+        path = _graph_file()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}'
+            with open(tmp_path, mode='w') as file:
+                json.dump(cls._links, file)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+
+def get_group_network_name(project_name: str) -> Union[str, None]:
+    """Name of the link group network of the project. None if the project is not linked with other projects."""
+    group = LinkGraph.group_of(project_name)
+    if len(group) < 2:
+        return None
+    return LINK_GROUP_NETWORK_PREFIX + min(group)
+
+
+def migrate(client: DockerClient, project_name: str) -> List[str]:
+    """
+    Moves the running service containers of the group of the project to the group network and removes
+    them from the networks of other projects and old group networks. Removes unused group networks
+    and returns their names.
+    """
+    group = LinkGraph.group_of(project_name)
+    group_network = get_group_network_name(project_name)
+    group_project_networks = {get_network_name(p) for p in group}
+    for container in client.api.containers(filters={'label': RIPTIDE_DOCKER_LABEL_PROJECT}):
+        container_project = container['Labels'][RIPTIDE_DOCKER_LABEL_PROJECT]
+        if container_project not in group:
+            continue
+        networks = (container.get('NetworkSettings') or {}).get('Networks') or {}
+        if group_network is not None and group_network not in networks:
+            client.api.connect_container_to_network(container['Id'], group_network)
+        for network_name in networks.keys():
+            is_old_group = network_name.startswith(LINK_GROUP_NETWORK_PREFIX) and network_name != group_network
+            is_other_project = network_name in group_project_networks \
+                and network_name != get_network_name(container_project)
+            if is_old_group or is_other_project:
+                try:
+                    client.api.disconnect_container_from_network(container['Id'], network_name)
+                except APIError:
+                    pass
+    removed = []
+    for network in client.api.networks(filters={'label': RIPTIDE_DOCKER_LABEL_LINK_GROUP}):
+        if network['Name'] != group_network:
+            try:
+                # Fails if containers (of other groups) still use it
+                client.api.remove_network(network['Id'])
+                removed.append(network['Name'])
+            except APIError:
+                pass
+    return removed
+
+
+def _graph_file() -> str:
+    return os.path.join(riptide_config_dir(), LINK_GRAPH_FILE)
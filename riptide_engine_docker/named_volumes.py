@@ -1,16 +1,55 @@
 """
 Module for manipulating and listing Docker named volumes. For function docs, see engine interface specifications.
 """
-from typing import List
+import threading
+from datetime import datetime
+from time import time
+from typing import List, NamedTuple, Union, Dict
 
 from docker import DockerClient
-from docker.errors import NotFound, ContainerError
+from docker.errors import NotFound
 
 from riptide.engine.abstract import ExecError
 from riptide_engine_docker.container_builder import RIPTIDE_DOCKER_LABEL_IS_RIPTIDE, ContainerBuilder
+from riptide_engine_docker import volume_sync, volume_archive
 from riptide_engine_docker.path_utils import IMAGE as PATH_UTILS_IMAGE
+from riptide_engine_docker.volume_archive import SnapshotResult
+from riptide_engine_docker.volume_sync import ProgressCallback, DEFAULT_SYNC_WORKERS, SyncResult
 
 NAMED_VOLUME_INTERNAL_PREFIX = 'riptide__'
+# Time in seconds the result of the disk usage query is reused by VolumeUsageCache.
+DEFAULT_VOLUME_USAGE_TTL = 60
+
+
+class NamedVolumeUsage(NamedTuple):
+    name: str
+    # Size in bytes. None if the daemon didn't calculate it.
+    size: Union[int, None]
+    # Unix timestamp, see usage.
+    last_used: Union[int, None]
+    # Names of the containers using the volume.
+    containers: List[str]
+
+
+class VolumeUsageCache:
+    """Caches the result of usage for ttl seconds. Thread-safe."""
+
+    def __init__(self, ttl: int = DEFAULT_VOLUME_USAGE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._usage: List[NamedVolumeUsage] = None
+        self._time = 0
+
+    def get(self, client: DockerClient) -> List[NamedVolumeUsage]:
+        with self._lock:
+            if self._usage is None or time() - self._time > self.ttl:
+                self._usage = usage(client)
+                self._time = time()
+            return self._usage
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._usage = None
 
 
 def list(client: DockerClient) -> List[str]:
@@ -26,12 +65,50 @@ def list(client: DockerClient) -> List[str]:
     return volumes_wo_prefix
 
 
+def usage(client: DockerClient) -> List[NamedVolumeUsage]:
+    """
+    Size, last use and the containers using each named volume, from one disk usage query of the daemon.
+
+    Docker doesn't record when a volume was used. last_used is the current time if a running container uses
+    the volume, else the creation time of the newest container using it, else the creation time of the volume.
+    """
+    df = client.df()
+    containers_by_volume: Dict[str, List[dict]] = {}
+    for container in df.get('Containers') or []:
+        for mount in container.get('Mounts') or []:
+            if mount.get('Type') == 'volume':
+                containers_by_volume.setdefault(mount.get('Name'), []).append(container)
+
+    result = []
+    len_prefix = len(NAMED_VOLUME_INTERNAL_PREFIX)
+    for volume in df.get('Volumes') or []:
+        if RIPTIDE_DOCKER_LABEL_IS_RIPTIDE not in (volume.get('Labels') or {}):
+            continue
+        name = volume['Name']
+        containers = containers_by_volume.get(name, [])
+        size = (volume.get('UsageData') or {}).get('Size', -1)
+        if any(c.get('State') == 'running' for c in containers):
+            last_used = int(time())
+        elif len(containers) > 0:
+            last_used = max(c.get('Created', 0) for c in containers)
+        else:
+            last_used = _parse_time(volume.get('CreatedAt'))
+        result.append(NamedVolumeUsage(
+            name[len_prefix:] if name.startswith(NAMED_VOLUME_INTERNAL_PREFIX) else name,
+            size if size >= 0 else None,
+            last_used,
+            [c['Names'][0].lstrip('/') for c in containers if c.get('Names')]
+        ))
+    return result
+
+
 def delete(client: DockerClient, name: str) -> None:
     try:
         client.volumes.get(NAMED_VOLUME_INTERNAL_PREFIX + name).remove(True)
     except NotFound:
         # this is fine.
         pass
+    volume_sync.delete_manifest(name)
 
 
 def exists(client: DockerClient, name: str) -> bool:
@@ -42,22 +119,66 @@ def exists(client: DockerClient, name: str) -> bool:
         return False
 
 
-def copy(client: DockerClient, from_name: str, target_name: str) -> None:
+def copy(client: DockerClient, from_name: str, target_name: str,
+         progress: ProgressCallback = None, workers: int = DEFAULT_SYNC_WORKERS) -> None:
     if not exists(client, from_name):
         raise FileExistsError(f"The named volume {from_name} does not exist.")
     if exists(client, target_name):
         raise FileExistsError(f"The named volume {target_name} already exists.")
 
-    builder = ContainerBuilder(PATH_UTILS_IMAGE, 'cp -a /copy_from/. /copy_to/')
-    builder.set_named_volume_mount(from_name, '/copy_from', 'rw')
-    builder.set_named_volume_mount(target_name, '/copy_to', 'rw')
+    try:
+        volume_sync.sync(client, _sync_builder(from_name, target_name), from_name, target_name, progress, workers)
+    except ExecError as err:
+        raise ExecError(f"Error copying the named volume {from_name} -> {target_name}: {err}") from err
+
+
+def sync(client: DockerClient, from_name: str, target_name: str,
+         progress: ProgressCallback = None, workers: int = DEFAULT_SYNC_WORKERS) -> SyncResult:
+    """
+    Incrementally updates the named volume target_name to have the same content as from_name.
+    target_name is created if it doesn't exist. See volume_sync.
+    """
+    if not exists(client, from_name):
+        raise FileExistsError(f"The named volume {from_name} does not exist.")
+
+    try:
+        return volume_sync.sync(
+            client, _sync_builder(from_name, target_name), from_name, target_name, progress, workers
+        )
+    except ExecError as err:
+        raise ExecError(f"Error synchronizing the named volume {from_name} -> {target_name}: {err}") from err
+
+
+def _sync_builder(from_name: str, target_name: str) -> ContainerBuilder:
+    # The helper container only keeps running, the work is done via exec
+    builder = ContainerBuilder(PATH_UTILS_IMAGE, 'sleep infinity')
+    builder.set_named_volume_mount(from_name, volume_sync.SYNC_FROM, 'rw')
+    builder.set_named_volume_mount(target_name, volume_sync.SYNC_TO, 'rw')
+    return builder
+
+
+def snapshot(client: DockerClient, name: str, path: str) -> SnapshotResult:
+    """Writes the content of the named volume into a compressed snapshot file. See volume_archive."""
+    if not exists(client, name):
+        raise FileExistsError(f"The named volume {name} does not exist.")
 
+    builder = ContainerBuilder(PATH_UTILS_IMAGE, None)
+    builder.set_named_volume_mount(name, volume_archive.ARCHIVE_MOUNT, 'ro')
+    return volume_archive.snapshot(client, builder, path)
+
+
+def restore(client: DockerClient, name: str, path: str) -> None:
+    """Creates the named volume from a snapshot file. See volume_archive."""
+    if exists(client, name):
+        raise FileExistsError(f"The named volume {name} already exists.")
+
+    builder = ContainerBuilder(PATH_UTILS_IMAGE, None)
+    builder.set_named_volume_mount(name, volume_archive.ARCHIVE_MOUNT, 'rw')
     try:
-        container = client.containers.create(**builder.build_docker_api())
-        container.start()
-        container.remove(force=True)
-    except ContainerError as err:
-        raise ExecError(f"Error copying the named volume {from_name} -> {target_name}: {err.stderr}") from err
+        volume_archive.restore(client, builder, path)
+    except ExecError:
+        delete(client, name)
+        raise
 
 
 def create(client: DockerClient, name: str) -> None:
@@ -65,3 +186,12 @@ def create(client: DockerClient, name: str) -> None:
         raise FileExistsError(f"The named volume {name} already exists.")
 
     client.volumes.create(NAMED_VOLUME_INTERNAL_PREFIX + name, labels={RIPTIDE_DOCKER_LABEL_IS_RIPTIDE: "1"})
+
+
+def _parse_time(timestamp: Union[str, None]) -> Union[int, None]:
+    if not timestamp:
+        return None
+    try:
+        return int(datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp())
+    except ValueError:
+        return None
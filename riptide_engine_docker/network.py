@@ -1,18 +1,189 @@
-from typing import List, Union
+import json
+import os
+import re
+import threading
+from typing import List, Union, Callable, TypeVar, Set
 
+import docker
 from docker import DockerClient
-from docker.errors import NotFound
-from docker.models.containers import Container
+from docker.errors import NotFound, APIError
+from docker.models.containers import Container, _create_container_args
+from docker.utils import version_gte
 
-from riptide_engine_docker.container_builder import get_network_name, RIPTIDE_DOCKER_LABEL_IS_RIPTIDE
+from riptide.config.files import riptide_config_dir
+from riptide_engine_docker.container_builder import get_network_name, RIPTIDE_DOCKER_LABEL_IS_RIPTIDE, \
+    ContainerBuilder
+from riptide_engine_docker.link_groups import get_group_network_name, LinkGraph, RIPTIDE_DOCKER_LABEL_LINK_GROUP, \
+    LINK_GROUP_NETWORK_PREFIX, migrate
+
+NETWORK_REGISTRY_FILE = 'docker_networks.json'
+# First API version that attaches containers to more than one network on create.
+MULTIPLE_NETWORKS_API_VERSION = '1.44'
+# First version of the Docker client (docker-py) that accepts networking_config in containers.create.
+CLIENT_NETWORKING_CONFIG_VERSION = (7, 1)
+
+T = TypeVar('T')
+
+
+class NetworkRegistry:
+    """
+    Remembers which project networks exist, in memory and in a file in the Riptide configuration directory,
+    so that network.start doesn't need to look up the network on every command.
+
+    Singleton (via class methods). Thread-safe.
+
+    Networks are forgotten when Docker reports that they were removed (see watch) or when using
+    them failed because they don't exist (see with_project_network).
+    """
+
+    _lock = threading.Lock()
+    _networks: Set[str] = None
+    _watching = False
+
+    @classmethod
+    def exists(cls, network_name: str) -> bool:
+        with cls._lock:
+            cls._load()
+            return network_name in cls._networks
+
+    @classmethod
+    def add(cls, network_name: str) -> None:
+        with cls._lock:
+            cls._load()
+            if network_name not in cls._networks:
+                cls._networks.add(network_name)
+                cls._write()
+
+    @classmethod
+    def invalidate(cls, network_name: str) -> None:
+        with cls._lock:
+            cls._load()
+            if network_name in cls._networks:
+                cls._networks.remove(network_name)
+                cls._write()
+
+    @classmethod
+    def watch(cls, client: DockerClient) -> None:
+        """
+        Forget networks as soon as they are removed, for as long as this process runs.
+        Starts a daemon thread listening to Docker network events, once per process.
+        """
+        with cls._lock:
+            if cls._watching:
+                return
+            cls._watching = True
+        threading.Thread(target=cls._watch, args=(client,), daemon=True).start()
+
+    @classmethod
+    def _watch(cls, client: DockerClient):
+        try:
+            for event in client.events(decode=True, filters={'type': 'network', 'event': 'destroy'}):
+                name = event.get('Actor', {}).get('Attributes', {}).get('name', '')
+                if name.startswith('riptide__'):
+                    cls.invalidate(name)
+        except Exception:
+            # Any error of the stream (API, connection, decoding) ends the watch, the next call to watch restarts it.
+            # Missed removals are still noticed when using the network (see with_project_network).
+            pass
+        finally:
+            with cls._lock:
+                cls._watching = False
+
+    @classmethod
+    def _load(cls):
+        if cls._networks is not None:
+            return
+        cls._networks = set()
+        try:
+            with open(_registry_file(), mode='r') as file:
+                cls._networks = set(json.load(file))
+        except (OSError, ValueError, TypeError):
+            # No or broken file, all networks are looked up again.
+            pass
+
+    @classmethod
+    def _write(cls):
+        path = _registry_file()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}'
+            with open(tmp_path, mode='w') as file:
+                json.dump(sorted(cls._networks), file)
+            os.replace(tmp_path, path)
+        except OSError:
+            # The registry still works in memory.
+            pass
 
 
 def start(client: DockerClient, project_name: str):
+    """Creates the project network, if it doesn't exist. Networks known to exist are not looked up."""
     net_name = get_network_name(project_name)
+    if NetworkRegistry.exists(net_name):
+        return
     try:
         client.networks.get(net_name)
     except NotFound:
         client.networks.create(net_name, driver="bridge", attachable=True, labels={RIPTIDE_DOCKER_LABEL_IS_RIPTIDE: "1"})
+    NetworkRegistry.add(net_name)
+
+
+def start_link_group(client: DockerClient, project: 'Project'):
+    """
+    Records the links of the project and creates the link group network of the project, if needed.
+    Migrates the containers of the group if the group changed. See link_groups.
+    """
+    graph_changed = LinkGraph.update(project["name"], project["links"])
+    net_name = get_group_network_name(project["name"])
+    if net_name is None or (NetworkRegistry.exists(net_name) and not graph_changed):
+        return
+    try:
+        client.networks.get(net_name)
+    except NotFound:
+        client.networks.create(net_name, driver="bridge", attachable=True, labels={
+            RIPTIDE_DOCKER_LABEL_IS_RIPTIDE: "1",
+            RIPTIDE_DOCKER_LABEL_LINK_GROUP: net_name[len(LINK_GROUP_NETWORK_PREFIX):]
+        })
+        graph_changed = True
+    NetworkRegistry.add(net_name)
+    if graph_changed:
+        migrate_link_group(client, project["name"])
+
+
+def migrate_link_group(client: DockerClient, project_name: str):
+    """Migrates the containers of the link group of the project, see link_groups.migrate."""
+    for removed_network in migrate(client, project_name):
+        NetworkRegistry.invalidate(removed_network)
+
+
+def with_project_network(client: DockerClient, project_name: str, func: Callable[[], T]) -> T:
+    """
+    Calls func, which uses the project network (eg. creates a container in it).
+    If func fails because the network doesn't exist (anymore), the network is created and func is called again.
+    """
+    try:
+        return func()
+    except NotFound as err:
+        if not is_missing_network_error(err, project_name):
+            raise
+        NetworkRegistry.invalidate(get_network_name(project_name))
+        start(client, project_name)
+        return func()
+
+
+def check_exists(client: DockerClient, project_name: str) -> bool:
+    """Looks up the project network, even if it is known to exist. Forgets it if it doesn't exist anymore."""
+    net_name = get_network_name(project_name)
+    try:
+        client.networks.get(net_name)
+        return True
+    except NotFound:
+        NetworkRegistry.invalidate(net_name)
+        return False
+
+
+def is_missing_network_error(err: APIError, project_name: str) -> bool:
+    """Whether the error was caused by the project network not existing."""
+    return get_network_name(project_name) in str(err) and 'not found' in str(err)
 
 
 def collect_names_for_links(client: DockerClient, links: List[str]) -> List[str]:
@@ -23,10 +194,79 @@ def collect_names_for_links(client: DockerClient, links: List[str]) -> List[str]
     return []
 
 
-def add_network_links(client: DockerClient, container: Container, name: Union[str, None], links: List[str]):
-    """Adds a project to all container networks specified in the links. Links is a list of Riptide projects."""
-    for network_name in collect_names_for_links(client, links):
-        if name is not None:
-            client.networks.get(network_name).connect(container, aliases=[name])
-        else:
-            client.networks.get(network_name).connect(container)
+def link_network_names(client: DockerClient, project: 'Project', link_groups=False) -> List[str]:
+    """
+    Networks containers of the project join for the links of the project.
+    With link groups, this is only the network of the link group (see link_groups).
+    """
+    if link_groups:
+        group_network = get_group_network_name(project["name"])
+        return [group_network] if group_network is not None else []
+    return collect_names_for_links(client, project["links"])
+
+
+def add_network_links(client: DockerClient, container: Container, name: Union[str, None], networks: List[str]):
+    """
+    Adds a running container to the given link networks (see link_network_names).
+    Prefer add_link_networks, which attaches the networks on create.
+    """
+    for network_name in networks:
+        client.api.connect_container_to_network(container.id, network_name, aliases=[name] if name else None)
+
+
+def add_link_networks(client: DockerClient, builder: ContainerBuilder, name: Union[str, None], project: 'Project',
+                      link_groups=False):
+    """
+    Adds the link networks of the project to the builder. If name is given, it's used as alias in the networks.
+    Link group networks never get aliases, they would be ambiguous.
+    """
+    for network_name in link_network_names(client, project, link_groups):
+        builder.add_network(network_name, [name] if name and not link_groups else None)
+
+
+def supports_multiple_networks(client: DockerClient) -> bool:
+    """Whether the Docker daemon can attach a container to more than one network on create."""
+    return version_gte(client.api.api_version, MULTIPLE_NETWORKS_API_VERSION)
+
+
+def create_container(client: DockerClient, config: dict) -> Container:
+    """
+    Creates a container from ContainerBuilder.build_docker_api arguments, attached to all of it's networks.
+    Daemons that can't attach multiple networks on create get the additional networks connected after create
+    (but still before the container is started).
+    """
+    endpoints = config.get('networking_config', {})
+    if len(endpoints) <= 1 or supports_multiple_networks(client):
+        return _create(client, config)
+    config = config.copy()
+    config['networking_config'] = {config['network']: endpoints[config['network']]}
+    container = _create(client, config)
+    for network_name, endpoint in endpoints.items():
+        if network_name != config['network']:
+            client.api.connect_container_to_network(container.id, network_name, aliases=endpoint.get('Aliases'))
+    return container
+
+
+def _create(client: DockerClient, config: dict) -> Container:
+    if 'networking_config' not in config or _client_supports_networking_config():
+        return client.containers.create(**config)
+    # Older clients don't accept networking_config: Convert the arguments like containers.create does,
+    # then add the endpoints.
+    kwargs = config.copy()
+    endpoints = kwargs.pop('networking_config')
+    kwargs.setdefault('command', None)
+    kwargs['version'] = client.api._version
+    create_kwargs = _create_container_args(kwargs)
+    create_kwargs['networking_config'] = client.api.create_networking_config({
+        network_name: client.api.create_endpoint_config(aliases=endpoint.get('Aliases'))
+        for network_name, endpoint in endpoints.items()
+    })
+    return client.containers.get(client.api.create_container(**create_kwargs)['Id'])
+
+
+def _client_supports_networking_config() -> bool:
+    return tuple(int(part) for part in re.findall(r'[0-9]+', docker.__version__)[:2]) >= CLIENT_NETWORKING_CONFIG_VERSION
+
+
+def _registry_file() -> str:
+    return os.path.join(riptide_config_dir(), NETWORK_REGISTRY_FILE)
@@ -1,18 +1,38 @@
+import functools
 import os
+import shlex
 import shutil
+from typing import List, NamedTuple, Union, Tuple, Dict
 
 from riptide.config.document.command import Command
 from riptide.config.files import path_in_project
 from riptide.engine.abstract import ExecError
+from riptide_engine_docker import host_copy, helper
+from riptide_engine_docker.cmd_detached import STDOUT
+from riptide_engine_docker.helper import HelperService
+from riptide_engine_docker.util import stream_lines
 
 IMAGE = 'alpine'
+BATCH_MOUNT_PREFIX = '/cmd_target_'
+# Maximum size of one batch script in bytes. The script is passed as one argument, which Linux limits to 128 KiB.
+# Larger batches are split into multiple scripts.
+BATCH_SCRIPT_MAX_SIZE = 64 * 1024
+# Shell functions for batch operations. run prints "<index> <exit code> <output>" for each operation.
+BATCH_SCRIPT_HEADER = """run() {
+  i=$1; shift; out=$("$@" 2>&1); code=$?
+  printf '%s %s %s\\n' "$i" "$code" "$(printf %s "$out" | tr '\\n' ' ')"
+}
+rm_path() { rm -rf -- "$1"; }
+cp_path() { if [ -d "$1" ]; then mkdir -p "$2" && cp -a "$1/." "$2/"; else cp -a "$1" "$2"; fi; }
+"""
 # TODO: Since permissions are always mapped to user->root under Windows, there won't be permission
 #       problems under windows. We could probably just use the AbstractEngine implementation there.
 
 
 def rm(engine, path, project: 'Project'):
     """
-    Removes path from the hosts file system using a Docker container running root.
+    Removes path from the hosts file system using a Docker container running root
+    (or the helper container of the project, see helper).
     See AbstractEngine.path_rm for general usage.
     """
     # TODO: Safety checks, this function is potentially really dangerous right now
@@ -20,26 +40,32 @@ def rm(engine, path, project: 'Project'):
         raise PermissionError(f"Tried to delete a file/directory that is not within the project: {path}")
     if not os.path.exists(path):
         return
-    name_of_file = os.path.basename(path)
-    file_dir = os.path.abspath(os.path.join(path, '..'))
-    command = Command({
-        'image': IMAGE,
-        'command': f'rm -rf /cmd_target/{name_of_file}',
-        'additional_volumes': {'target': {
-            'host': file_dir,
-            'container': '/cmd_target',
-            'mode': 'rw'
-        }}
-    })
-    command.validate()
-    (exit_code, output) = engine.cmd_detached(project, command, run_as_root=True)
+    helpers = _helpers_for(engine, project, [path])
+    if helpers is not None:
+        output = helpers.exec(project, 'rm -rf -- ' + shlex.quote(helper.container_path(path)))
+    else:
+        name_of_file = os.path.basename(path)
+        file_dir = os.path.abspath(os.path.join(path, '..'))
+        command = Command({
+            'image': IMAGE,
+            'command': f'rm -rf /cmd_target/{name_of_file}',
+            'additional_volumes': {'target': {
+                'host': file_dir,
+                'container': '/cmd_target',
+                'mode': 'rw'
+            }}
+        })
+        command.validate()
+        output = engine.cmd_detached_stream(project, command, run_as_root=True)
+    exit_code = output.wait()
     if exit_code != 0:
-        raise ExecError(f"Error removing the path ({str(exit_code)}) {path}: {output}")
+        raise ExecError(f"Error removing the path ({str(exit_code)}) {path}: {output.tail()}")
 
 
 def copy(engine, fromm, to, project: 'Project'):
     """
     Copy files from the hosts file system using a Docker container running root.
+    On Linux, files of directories owned by the current user are copied directly on the host instead (see host_copy).
     See AbstractEngine.path_copy for general usage.
     """
     if not path_in_project(to, project):
@@ -48,20 +74,184 @@ def copy(engine, fromm, to, project: 'Project'):
         raise OSError(f"Tried to copy a directory/file that does not exist: {fromm}")
     if not os.path.exists(os.path.dirname(to)):
         raise OSError(f"Tried to copy into a path that does not exist: {to}")
-    command = Command({
-        'image': IMAGE,
-        'command': 'cp -a /copy_from/. /copy_to/',
-        'additional_volumes': {'fromm': {
-            'host': fromm,
-            'container': '/copy_from',
-            'mode': 'ro'
-        }, 'to': {
-            'host': to,
-            'container': '/copy_to',
-            'mode': 'rw'
-        }}
-    })
-    command.validate()
-    (exit_code, output) = engine.cmd_detached(project, command, run_as_root=True)
+    if host_copy.supported() and os.path.isdir(fromm):
+        # Copy everything the user owns on the host, only the rest with a container
+        remaining = host_copy.copy_tree(fromm, to)
+        failed = [r for r in copy_many(engine, remaining, project) if not r.success]
+        if len(failed) > 0:
+            raise ExecError(f"Error copying the directory {fromm} -> {to}: " +
+                            ", ".join(f"{r.path}: {r.error}" for r in failed))
+        return
+    helpers = _helpers_for(engine, project, [fromm, to])
+    if helpers is not None:
+        from_in_helper = shlex.quote(helper.container_path(fromm))
+        to_in_helper = shlex.quote(helper.container_path(to))
+        output = helpers.exec(project, f'mkdir -p {to_in_helper} && cp -a {from_in_helper}/. {to_in_helper}/')
+    else:
+        command = Command({
+            'image': IMAGE,
+            'command': 'cp -a /copy_from/. /copy_to/',
+            'additional_volumes': {'fromm': {
+                'host': fromm,
+                'container': '/copy_from',
+                'mode': 'ro'
+            }, 'to': {
+                'host': to,
+                'container': '/copy_to',
+                'mode': 'rw'
+            }}
+        })
+        command.validate()
+        output = engine.cmd_detached_stream(project, command, run_as_root=True)
+    exit_code = output.wait()
     if exit_code != 0:
-        raise ExecError(f"Error copying the directory ({str(exit_code)}) {fromm} -> {to}: {output}")
+        raise ExecError(f"Error copying the directory ({str(exit_code)}) {fromm} -> {to}: {output.tail()}")
+
+
+class PathResult(NamedTuple):
+    # For copy operations, the target path
+    path: str
+    success: bool
+    # Error message, if not successful
+    error: Union[str, None] = None
+
+
+def rm_many(engine, paths: List[str], project: 'Project') -> List[PathResult]:
+    """
+    Removes all paths from the hosts file system using one Docker container running root
+    (more for very large batches). The common parent directory of the paths is mounted once.
+    Returns one result per path, in the same order.
+    """
+    results: Dict[int, PathResult] = {}
+    operations: Dict[int, Tuple[str, List[str]]] = {}
+    for i, path in enumerate(paths):
+        if not path_in_project(path, project):
+            results[i] = PathResult(
+                path, False, f"Tried to delete a file/directory that is not within the project: {path}"
+            )
+        elif not os.path.exists(path):
+            results[i] = PathResult(path, True)
+        else:
+            operations[i] = ('rm_path', [path])
+    return _run_batch(engine, project, paths, operations, results, rw_paths=[p for _, [p] in operations.values()])
+
+
+def copy_many(engine, copies: List[Tuple[str, str]], project: 'Project') -> List[PathResult]:
+    """
+    Copies all (from, to) pairs on the hosts file system using one Docker container running root
+    (more for very large batches). The common parent directories of the sources and of the targets are mounted
+    once. Returns one result per pair, in the same order.
+    """
+    results: Dict[int, PathResult] = {}
+    operations: Dict[int, Tuple[str, List[str]]] = {}
+    for i, (fromm, to) in enumerate(copies):
+        if not path_in_project(to, project):
+            results[i] = PathResult(
+                to, False, f"Tried to copy into a path that is not within the project: {fromm} -> {to}"
+            )
+        elif not os.path.exists(fromm):
+            results[i] = PathResult(to, False, f"Tried to copy a directory/file that does not exist: {fromm}")
+        elif not os.path.exists(os.path.dirname(to)):
+            results[i] = PathResult(to, False, f"Tried to copy into a path that does not exist: {to}")
+        else:
+            operations[i] = ('cp_path', [fromm, to])
+    return _run_batch(engine, project, [to for _, to in copies], operations, results,
+                      rw_paths=[to for _, [_, to] in operations.values()],
+                      ro_paths=[fromm for _, [fromm, _] in operations.values()])
+
+
+def _run_batch(engine, project: 'Project', paths: List[str], operations: Dict[int, Tuple[str, List[str]]],
+               results: Dict[int, PathResult], rw_paths: List[str], ro_paths: List[str] = None) -> List[PathResult]:
+    """
+    Runs all operations (index -> shell function and host paths) in one container and collects the results.
+    If the script would be larger than BATCH_SCRIPT_MAX_SIZE, it is split and each part is run in it's own container.
+    """
+    if len(operations) > 0:
+        ro_paths = ro_paths if ro_paths is not None else []
+        helpers = _helpers_for(engine, project, rw_paths + ro_paths)
+        mounts = []
+        if helpers is not None:
+            to_container = helper.container_path
+        else:
+            mounts = _batch_mounts(rw_paths, ro_paths)
+            to_container = functools.partial(_path_in_batch_mount, mounts)
+        script_lines = {}
+        for i, (function, host_paths) in operations.items():
+            container_paths = [to_container(p) for p in host_paths]
+            script_lines[i] = ' '.join(['run', str(i), function] + [shlex.quote(p) for p in container_paths]) + '\n'
+        for part in _split_batch(script_lines):
+            script = BATCH_SCRIPT_HEADER + ''.join(script_lines[i] for i in part)
+            if helpers is not None:
+                output = helpers.exec(project, script)
+            else:
+                command = Command({
+                    'image': IMAGE,
+                    'command': 'sh -c ' + shlex.quote(script),
+                    'additional_volumes': {f'target{n}': {
+                        'host': host_dir,
+                        'container': BATCH_MOUNT_PREFIX + str(n),
+                        'mode': mode
+                    } for n, (host_dir, mode) in enumerate(mounts)}
+                })
+                command.validate()
+                output = engine.cmd_detached_stream(project, command, run_as_root=True)
+            for line in stream_lines(data for stream, data in output if stream == STDOUT):
+                i, _, rest = line.partition(' ')
+                code, _, message = rest.partition(' ')
+                if i.isdigit() and int(i) in part and code.isdigit():
+                    results[int(i)] = PathResult(paths[int(i)], code == '0', message.strip() if code != '0' else None)
+            for i in part:
+                if i not in results:
+                    results[i] = PathResult(
+                        paths[i], False, f"Batch operation failed ({str(output.exit_code)}): {output.tail()}"
+                    )
+    return [results[i] for i in range(len(paths))]
+
+
+def _split_batch(script_lines: Dict[int, str]) -> List[List[int]]:
+    """Splits the operations into parts whose scripts are not larger than BATCH_SCRIPT_MAX_SIZE."""
+    parts = []
+    size = 0
+    for i, line in script_lines.items():
+        line_size = len(line.encode('utf-8'))
+        if len(parts) == 0 or size + line_size > BATCH_SCRIPT_MAX_SIZE - len(BATCH_SCRIPT_HEADER):
+            parts.append([])
+            size = 0
+        parts[-1].append(i)
+        size += line_size
+    return parts
+
+
+def _helpers_for(engine, project: 'Project', paths: List[str]) -> Union[HelperService, None]:
+    """The helper containers of the engine, if they are used and can access all paths."""
+    if engine.helpers is not None and engine.helpers.can_run(project, paths):
+        return engine.helpers
+    return None
+
+
+def _batch_mounts(rw_paths: List[str], ro_paths: List[str]) -> List[Tuple[str, str]]:
+    """
+    Directories to mount (host directory, mode) so that all paths are reachable: The deepest common parent
+    directory of the rw paths (writable) and the one of the ro paths (read only),
+    unless it is inside of the writable one.
+    """
+    mounts = []
+    for paths, mode in [(rw_paths, 'rw'), (ro_paths, 'ro')]:
+        if len(paths) == 0:
+            continue
+        directory = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+        if not any(_is_in(directory, mount) for mount, _ in mounts):
+            mounts.append((directory, mode))
+    return mounts
+
+
+def _path_in_batch_mount(mounts: List[Tuple[str, str]], path: str) -> str:
+    path = os.path.abspath(path)
+    for n, (directory, _) in enumerate(mounts):
+        if _is_in(path, directory):
+            return BATCH_MOUNT_PREFIX + str(n) + '/' + os.path.relpath(path, directory).replace(os.sep, '/')
+    raise ValueError(f"{path} is not in a mounted directory.")
+
+
+def _is_in(path: str, directory: str) -> bool:
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
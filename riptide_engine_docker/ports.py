@@ -0,0 +1,165 @@
+"""
+Allocation of host ports for the main port of services.
+
+Ports used by existing containers are known from their riptide_port labels. The labels are listed at most
+every CONTAINER_PORTS_TTL seconds per process. Ports that were handed out but whose container doesn't exist yet
+are leased in a state file in the Riptide configuration directory for a short time. Since a lease lasts longer
+than the container ports are cached, containers created by other processes in the meantime are covered by their
+lease. The state file is protected by a file lock, so multiple Riptide processes can allocate ports at the same time.
+
+Services get their previous port again, if it's still free (and it was used within SERVICE_PORT_TTL).
+Otherwise ports are handed out round-robin, starting at DOCKER_ENGINE_HTTP_PORT_BND_START, instead of always
+scanning from the start. Only the candidate ports are checked for other programs using them, by binding them.
+"""
+import json
+import os
+import socket
+import threading
+from time import time
+from typing import Set
+
+from docker import DockerClient
+
+from riptide.config.files import riptide_config_dir
+from riptide.config.service.ports import PortsConfig
+from riptide_engine_docker.container_builder import RIPTIDE_DOCKER_LABEL_HTTP_PORT, DOCKER_ENGINE_HTTP_PORT_BND_START
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+PORTS_STATE_FILE = 'docker_ports.json'
+PORTS_LOCK_FILE = 'docker_ports.lock'
+# Time a port stays reserved after it was handed out, without a container with the label existing, in seconds.
+PORT_LEASE_TIME = 120
+# Time the ports of containers are cached, in seconds. Must be shorter than PORT_LEASE_TIME.
+CONTAINER_PORTS_TTL = 30
+# Time the previous port of a service is remembered after it was last allocated, in seconds.
+SERVICE_PORT_TTL = 30 * 24 * 60 * 60
+MAX_PORT = 65535
+
+_thread_lock = threading.Lock()
+# (time of the listing, ports of containers)
+_container_ports_cache = (0.0, set())
+
+
+class _FileLock:
+    """Exclusive lock on a file, across processes."""
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'a+')
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.file.close()
+
+
+class PortAllocator:
+    """Allocates host ports for the main ports of services. Thread- and process-safe."""
+
+    def __init__(self, client: DockerClient, start_port: int = DOCKER_ENGINE_HTTP_PORT_BND_START):
+        self.client = client
+        self.start_port = start_port
+
+    def allocate(self, project_name: str, service_name: str) -> int:
+        """Returns a free port for the service and reserves it."""
+        key = project_name + '/' + service_name
+        with _thread_lock, _FileLock(_config_file(PORTS_LOCK_FILE)):
+            state = self._load_state()
+            now = time()
+            state["leases"] = {port: lease for port, lease in state["leases"].items() if lease[1] > now}
+            state["services"] = {service: entry for service, entry in state["services"].items()
+                                 if isinstance(entry, list) and entry[1] > now - SERVICE_PORT_TTL}
+            reserved = self._ports_of_containers(now)
+            reserved.update(int(port) for port, lease in state["leases"].items() if lease[0] != key)
+            if PortsConfig.get() is not None:
+                # Ports of additional_ports
+                reserved.update(int(port) for port in PortsConfig.get()["ports"].keys())
+
+            previous = state["services"].get(key, [None])[0]
+            if previous is not None and previous not in reserved and _is_free(previous):
+                port = previous
+            else:
+                port = self._next_free_port(state["next"], reserved)
+                state["next"] = port + 1
+
+            state["services"][key] = [port, now]
+            state["leases"][str(port)] = [key, now + PORT_LEASE_TIME]
+            self._write_state(state)
+            return port
+
+    def _next_free_port(self, cursor: int, reserved: Set[int]) -> int:
+        if cursor < self.start_port or cursor > MAX_PORT:
+            cursor = self.start_port
+        for _ in range(MAX_PORT - self.start_port + 1):
+            if cursor not in reserved and _is_free(cursor):
+                return cursor
+            cursor = cursor + 1 if cursor < MAX_PORT else self.start_port
+        raise OSError(f"No free port found for the service (ports {self.start_port} - {MAX_PORT}).")
+
+    def _ports_of_containers(self, now: float) -> Set[int]:
+        """Ports of all containers with the port label, cached for CONTAINER_PORTS_TTL. Needs the thread lock."""
+        global _container_ports_cache
+        listed_at, ports = _container_ports_cache
+        if listed_at > now - CONTAINER_PORTS_TTL:
+            return set(ports)
+        ports = set()
+        for container in self.client.api.containers(all=True, filters={'label': RIPTIDE_DOCKER_LABEL_HTTP_PORT}):
+            try:
+                ports.add(int(container['Labels'][RIPTIDE_DOCKER_LABEL_HTTP_PORT]))
+            except (KeyError, ValueError, TypeError):
+                pass
+        _container_ports_cache = (now, ports)
+        return set(ports)
+
+    def _load_state(self) -> dict:
+        state = {"services": {}, "leases": {}, "next": self.start_port}
+        try:
+            with open(_config_file(PORTS_STATE_FILE), mode='r') as file:
+                state.update(json.load(file))
+        except (OSError, ValueError):
+            pass
+        return state
+
+    @staticmethod
+    def _write_state(state: dict):
+        path = _config_file(PORTS_STATE_FILE)
+        with open(path + '.tmp', mode='w') as file:
+            json.dump(state, file)
+        os.replace(path + '.tmp', path)
+
+
+def _is_free(port: int) -> bool:
+    """Whether no other program listens on the TCP port, checked by binding it."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        if os.name == 'posix':
+            # Connections of a previous container of the service in TIME_WAIT don't block the port,
+            # listening sockets still do. (On Windows, this option would allow binding a port in use.)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', port))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def _config_file(name: str) -> str:
+    return os.path.join(riptide_config_dir(), name)
@@ -0,0 +1,305 @@
+"""
+Readiness checks for service containers.
+
+After a service container was started, the start process waits until the service is ready or
+until it crashed. What "ready" means is decided by a list of probes, which all run in parallel:
+
+- EventsProbe:      Watches the Docker events stream of the container and reports a crash on 'die'.
+                    Always used.
+- HealthcheckProbe: Like EventsProbe, but the service is only ready after Docker reported the
+                    container as healthy. Used instead of EventsProbe if the image defines a HEALTHCHECK.
+- TcpProbe:         The service is ready when the main port accepts connections.
+                    Used if enabled for the service and the service has a port (see ReadinessSettings).
+- LogProbe:         The service is ready when a line of the service's stdout/stderr matches a pattern.
+                    Used if a pattern is configured for the service (see ReadinessSettings).
+
+The service is ready once all required probes succeeded or timed out. If there are no required probes
+(the default, unless the image has a HEALTHCHECK), it is ready after the grace period, if it didn't crash within it.
+TcpProbe and LogProbe are opt-in, since a service that opens it's port late (or never prints the pattern)
+would otherwise delay the start up to the probe timeout.
+"""
+import queue
+import socket
+import threading
+from abc import ABC, abstractmethod
+from time import sleep, monotonic
+from typing import List, NamedTuple, Dict, Union, Callable
+
+from docker import DockerClient
+from docker.errors import APIError
+from docker.models.containers import Container
+
+from riptide.config.document.service import Service
+
+READY = 'ready'
+CRASHED = 'crashed'
+TIMEOUT = 'timeout'
+
+# Default time a single probe may take, in seconds.
+DEFAULT_PROBE_TIMEOUT = 60
+# Time to watch for crashes, if no probe decides when the service is ready, in seconds.
+DEFAULT_GRACE_PERIOD = 1.0
+# Interval for probes that need to retry, in seconds.
+PROBE_RETRY_INTERVAL = 0.1
+LOG_PROBE_RETRY_INTERVAL = 0.5
+
+# Files the riptide entrypoint redirects the stdout / stderr of services to.
+SERVICE_STDOUT = '/riptide_stdout'
+SERVICE_STDERR = '/riptide_stderr'
+# Start of the line the riptide entrypoint writes to the log files on each (re)start.
+SERVICE_RESTART_MARKER = 'SERVICE RESTART - '
+EENV_READINESS_PATTERN = 'RIPTIDE__DOCKER_READINESS_PATTERN'
+
+
+class ReadinessSettings(NamedTuple):
+    timeout: float = DEFAULT_PROBE_TIMEOUT
+    grace_period: float = DEFAULT_GRACE_PERIOD
+    # Service name -> extended regular expression (grep -E / awk syntax) for LogProbe
+    log_patterns: Dict[str, str] = {}
+    # Names of the services whose main port is checked with TcpProbe
+    tcp_services: List[str] = []
+
+
+class ReadinessResult(NamedTuple):
+    state: str  # READY or CRASHED. Probes that timed out don't prevent READY.
+    # Human readable messages, eg. for probes that timed out.
+    messages: List[str]
+
+
+Report = Callable[[str, str], None]
+
+
+class ReadinessProbe(ABC):
+    """
+    Base class for readiness probes.
+
+    prepare is called after the container was created but before it is started. run is called in it's own thread
+    after the container was started and must call report exactly once (or return without calling it, if stop is set).
+    """
+    #: If True, the service is not ready until this probe reported READY (or TIMEOUT).
+    required = True
+
+    def __init__(self, timeout: float = DEFAULT_PROBE_TIMEOUT):
+        self.timeout = timeout
+
+    def prepare(self, client: DockerClient, container: Container) -> None:
+        pass
+
+    @abstractmethod
+    def run(self, client: DockerClient, container: Container, report: Report, stop: threading.Event) -> None:
+        pass
+
+    def close(self) -> None:
+        """Called when the readiness check is finished. Must make run return soon."""
+        pass
+
+    def __str__(self):
+        return self.__class__.__name__
+
+
+class EventsProbe(ReadinessProbe):
+    """Reports a crash if the container dies. Subscribes to the events of the container before it is started."""
+    required = False
+
+    def __init__(self, timeout: float = DEFAULT_PROBE_TIMEOUT):
+        super().__init__(timeout)
+        self.events = None
+
+    def prepare(self, client, container):
+        self.events = client.events(decode=True, filters={
+            'container': container.id,
+            'event': ['die', 'health_status']
+        })
+
+    def run(self, client, container, report, stop):
+        for event in self.events:
+            if stop.is_set():
+                return
+            action = event.get('Action', event.get('status', ''))
+            if action == 'die':
+                exit_code = event.get('Actor', {}).get('Attributes', {}).get('exitCode', '?')
+                report(CRASHED, f'Container exited with exit code {exit_code}.')
+                return
+            if action.startswith('health_status'):
+                self._health_status(action.split(':', 1)[-1].strip(), report)
+
+    def _health_status(self, health: str, report: Report):
+        pass
+
+    def close(self):
+        if self.events is not None:
+            self.events.close()
+
+
+class HealthcheckProbe(EventsProbe):
+    """Like EventsProbe, but the service is only ready after the HEALTHCHECK of the image reported it as healthy."""
+    required = True
+
+    def _health_status(self, health, report):
+        if health == 'healthy':
+            report(READY, 'Container is healthy.')
+
+
+class TcpProbe(ReadinessProbe):
+    """The service is ready when the given host port accepts TCP connections."""
+
+    def __init__(self, port: int, host='127.0.0.1', timeout: float = DEFAULT_PROBE_TIMEOUT):
+        super().__init__(timeout)
+        self.host = host
+        self.port = port
+
+    def run(self, client, container, report, stop):
+        while not stop.is_set():
+            if self._accepts_connection():
+                report(READY, f'Port {self.port} accepts connections.')
+                return
+            sleep(PROBE_RETRY_INTERVAL)
+
+    def _accepts_connection(self) -> bool:
+        try:
+            with socket.create_connection((self.host, self.port), timeout=1) as sock:
+                # The Docker userland proxy accepts connections on the host port even when nothing listens
+                # inside of the container yet, it then closes the connection immediately.
+                # A real server either keeps the connection open or sends something.
+                sock.settimeout(PROBE_RETRY_INTERVAL)
+                try:
+                    return sock.recv(1) != b''
+                except socket.timeout:
+                    return True
+        except OSError:
+            return False
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({self.port})'
+
+
+class LogProbe(ReadinessProbe):
+    """
+    The service is ready when a line in it's stdout or stderr (as redirected by the riptide entrypoint)
+    that was written since the last restart matches the given extended regular expression.
+    """
+
+    def __init__(self, pattern: str, timeout: float = DEFAULT_PROBE_TIMEOUT):
+        super().__init__(timeout)
+        self.pattern = pattern
+
+    def run(self, client, container, report, stop):
+        # Each file is checked separately, lines before the last restart marker are ignored.
+        script = 'FNR == 1 {m[FILENAME] = 0} ' \
+                 f'index($0, "{SERVICE_RESTART_MARKER}") == 1 {{m[FILENAME] = 0}} ' \
+                 f'$0 ~ ENVIRON["{EENV_READINESS_PATTERN}"] {{m[FILENAME] = 1}} ' \
+                 'END {for (f in m) if (m[f]) exit 0; exit 1}'
+        while not stop.is_set():
+            try:
+                exit_code, _ = container.exec_run(
+                    ['awk', script, SERVICE_STDOUT, SERVICE_STDERR],
+                    environment={EENV_READINESS_PATTERN: self.pattern},
+                    stdout=False, stderr=False
+                )
+                if exit_code == 0:
+                    report(READY, f'Log matched {self.pattern}.')
+                    return
+            except APIError:
+                # Most likely the container isn't running (anymore), the events probe will report that.
+                pass
+            stop.wait(LOG_PROBE_RETRY_INTERVAL)
+
+    def __str__(self):
+        return f'{self.__class__.__name__}({self.pattern})'
+
+
+def default_probes(service: Service, image_config: dict, main_port: Union[int, None],
+                   settings: ReadinessSettings) -> List[ReadinessProbe]:
+    """
+    Returns the probes to use for the service.
+
+    :param service:      Service to start
+    :param image_config: Config of the image (result of inspect_image)
+    :param main_port:    Host port the main port of the service is bound to, if any
+    :param settings:     Readiness settings of the engine
+    """
+    if image_has_healthcheck(image_config):
+        probes = [HealthcheckProbe(settings.timeout)]
+    else:
+        probes = [EventsProbe(settings.timeout)]
+    if main_port is not None and service["$name"] in settings.tcp_services:
+        probes.append(TcpProbe(main_port, timeout=settings.timeout))
+    if service["$name"] in settings.log_patterns:
+        probes.append(LogProbe(settings.log_patterns[service["$name"]], settings.timeout))
+    return probes
+
+
+def image_has_healthcheck(image_config: dict) -> bool:
+    healthcheck = image_config.get("Healthcheck")
+    return healthcheck is not None and healthcheck.get("Test", ["NONE"])[0] != "NONE"
+
+
+class ReadinessCheck:
+    """
+    Runs readiness probes for one container. Create it after the container was created
+    and before starting it, then call wait after starting it. If the container is not started, call close.
+    """
+    def __init__(self, client: DockerClient, container: Container, probes: List[ReadinessProbe],
+                 grace_period: float = DEFAULT_GRACE_PERIOD):
+        self.client = client
+        self.container = container
+        self.probes = probes
+        self.grace_period = grace_period
+        try:
+            for probe in self.probes:
+                probe.prepare(client, container)
+        except Exception:
+            self.close()
+            raise
+
+    def wait(self) -> ReadinessResult:
+        """Wait until the service is ready or crashed. Closes all probes."""
+        results = queue.Queue()
+        stop = threading.Event()
+        for probe in self.probes:
+            threading.Thread(
+                target=self._run_probe, args=(probe, results, stop), daemon=True
+            ).start()
+
+        pending = {probe for probe in self.probes if probe.required}
+        messages = []
+        started = monotonic()
+        deadlines = {probe: started + probe.timeout for probe in pending}
+        try:
+            while True:
+                if len(pending) > 0:
+                    wait_until = min(deadlines[probe] for probe in pending)
+                else:
+                    wait_until = started + self.grace_period
+                try:
+                    probe, state, message = results.get(timeout=max(0.0, wait_until - monotonic()))
+                except queue.Empty:
+                    if len(pending) == 0:
+                        return ReadinessResult(READY, messages)
+                    for probe in [p for p in pending if deadlines[p] <= monotonic()]:
+                        pending.remove(probe)
+                        messages.append(f'{probe}: Timed out after {probe.timeout}s.')
+                    continue
+                if state == CRASHED:
+                    return ReadinessResult(CRASHED, [message])
+                if state == TIMEOUT:
+                    messages.append(message)
+                if probe in pending:
+                    pending.remove(probe)
+                    if len(pending) == 0:
+                        return ReadinessResult(READY, messages)
+        finally:
+            stop.set()
+            self.close()
+
+    def close(self):
+        """Closes all probes."""
+        for probe in self.probes:
+            probe.close()
+
+    def _run_probe(self, probe: ReadinessProbe, results: queue.Queue, stop: threading.Event):
+        try:
+            probe.run(self.client, self.container, lambda state, message: results.put((probe, state, message)), stop)
+        except Exception as ex:
+            if not stop.is_set():
+                results.put((probe, TIMEOUT, f'{probe}: Failed: {ex}'))
@@ -0,0 +1,175 @@
+"""
+Dependency aware scheduler for starting the services of a project.
+
+Services are started with a limited number of parallel workers. A service is only started after
+all services it depends on were started successfully (and passed their readiness checks).
+If a dependency could not be started, the dependent services are skipped.
+"""
+import heapq
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import monotonic
+from typing import Callable, Dict, List, NamedTuple, Iterable, Set
+
+from riptide.config.document.project import Project
+
+# Default number of services that are started at the same time.
+DEFAULT_MAX_PARALLEL_STARTS = 8
+# Services with this role are started before all other services, if db_first is enabled (see service_dependencies).
+ROLE_STARTED_FIRST = 'db'
+
+
+class StartReport(NamedTuple):
+    # Chain of services (first to last) that took the longest time, following the dependencies.
+    critical_path: List[str]
+    # Sum of the start durations of the services on the critical path, in seconds.
+    # This is the minimum time the start could take, with an unlimited number of workers.
+    critical_path_time: float
+    # Wall time of the entire start, in seconds.
+    total_time: float
+    # Start duration of every service that was started, in seconds.
+    durations: Dict[str, float]
+
+
+class _Task(NamedTuple):
+    func: Callable[[], bool]
+    dependencies: Set[str]
+    on_skip: Callable[[str], None]
+
+
+class DependencyScheduler:
+    """
+    Runs tasks, ordered by their dependencies, with a limited number of workers.
+
+    Tasks return True on success. If a task fails, all tasks depending on it (directly or indirectly)
+    are skipped. Tasks that are part of circular dependencies are skipped too.
+    When multiple tasks are ready to run, the tasks with the longest chain of dependent tasks are run first.
+    """
+    def __init__(self, max_workers: int = DEFAULT_MAX_PARALLEL_STARTS):
+        self.max_workers = max_workers
+        self.tasks: Dict[str, _Task] = {}
+
+    def add(self, name: str, func: Callable[[], bool], dependencies: Iterable[str], on_skip: Callable[[str], None]):
+        """
+        :param name:            Unique name of the task
+        :param func:            Function to run
+        :param dependencies:    Names of tasks that must finish successfully before this task is run.
+                                Names of tasks that were not added are ignored.
+        :param on_skip:         Called with a reason if the task is skipped.
+        """
+        self.tasks[name] = _Task(func, set(dependencies), on_skip)
+
+    def run(self) -> StartReport:
+        """Runs all tasks and returns when all tasks are finished or skipped."""
+        dependencies = {name: task.dependencies & self.tasks.keys() for name, task in self.tasks.items()}
+        dependents = {name: set() for name in self.tasks.keys()}
+        for name, deps in dependencies.items():
+            for dep in deps:
+                dependents[dep].add(name)
+
+        in_cycle = self._find_cycles(dependencies, dependents)
+        for name in in_cycle:
+            self.tasks[name].on_skip(f"Circular dependency between services: {', '.join(sorted(in_cycle))}.")
+
+        priorities = {}
+        for name in self.tasks.keys():
+            if name not in in_cycle:
+                self._priority(name, dependents, priorities)
+
+        remaining = {name: len(deps) for name, deps in dependencies.items() if name not in in_cycle}
+        ready = [(-priorities[name], name) for name, count in remaining.items() if count == 0]
+        heapq.heapify(ready)
+
+        started_at = {}
+        durations = {}
+        start = monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            running = {}
+            while len(ready) > 0 or len(running) > 0:
+                while len(ready) > 0 and len(running) < self.max_workers:
+                    _, name = heapq.heappop(ready)
+                    started_at[name] = monotonic()
+                    running[executor.submit(self.tasks[name].func)] = name
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    durations[name] = monotonic() - started_at[name]
+                    if future.exception() is None and future.result():
+                        for dependent in dependents[name]:
+                            remaining[dependent] -= 1
+                            if remaining[dependent] == 0:
+                                heapq.heappush(ready, (-priorities[dependent], dependent))
+                    else:
+                        self._skip_dependents(name, name, dependents, set())
+
+        critical_path, critical_path_time = self._critical_path(dependencies, durations)
+        return StartReport(critical_path, critical_path_time, monotonic() - start, durations)
+
+    @staticmethod
+    def _find_cycles(dependencies: Dict[str, Set[str]], dependents: Dict[str, Set[str]]) -> Set[str]:
+        """Returns all tasks that are part of a cycle or depend on one (Kahn's algorithm)."""
+        remaining = {name: len(deps) for name, deps in dependencies.items()}
+        todo = [name for name, count in remaining.items() if count == 0]
+        while len(todo) > 0:
+            name = todo.pop()
+            del remaining[name]
+            for dependent in dependents[name]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    todo.append(dependent)
+        return set(remaining.keys())
+
+    def _priority(self, name: str, dependents: Dict[str, Set[str]], priorities: Dict[str, int]) -> int:
+        """Length of the longest chain of tasks depending on the task."""
+        if name not in priorities:
+            priorities[name] = 1 + max((self._priority(d, dependents, priorities) for d in dependents[name]), default=0)
+        return priorities[name]
+
+    def _skip_dependents(self, failed: str, name: str, dependents: Dict[str, Set[str]], skipped: Set[str]):
+        for dependent in dependents[name]:
+            if dependent not in skipped:
+                skipped.add(dependent)
+                self.tasks[dependent].on_skip(f"Not started, because service '{failed}' could not be started.")
+                self._skip_dependents(failed, dependent, dependents, skipped)
+
+    @staticmethod
+    def _critical_path(dependencies: Dict[str, Set[str]], durations: Dict[str, float]):
+        path_times = {}
+        previous = {}
+
+        def path_time(name):
+            if name not in path_times:
+                deps = [d for d in dependencies[name] if d in durations]
+                previous[name] = max(deps, key=path_time, default=None)
+                path_times[name] = durations[name] + (path_time(previous[name]) if previous[name] else 0.0)
+            return path_times[name]
+
+        last = max(durations.keys(), key=path_time, default=None)
+        path = []
+        while last is not None:
+            path.insert(0, last)
+            last = previous[last]
+        return path, path_times[path[-1]] if len(path) > 0 else 0.0
+
+
+def service_dependencies(project: Project, service_name: str, explicit: Dict[str, List[str]],
+                         db_first=False) -> List[str]:
+    """
+    Returns the names of the services the given service depends on.
+
+    If dependencies are explicitly configured for the service, these are used. Otherwise the service
+    doesn't depend on other services, unless db_first is set: Then it depends on the services with the 'db' role
+    (except for those services themselves).
+
+    :param project:         Project of the service
+    :param service_name:    Name of the service
+    :param explicit:        Explicitly configured dependencies (service name -> list of service names)
+    :param db_first:        Whether services without explicit dependencies depend on the 'db' services
+    """
+    if service_name in explicit:
+        return explicit[service_name]
+    if not db_first:
+        return []
+    services = project["app"]["services"]
+    if ROLE_STARTED_FIRST in services[service_name]["roles"]:
+        return []
+    return [name for name, service in services.items() if ROLE_STARTED_FIRST in service["roles"]]
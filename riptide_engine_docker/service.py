@@ -1,25 +1,53 @@
 import copy
+import functools
 import json
-from time import sleep
-import threading
+import re
+import shlex
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from typing import Dict, NamedTuple, List, Union
 
 from docker import DockerClient
 from docker.errors import NotFound, APIError, ContainerError
+from docker.models.containers import Container
 from json import JSONDecodeError
 
-from riptide.config.document.config import Config
 from riptide.config.document.service import Service
 
 from riptide_engine_docker.container_builder import get_network_name, get_service_container_name, \
-    ContainerBuilder, RIPTIDE_DOCKER_LABEL_IS_RIPTIDE, EENV_NO_STDOUT_REDIRECT, EENV_ORIGINAL_ENTRYPOINT
+    ContainerBuilder, RIPTIDE_DOCKER_LABEL_IS_RIPTIDE, EENV_NO_STDOUT_REDIRECT, EENV_ORIGINAL_ENTRYPOINT, \
+    RIPTIDE_DOCKER_LABEL_PROJECT, RIPTIDE_DOCKER_LABEL_SERVICE
 from riptide.engine.results import ResultQueue, ResultError, StartStopResultStep
 from riptide.lib.cross_platform.cpuser import getuid
-from riptide_engine_docker.network import add_network_links
+from riptide_engine_docker.image_cache import ImageConfigCache, normalize_image_name, with_image
+from riptide_engine_docker.network import add_link_networks, with_project_network, create_container
+from riptide_engine_docker.ports import PortAllocator
+from riptide_engine_docker.util import tar_single_file, stream_lines, socket_output
+from riptide_engine_docker.state import StateSnapshot, containers_with_label
+from riptide_engine_docker.readiness import ReadinessSettings, ReadinessCheck, default_probes, CRASHED
 
-start_lock = threading.Lock()
+PRE_START_SCRIPT_PATH = '/riptide_pre_start.sh'
+# Prefix of the lines the batched pre start script uses to mark the start and end of commands.
+PRE_START_MARKER = '__RIPTIDE_PRE_START__'
 
 
-def start(project_name: str, service: Service, client: DockerClient, queue: ResultQueue, quick=False):
+class PostStartFailedStep(StartStopResultStep):
+    """
+    Last step of a start, if post start commands failed. The service was still started.
+    Tells the failure apart from "Started!" by it's type, failed_commands are the commands that failed.
+    """
+    failed_commands: List[str] = []
+
+    def __new__(cls, current_step: int, steps: Union[int, None], text: str, failed_commands: List[str]):
+        step = super().__new__(cls, steps=steps, current_step=current_step, text=text)
+        step.failed_commands = failed_commands
+        return step
+
+
+def start(project_name: str, service: Service, client: DockerClient, queue: ResultQueue, quick=False,
+          readiness_settings: ReadinessSettings = None, batch_pre_start=False,
+          post_start_parallel_groups: List[List[str]] = None, link_groups=False):
     """
     Starts the given service by starting the container (if not already started).
 
@@ -28,12 +56,27 @@ def start(project_name: str, service: Service, client: DockerClient, queue: Resu
     If an error during start occurs, an ResultError is added to the queue, indicating the kind of error.
     On errors, tries to execute stop after updating the queue.
 
+    Post start commands that exit with a non-zero exit code don't fail the start: The service runs and is usable,
+    the commands only prepare it (eg. warm up caches). The last step is a PostStartFailedStep then, instead of a
+    plain StartStopResultStep, and it's text names the number of failed commands. Post start commands that can't
+    be run at all (Docker API errors) fail the start.
+
     :param client:          Docker Client
     :param project_name:    Name of the project to start
     :param service:         Service object defining the service
     :param queue:           ResultQueue to update, or None
     :param quick:           If True: pre_start and post_start commands are skipped.
+    :param readiness_settings: Settings for checking whether the service is ready after start.
+    :param batch_pre_start: If True: All pre_start commands are run in one container, instead of one per command.
+    :param post_start_parallel_groups: Groups of post_start commands that are independent of each other.
+                                       Consecutive commands of the same group are run concurrently.
+    :param link_groups:     If True: Join the link group network instead of the networks of all linked projects.
+    :return: True if the service was started or was already running.
     """
+    if readiness_settings is None:
+        readiness_settings = ReadinessSettings()
+    if post_start_parallel_groups is None:
+        post_start_parallel_groups = []
 
     name = get_service_container_name(project_name, service["$name"])
     needs_to_be_started = False
@@ -50,7 +93,7 @@ def start(project_name: str, service: Service, client: DockerClient, queue: Resu
     except APIError as err:
         queue.end_with_error(ResultError("ERROR checking container status.", cause=err))
         stop(project_name, service["$name"], client)
-        return
+        return False
 
     if needs_to_be_started:
 
@@ -64,30 +107,35 @@ def start(project_name: str, service: Service, client: DockerClient, queue: Resu
 
         # 2. Pulling image
         queue.put(StartStopResultStep(current_step=current_step, steps=step_count, text="Checking image... "))
-        # Check if image exists
+        # Check if image exists (and get it's config)
+        image_config = None
         try:
-            client.images.get(service["image"])
+            image_config = ImageConfigCache.get(client, service["image"])
         except NotFound:
             try:
                 queue.put(StartStopResultStep(current_step=current_step, steps=step_count, text="Pulling image... "))
-                image_name_full = service['image'] if ":" in service['image'] else service['image'] + ":latest"
+                image_name_full = normalize_image_name(service['image'])
+                last_status = ""
                 for line in client.api.pull(image_name_full, stream=True):
                     try:
                         status = json.loads(line)
+                        last_status = status["status"]
                         if "progress" in status:
                             queue.put(StartStopResultStep(current_step=current_step, steps=step_count, text="Pulling image... " + status["status"] + " : " + status["progress"]))
                         else:
                             queue.put(StartStopResultStep(current_step=current_step, steps=step_count, text="Pulling image... " + status["status"]))
                     except JSONDecodeError:
                         queue.put(StartStopResultStep(current_step=current_step, steps=step_count, text="Pulling image... " + str(line)))
+                ImageConfigCache.after_pull(service["image"], last_status)
             except APIError as err:
                 queue.end_with_error(ResultError("ERROR pulling image.", cause=err))
                 stop(project_name, service["$name"], client)
-                return
+                return False
 
         # 2.5. Prepare container
         try:
-            image_config = client.api.inspect_image(service["image"])["Config"]
+            if image_config is None:
+                image_config = ImageConfigCache.get(client, service["image"])
             builder = ContainerBuilder(
                 service["image"],
                 service["command"] if "command" in service else image_config["Cmd"]
@@ -98,43 +146,43 @@ def start(project_name: str, service: Service, client: DockerClient, queue: Resu
             builder.set_hostname(service['$name'])
             # If src role is set, change workdir
             builder.set_workdir(service.get_working_directory())
+            # Attach to all networks on create
+            builder.set_network(get_network_name(project_name), [service['$name']])
+            add_link_networks(client, builder, service['$name'], service.get_project(), link_groups)
         except Exception as ex:
             queue.end_with_error(ResultError("ERROR preparing container.", cause=ex))
-            return
+            return False
 
         # 3. Run pre start commands
         cmd_no = -1
-        if not quick:
+        if not quick and batch_pre_start and len(service["pre_start"]) > 0:
+            try:
+                current_step = _run_pre_start_batched(
+                    client, project_name, service, builder, name, queue, current_step, step_count
+                )
+            except (APIError, ContainerError) as err:
+                if isinstance(err, ContainerError):
+                    message = "ERROR running pre start command '" + err.command + "'."
+                else:
+                    message = "ERROR running pre start commands."
+                queue.end_with_error(ResultError(message, cause=err))
+                stop(project_name, service["$name"], client)
+                return False
+        elif not quick:
             for cmd in service["pre_start"]:
                 cmd_no = cmd_no + 1
                 current_step += 1
                 queue.put(StartStopResultStep(current_step=current_step, steps=step_count, text="Pre Start: " + cmd))
                 try:
-                    # Remove first, just to be sure
-                    try:
-                        client.containers.get(name + "__pre_start" + str(cmd_no)).stop()
-                    except APIError:
-                        pass
-                    try:
-                        client.containers.get(name + "__pre_start" + str(cmd_no)).remove()
-                    except APIError:
-                        pass
+                    _remove_container_if_exists(client, name + "__pre_start" + str(cmd_no))
 
                     # Fork built container configuration and adjust it for pre start container
-                    pre_start_config = copy.deepcopy(builder.build_docker_api())
-                    pre_start_config.update({
-                        'name': name + "__pre_start" + str(cmd_no),
-                        'network': get_network_name(project_name),
-                        # Don't use ports and labels of actual service container
-                        'ports': None,
-                        'labels': {RIPTIDE_DOCKER_LABEL_IS_RIPTIDE: '1'}
-                    })
-                    pre_start_config['environment'][EENV_NO_STDOUT_REDIRECT] = '1'
-                    pre_start_config['environment'][EENV_ORIGINAL_ENTRYPOINT] = '/bin/sh -c "' + cmd + '"'
+                    pre_start_config = _pre_start_config(
+                        builder, project_name, name + "__pre_start" + str(cmd_no), '/bin/sh -c "' + cmd + '"'
+                    )
 
                     # RUN
-                    container = client.containers.create(**pre_start_config)
-                    add_network_links(client, container, None, service.get_project()["links"])
+                    container = _create(client, project_name, service["image"], pre_start_config)
                     container.start()
                     exit_code = container.wait()
                     if exit_code["StatusCode"] != 0:
@@ -143,68 +191,259 @@ def start(project_name: str, service: Service, client: DockerClient, queue: Resu
                 except (APIError, ContainerError) as err:
                     queue.end_with_error(ResultError("ERROR running pre start command '" + cmd + "'.", cause=err))
                     stop(project_name, service["$name"], client)
-                    return
+                    return False
 
         # 4. Starting the container
         current_step += 1
         queue.put(StartStopResultStep(current_step=current_step, steps=step_count, text="Starting Container..."))
 
+        readiness_check = None
         try:
-            # Lock here to prevent race conditions with port assignment
-            with start_lock:
-                builder.service_add_main_port(service)
-                # CREATE
-                container = client.containers.create(**builder.build_docker_api())
-                # Add container to link networks
-                add_network_links(client, container, service["$name"], service.get_project()["links"])
-                # Add container to main network
-                client.networks.get(get_network_name(project_name)).connect(container, aliases=[service["$name"]])
-                # RUN
-                container.start()
-        except (APIError, ContainerError) as err:
+            builder.service_add_main_port(service, PortAllocator(client))
+            # CREATE, attached to the main and link networks
+            container = _create(client, project_name, service["image"], builder.build_docker_api())
+            # Subscribe to container events before starting, so that no crash is missed
+            readiness_check = ReadinessCheck(client, container, default_probes(
+                service, image_config,
+                builder.ports[service["port"]] if "port" in service else None,
+                readiness_settings
+            ), readiness_settings.grace_period)
+            # RUN
+            container.start()
+        except (APIError, ContainerError, OSError) as err:
+            if readiness_check is not None:
+                # Closes the events stream
+                readiness_check.close()
             queue.end_with_error(ResultError("ERROR starting container.", cause=err))
-            return
+            return False
 
-        # 4b. Checking if it actually started or just crashed immediately
+        # 4b. Checking if it actually started or just crashed
         current_step += 1
         queue.put(StartStopResultStep(current_step=current_step, steps=step_count, text="Checking..."))
-        sleep(3)
-        try:
-            container = client.containers.get(name)
-            if container.status == "exited":
-                extra = " Try 'run_as_current_user': false" if service["run_as_current_user"] else ""
-                queue.end_with_error(ResultError("ERROR: Container crashed." + extra, details=container.logs().decode("utf-8")))
+        readiness = readiness_check.wait()
+        if readiness.state == CRASHED:
+            extra = " Try 'run_as_current_user': false" if service["run_as_current_user"] else ""
+            try:
+                details = container.logs().decode("utf-8")
                 container.remove()
-                return
-        except NotFound:
-            queue.end_with_error(ResultError("ERROR: Container went missing."))
-            return
+            except NotFound:
+                queue.end_with_error(ResultError("ERROR: Container went missing."))
+                return False
+            queue.end_with_error(ResultError("ERROR: Container crashed." + extra, details=details))
+            return False
+        for message in readiness.messages:
+            queue.put(StartStopResultStep(current_step=current_step, steps=step_count, text="Checking... " + message))
 
         # 5. Execute Post Start commands via docker exec.
-        cmd_no = -1
+        failed_post_start = []
         if not quick:
-            for cmd in service["post_start"]:
-                cmd_no = cmd_no + 1
-                current_step += 1
-                queue.put(StartStopResultStep(current_step=current_step, steps=step_count, text="Post Start: " + cmd))
-                try:
-                    container.exec_run(
-                        cmd=["/bin/sh", "-c", cmd],
-                        detach=False,
-                        tty=True,
-                        user=str(getuid()) if service['run_as_current_user'] else None
-                    )
-                except (APIError, ContainerError) as err:
-                    queue.end_with_error(ResultError("ERROR running post start command '" + cmd + "'.", cause=err))
-                    stop(project_name, service["$name"], client)
-                    return
+            for group in _plan_post_start(service["post_start"], post_start_parallel_groups):
+                results = _run_post_start_group(client, container, service, group, queue, current_step, step_count)
+                current_step += len(group)
+                for result in results:
+                    if result.error is not None:
+                        queue.end_with_error(ResultError(
+                            "ERROR running post start command '" + result.command + "'.", cause=result.error
+                        ))
+                        stop(project_name, service["$name"], client)
+                        return False
+                    if result.exit_code != 0:
+                        failed_post_start.append(result.command)
 
         # 6. Done!
         current_step += 1
-        queue.put(StartStopResultStep(current_step=current_step, steps=step_count, text="Started!"))
+        if len(failed_post_start) > 0:
+            queue.put(PostStartFailedStep(current_step=current_step, steps=step_count,
+                                          text=f"Started! ({len(failed_post_start)} post start command(s) failed)",
+                                          failed_commands=failed_post_start))
+        else:
+            queue.put(StartStopResultStep(current_step=current_step, steps=step_count, text="Started!"))
     else:
         queue.put(StartStopResultStep(current_step=2, steps=2, text='Already started!'))
     queue.end()
+    return True
+
+
+def _remove_container_if_exists(client: DockerClient, name: str):
+    """Remove a left over helper container, just to be sure"""
+    try:
+        client.containers.get(name).stop()
+    except APIError:
+        pass
+    try:
+        client.containers.get(name).remove()
+    except APIError:
+        pass
+
+
+def _pre_start_config(builder: ContainerBuilder, project_name: str, name: str, entrypoint: str) -> dict:
+    """Fork the built service container configuration and adjust it for a pre start container"""
+    pre_start_config = copy.deepcopy(builder.build_docker_api())
+    pre_start_config.update({
+        'name': name,
+        'network': get_network_name(project_name),
+        # Don't use ports, labels and network aliases of actual service container
+        'ports': None,
+        'labels': {RIPTIDE_DOCKER_LABEL_IS_RIPTIDE: '1'},
+        'networking_config': {network: {} for network in pre_start_config['networking_config'].keys()}
+    })
+    pre_start_config['environment'][EENV_NO_STDOUT_REDIRECT] = '1'
+    pre_start_config['environment'][EENV_ORIGINAL_ENTRYPOINT] = entrypoint
+    return pre_start_config
+
+
+def _run_pre_start_batched(client: DockerClient, project_name: str, service: Service, builder: ContainerBuilder,
+                           name: str, queue: ResultQueue, current_step: int, step_count: int) -> int:
+    """
+    Runs all pre start commands in order in one container. Stops at the first command that fails.
+    Output of the commands is streamed into the queue. Returns the new current step.
+
+    The commands are written to a script, that marks the start and exit code of each command
+    in the output of the container. Markers are printed on their own line, with a newline before them,
+    in case the output of the command before didn't end with one. That empty line is not part of the output.
+    Markers contain a random token of this run. Only lines that are exactly the next expected marker are
+    markers, all other lines are output of the commands.
+
+    :raises: ContainerError: If a command failed. The command attribute contains the failed command.
+    :raises: APIError
+    """
+    commands = service["pre_start"]
+    marker = PRE_START_MARKER + uuid.uuid4().hex
+    marker_pattern = re.compile(re.escape(marker) + r' (start|exit) ([0-9]+)(?: ([0-9]+))?')
+    script = ''
+    for cmd_no, cmd in enumerate(commands):
+        script += f"printf '\\n%s\\n' '{marker} start {cmd_no}'\n" \
+                  f'/bin/sh -c {shlex.quote(cmd)}\n' \
+                  f'rc=$?\n' \
+                  f"printf '\\n%s\\n' \"{marker} exit {cmd_no} $rc\"\n" \
+                  f'[ $rc -eq 0 ] || exit $rc\n'
+
+    container_name = name + "__pre_start"
+    _remove_container_if_exists(client, container_name)
+    container = _create(client, project_name, service["image"],
+                        _pre_start_config(builder, project_name, container_name, '/bin/sh ' + PRE_START_SCRIPT_PATH))
+    try:
+        container.put_archive('/', tar_single_file(PRE_START_SCRIPT_PATH.lstrip('/'), script.encode('utf-8')))
+        container.start()
+
+        cmd = None
+        cmd_no = -1
+        output = []
+
+        def add_output(output_line: str):
+            output.append(output_line)
+            queue.put(StartStopResultStep(current_step=current_step, steps=step_count,
+                                          text="Pre Start: " + cmd + ": " + output_line))
+
+        # An empty line is held back until the next line, it may be the newline printed before a marker
+        held_empty_line = False
+        for line in stream_lines(container.logs(stream=True, follow=True)):
+            match = marker_pattern.fullmatch(line)
+            if match is not None and match.group(1) == 'start' and match.group(3) is None \
+                    and int(match.group(2)) == cmd_no + 1 and cmd_no + 1 < len(commands):
+                cmd_no += 1
+                cmd = commands[cmd_no]
+                output = []
+                current_step += 1
+                queue.put(StartStopResultStep(current_step=current_step, steps=step_count, text="Pre Start: " + cmd))
+            elif match is not None and match.group(1) == 'exit' and match.group(3) is not None \
+                    and int(match.group(2)) == cmd_no:
+                if match.group(3) != '0':
+                    raise ContainerError(container, int(match.group(3)), cmd, service["image"], '\n'.join(output))
+            elif cmd is not None:
+                if held_empty_line:
+                    add_output('')
+                held_empty_line = line == ''
+                if not held_empty_line:
+                    add_output(line)
+                continue
+            held_empty_line = False
+
+        exit_code = container.wait()
+        if exit_code["StatusCode"] != 0:
+            # Failed outside of a command, eg. in the entrypoint
+            raise ContainerError(container, exit_code["StatusCode"], cmd or commands[0], service["image"],
+                                 container.logs(stdout=False))
+    finally:
+        container.remove(force=True)
+    return current_step
+
+
+class PostStartResult(NamedTuple):
+    command: str
+    exit_code: Union[int, None]
+    # Duration in seconds
+    duration: float
+    # APIError, if the command could not be run
+    error: Union[Exception, None]
+
+
+def _plan_post_start(commands: List[str], parallel_groups: List[List[str]]) -> List[List[str]]:
+    """
+    Splits the post start commands into groups that are run one after another.
+    Consecutive commands that are all in the same parallel group are put in one group and run concurrently,
+    all other commands are in their own group.
+    """
+    plan = []
+    current_parallel_group = None
+    for cmd in commands:
+        parallel_group = next((group for group in parallel_groups if cmd in group), None)
+        if parallel_group is not None and parallel_group is current_parallel_group:
+            plan[-1].append(cmd)
+        else:
+            plan.append([cmd])
+        current_parallel_group = parallel_group
+    return plan
+
+
+def _run_post_start_group(client: DockerClient, container: Container, service: Service, group: List[str],
+                          queue: ResultQueue, current_step: int, step_count: int) -> List[PostStartResult]:
+    """Runs the commands concurrently. Each command gets it's own step, starting after current_step."""
+    if len(group) == 1:
+        return [_run_post_start_command(client, container, service, group[0], queue, current_step + 1, step_count)]
+    with ThreadPoolExecutor(max_workers=len(group)) as executor:
+        futures = [
+            executor.submit(_run_post_start_command, client, container, service, cmd, queue, current_step + 1 + i, step_count)
+            for i, cmd in enumerate(group)
+        ]
+        return [future.result() for future in futures]
+
+
+def _run_post_start_command(client: DockerClient, container: Container, service: Service, cmd: str,
+                            queue: ResultQueue, step: int, step_count: int) -> PostStartResult:
+    """Runs one post start command via docker exec, streams it's output into the queue."""
+    queue.put(StartStopResultStep(current_step=step, steps=step_count, text="Post Start: " + cmd))
+    started = monotonic()
+    try:
+        exec_id = client.api.exec_create(
+            container.id,
+            cmd=["/bin/sh", "-c", cmd],
+            tty=False,
+            user=str(getuid()) if service['run_as_current_user'] else ''
+        )
+        output = socket_output(client.api.exec_start(exec_id, socket=True))
+        for line in stream_lines(stdout or stderr for stdout, stderr in output):
+            queue.put(StartStopResultStep(current_step=step, steps=step_count, text="Post Start: " + cmd + ": " + line))
+        exit_code = client.api.exec_inspect(exec_id)["ExitCode"]
+    except APIError as err:
+        return PostStartResult(cmd, None, monotonic() - started, err)
+    duration = monotonic() - started
+    if exit_code != 0:
+        text = f"Post Start: {cmd}: Failed with exit code {exit_code} after {duration:.1f}s"
+    else:
+        text = f"Post Start: {cmd}: Done in {duration:.1f}s"
+    queue.put(StartStopResultStep(current_step=step, steps=step_count, text=text))
+    return PostStartResult(cmd, exit_code, duration, None)
+
+
+def _create(client: DockerClient, project_name: str, image_name: str, config: dict) -> Container:
+    """
+    Creates a container in the project network. If the image was removed since it's config was cached,
+    it is pulled and the container is created again.
+    """
+    return with_image(client, image_name, functools.partial(
+        with_project_network, client, project_name, functools.partial(create_container, client, config)
+    ))
 
 
 def stop(project_name: str, service_name: str, client: DockerClient, queue: ResultQueue=None):
@@ -246,15 +485,33 @@ def stop(project_name: str, service_name: str, client: DockerClient, queue: Resu
         queue.end()
 
 
-def status(project_name: str, service: Service, client: DockerClient, system_config: Config):
-    # Get Container
-    name = get_service_container_name(project_name, service["$name"])
-    container_is_running = False
-    try:
-        container = client.containers.get(name)
-        if container.status != "exited":
-            container_is_running = True
-    except NotFound:
-        pass
+def status_by_project(client: DockerClient, project_name: str = None,
+                      snapshot: StateSnapshot = None) -> Dict[str, Dict[str, bool]]:
+    """
+    Returns the status of all service containers, grouped by project and then indexed by service name.
 
-    return container_is_running
+    This is done with one single (non-inspecting) container list call, using the labels set
+    by service_collect_labels. If project_name is given, only containers of this project are listed.
+    Services without a container are not contained in the result.
+    A service counts as running if it's container is not in the "exited" state.
+
+    If a snapshot of the state tracker is given, the containers of the snapshot are used instead.
+    """
+    if project_name is None:
+        label_filter = RIPTIDE_DOCKER_LABEL_PROJECT
+    else:
+        label_filter = RIPTIDE_DOCKER_LABEL_PROJECT + '=' + project_name
+
+    if snapshot is not None:
+        containers = containers_with_label(snapshot, label_filter)
+    else:
+        containers = client.api.containers(all=True, filters={'label': label_filter})
+
+    projects = {}
+    for container in containers:
+        labels = container['Labels'] or {}
+        if RIPTIDE_DOCKER_LABEL_SERVICE not in labels:
+            continue
+        projects.setdefault(labels[RIPTIDE_DOCKER_LABEL_PROJECT], {})[labels[RIPTIDE_DOCKER_LABEL_SERVICE]] = \
+            container['State'] != "exited"
+    return projects
@@ -0,0 +1,189 @@
+"""
+Optional in-memory model of the Docker objects of Riptide (containers, networks and volumes).
+
+The tracker lists all Riptide containers, networks and volumes (objects with the riptide label) once and then keeps
+the model up to date by consuming the Docker events stream. Reads are served from memory. This is meant for long-lived
+processes using the engine (eg. the Riptide proxy server), which would otherwise ask the Docker daemon
+on every lookup.
+
+Every change increases the version of the model. Snapshots are immutable, a snapshot stays consistent
+even if the model changes while it is used.
+
+If the events stream breaks, the tracker is not ready until it re-subscribed and listed all objects again.
+Callers must fall back to asking the daemon while the tracker is not ready.
+"""
+import threading
+from time import time
+from typing import Dict, NamedTuple, FrozenSet, Union, List, Callable
+
+from docker import DockerClient
+from docker.errors import APIError, NotFound
+
+from riptide_engine_docker.container_builder import RIPTIDE_DOCKER_LABEL_IS_RIPTIDE
+
+# Time to wait before re-subscribing after the events stream broke, in seconds.
+RECONNECT_INTERVAL = 2
+
+CONTAINER_STATES = {
+    'create': 'created',
+    'start': 'running',
+    'unpause': 'running',
+    'pause': 'paused',
+    'die': 'exited',
+}
+
+
+class StateSnapshot(NamedTuple):
+    version: int
+    # Container ID -> container, in the format of the (non-inspecting) container list API.
+    containers: Dict[str, dict]
+    networks: FrozenSet[str]
+    volumes: FrozenSet[str]
+
+    def container_by_name(self, name: str) -> Union[dict, None]:
+        for container in self.containers.values():
+            if '/' + name in container['Names']:
+                return container
+        return None
+
+
+class StateTracker:
+    """Keeps a model of all Riptide containers, networks and volumes up to date. Thread-safe."""
+
+    def __init__(self, client: DockerClient):
+        self.client = client
+        self._lock = threading.Lock()
+        self._snapshot = StateSnapshot(0, {}, frozenset(), frozenset())
+        self._ready = threading.Event()
+        self._stopped = threading.Event()
+        self._events = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def start(self, wait: bool = True) -> None:
+        """Starts tracking in a daemon thread. If wait is set, returns after the initial listing."""
+        threading.Thread(target=self._run, daemon=True).start()
+        if wait:
+            self._ready.wait(timeout=self.client.api.timeout)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._ready.clear()
+        if self._events is not None:
+            self._events.close()
+
+    def snapshot(self) -> Union[StateSnapshot, None]:
+        """Returns the current state. None if the tracker is not ready."""
+        if not self.ready:
+            return None
+        return self._snapshot
+
+    def record_volume(self, name: str, exists: bool) -> None:
+        """
+        Applies a change of a volume made by this process, so that snapshots contain it right away
+        and not only after the event of the change arrived.
+        """
+        self._apply_name('volumes', name, 'create' if exists else 'destroy')
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                # Subscribe before listing, so that no change between both is missed.
+                # Events for changes already contained in the listing are applied again, which does no harm.
+                self._events = self.client.events(decode=True, since=int(time()), filters={
+                    'type': ['container', 'network', 'volume']
+                })
+                self._seed()
+                self._ready.set()
+                for event in self._events:
+                    self._apply(event)
+            except (APIError, OSError, ValueError):
+                pass
+            self._ready.clear()
+            self._stopped.wait(RECONNECT_INTERVAL)
+
+    def _seed(self):
+        label = {'label': RIPTIDE_DOCKER_LABEL_IS_RIPTIDE}
+        containers = {c['Id']: c for c in self.client.api.containers(all=True, filters=label)}
+        networks = frozenset(n['Name'] for n in self.client.api.networks(filters=label))
+        volumes = frozenset(v['Name'] for v in self.client.api.volumes(filters=label)['Volumes'] or [])
+        with self._lock:
+            self._snapshot = StateSnapshot(self._snapshot.version + 1, containers, networks, volumes)
+
+    def _apply(self, event: dict):
+        event_type = event.get('Type')
+        action = event.get('Action', '')
+        actor = event.get('Actor', {})
+        attributes = actor.get('Attributes', {})
+        if event_type == 'container':
+            if RIPTIDE_DOCKER_LABEL_IS_RIPTIDE in attributes:
+                self._apply_container(actor['ID'], action, attributes)
+        elif event_type == 'network':
+            self._apply_object('networks', attributes.get('name', ''), action,
+                               lambda: self.client.api.inspect_network(actor.get('ID', ''))['Labels'])
+        elif event_type == 'volume':
+            self._apply_object('volumes', actor.get('ID', ''), action,
+                               lambda: self.client.api.inspect_volume(actor.get('ID', ''))['Labels'])
+
+    def _apply_container(self, container_id: str, action: str, attributes: dict):
+        if action == 'create':
+            # Events don't contain everything the list API returns (eg. labels and attributes are mixed).
+            found = self.client.api.containers(all=True, filters={'id': container_id})
+            with self._lock:
+                containers = dict(self._snapshot.containers)
+                containers.update({c['Id']: c for c in found})
+                self._update(containers=containers)
+        elif action == 'destroy':
+            with self._lock:
+                if container_id in self._snapshot.containers:
+                    containers = dict(self._snapshot.containers)
+                    del containers[container_id]
+                    self._update(containers=containers)
+        elif action in CONTAINER_STATES or action == 'rename':
+            with self._lock:
+                if container_id not in self._snapshot.containers:
+                    return
+                container = dict(self._snapshot.containers[container_id])
+                if action == 'rename':
+                    container['Names'] = ['/' + attributes.get('name', '')]
+                else:
+                    container['State'] = CONTAINER_STATES[action]
+                containers = dict(self._snapshot.containers)
+                containers[container_id] = container
+                self._update(containers=containers)
+
+    def _apply_object(self, kind: str, name: str, action: str, get_labels: Callable[[], Union[dict, None]]):
+        """
+        Applies an event of a network or volume. Their events don't contain labels, so created objects are
+        looked up. Removed objects are only in the model if they had the label.
+        """
+        if action == 'create':
+            try:
+                if RIPTIDE_DOCKER_LABEL_IS_RIPTIDE not in (get_labels() or {}):
+                    return
+            except NotFound:
+                # Removed again already, the destroy event follows.
+                return
+        self._apply_name(kind, name, action)
+
+    def _apply_name(self, kind: str, name: str, action: str):
+        with self._lock:
+            names = getattr(self._snapshot, kind)
+            if action == 'create' and name not in names:
+                self._update(**{kind: names | {name}})
+            elif action == 'destroy' and name in names:
+                self._update(**{kind: names - {name}})
+
+    def _update(self, **changes):
+        # Must be called with the lock held
+        self._snapshot = self._snapshot._replace(version=self._snapshot.version + 1, **changes)
+
+
+def containers_with_label(snapshot: StateSnapshot, label: str) -> List[dict]:
+    """Containers of the snapshot with the given label (or label=value), like the label filter of the list API."""
+    if '=' in label:
+        key, value = label.split('=', 1)
+        return [c for c in snapshot.containers.values() if (c['Labels'] or {}).get(key) == value]
+    return [c for c in snapshot.containers.values() if label in (c['Labels'] or {})]
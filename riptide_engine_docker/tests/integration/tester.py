@@ -7,6 +7,7 @@ from warnings import warn
 
 from riptide.tests.integration.engine.tester_for_engine import AbstractEngineTester
 from riptide_engine_docker.container_builder import get_service_container_name, RIPTIDE_DOCKER_LABEL_IS_RIPTIDE
+from riptide_engine_docker.network import NetworkRegistry
 
 
 class DockerEngineTester(AbstractEngineTester):
@@ -40,6 +41,7 @@ class DockerEngineTester(AbstractEngineTester):
         networks = client.networks.list(filters={'label': RIPTIDE_DOCKER_LABEL_IS_RIPTIDE})
         for network in networks:
             network.remove()
+            NetworkRegistry.invalidate(network.name)
 
     def assert_running(self, engine_obj, project, services):
         for service in services:
@@ -0,0 +1,131 @@
+import os
+import signal
+import socket
+import ssl
+import threading
+import unittest
+from unittest import mock
+
+from riptide_engine_docker.attach import _pump, _exec_exit_code, _forward_resize, _write_frames, FRAME_HEADER, \
+    _forward_interrupt
+
+
+class AttachTest(unittest.TestCase):
+
+    def test_pump(self):
+        ours, container = socket.socketpair()
+        stdin_read, stdin_write = os.pipe()
+        stdout_read, stdout_write = os.pipe()
+        input_data = b'input' * 100000
+
+        def fake_container():
+            received = b''
+            while len(received) < len(input_data):
+                received += container.recv(65536)
+            container.sendall(b'output:' + str(len(received)).encode())
+            container.close()
+
+        container_thread = threading.Thread(target=fake_container)
+        container_thread.start()
+        writer = threading.Thread(target=lambda: os.write(stdin_write, input_data))
+        writer.start()
+
+        _pump(ours, stdin_read, stdout_write)
+
+        os.close(stdout_write)
+        self.assertEqual(b'output:500000', os.read(stdout_read, 1024))
+        container_thread.join(5)
+        writer.join(5)
+        for fd in [stdin_read, stdin_write, stdout_read]:
+            os.close(fd)
+        ours.close()
+
+    def test_pump_multiplexed(self):
+        ours, container = socket.socketpair()
+        stdin_read, stdin_write = os.pipe()
+        stdout_read, stdout_write = os.pipe()
+        stderr_read, stderr_write = os.pipe()
+        os.write(stdin_write, b'dump')
+        os.close(stdin_write)
+
+        def fake_container():
+            received = b''
+            while True:
+                data = container.recv(65536)
+                if len(data) == 0:
+                    # stdin was closed
+                    break
+                received += data
+            container.sendall(FRAME_HEADER.pack(1, len(received)) + received)
+            container.sendall(FRAME_HEADER.pack(2, 5) + b'error')
+            container.close()
+
+        container_thread = threading.Thread(target=fake_container)
+        container_thread.start()
+
+        _pump(ours, stdin_read, stdout_write, stderr_write)
+
+        container_thread.join(5)
+        self.assertEqual(b'dump', os.read(stdout_read, 1024))
+        self.assertEqual(b'error', os.read(stderr_read, 1024))
+        for fd in [stdin_read, stdout_read, stdout_write, stderr_read, stderr_write]:
+            os.close(fd)
+        ours.close()
+
+    def test_pump_tls_pending(self):
+        # The socket itself never becomes readable, all output is already decrypted
+        ours, container = socket.socketpair()
+        sock = mock.Mock(spec=ssl.SSLSocket)
+        sock.fileno.return_value = ours.fileno()
+        sock.pending.side_effect = [5, 1]
+        sock.recv.side_effect = [b'hello', b'']
+        stdin_read, stdin_write = os.pipe()
+        stdout_read, stdout_write = os.pipe()
+
+        _pump(sock, stdin_read, stdout_write)
+
+        self.assertEqual(b'hello', os.read(stdout_read, 1024))
+        for fd in [stdin_read, stdin_write, stdout_read, stdout_write]:
+            os.close(fd)
+        ours.close()
+        container.close()
+
+    def test_write_frames_incomplete(self):
+        stdout_read, stdout_write = os.pipe()
+        data = FRAME_HEADER.pack(1, 3) + b'abc' + FRAME_HEADER.pack(1, 10) + b'def'
+
+        rest = _write_frames(data, stdout_write, stdout_write)
+
+        self.assertEqual(FRAME_HEADER.pack(1, 10) + b'def', rest)
+        self.assertEqual(b'abc', os.read(stdout_read, 1024))
+        os.close(stdout_read)
+        os.close(stdout_write)
+
+    @mock.patch('riptide_engine_docker.attach.sleep')
+    def test_exec_exit_code(self, sleep_mock):
+        client = mock.Mock()
+        client.api.exec_inspect.side_effect = [
+            {'Running': True, 'ExitCode': None},
+            {'Running': False, 'ExitCode': 3},
+        ]
+
+        self.assertEqual(3, _exec_exit_code(client, 'exec'))
+
+    @mock.patch('riptide_engine_docker.attach.os.get_terminal_size', side_effect=OSError())
+    def test_resize_default_size(self, get_terminal_size_mock):
+        resize = mock.Mock()
+
+        with _forward_resize(1, resize, (24, 80)):
+            pass
+
+        resize.assert_called_once_with(24, 80)
+
+    def test_forward_interrupt(self):
+        interrupt = mock.Mock()
+        old_handler = signal.getsignal(signal.SIGINT)
+
+        with _forward_interrupt(interrupt):
+            os.kill(os.getpid(), signal.SIGINT)
+
+        interrupt.assert_called_once_with()
+        self.assertEqual(old_handler, signal.getsignal(signal.SIGINT))
@@ -0,0 +1,50 @@
+import unittest
+from unittest import mock
+
+from riptide_engine_docker.client import connection_stats, pool_size_for, create_client, ClientSettings, \
+    CONNECTIONS_PER_START
+
+
+class PoolsStub(dict):
+    """Like urllib3's RecentlyUsedContainer, keys() returns a list."""
+    def keys(self):
+        return list(super().keys())
+
+
+class ClientTest(unittest.TestCase):
+
+    def test_pool_size_for(self):
+        with mock.patch('riptide_engine_docker.client._default_executor_workers', return_value=1):
+            self.assertGreaterEqual(pool_size_for(8, 4), 8 * CONNECTIONS_PER_START)
+            self.assertGreaterEqual(pool_size_for(1, 30), 30)
+        with mock.patch('riptide_engine_docker.client._default_executor_workers', return_value=32):
+            self.assertGreaterEqual(pool_size_for(1, 1), 32)
+
+    @mock.patch('riptide_engine_docker.client.docker')
+    def test_create_client(self, docker_mock):
+        docker_mock.from_env.return_value.api.headers = {}
+
+        client = create_client(ClientSettings(), 20)
+        docker_mock.from_env.assert_called_with(timeout=60, max_pool_size=20)
+        self.assertNotIn('Connection', client.api.headers)
+
+        client = create_client(ClientSettings(pool_size=5, keep_alive=False, timeout=10), 20)
+        docker_mock.from_env.assert_called_with(timeout=10, max_pool_size=5)
+        self.assertEqual('close', client.api.headers['Connection'])
+
+    def test_connection_stats(self):
+        unix_adapter = mock.Mock(spec=['pools'], pools=PoolsStub({
+            'http+docker://localhost': mock.Mock(num_connections=2, num_requests=10)
+        }))
+        tcp_adapter = mock.Mock(spec=['poolmanager'])
+        tcp_adapter.poolmanager.pools = PoolsStub({
+            'a': mock.Mock(num_connections=1, num_requests=1),
+            'b': mock.Mock(num_connections=1, num_requests=3)
+        })
+        client = mock.Mock()
+        client.api.adapters = {'http+docker://': unix_adapter, 'https://': tcp_adapter}
+
+        stats = connection_stats(client)
+        self.assertEqual(4, stats.connections)
+        self.assertEqual(14, stats.requests)
+        self.assertEqual(10, stats.reused)
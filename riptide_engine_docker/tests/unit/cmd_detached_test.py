@@ -0,0 +1,114 @@
+import socket
+import threading
+import time
+import unittest
+from unittest import mock
+
+from riptide_engine_docker.cmd_detached import DetachedOutput, STDOUT, STDERR, _claim, cmd_detached, \
+    cmd_detached_stream
+from riptide_engine_docker.container_builder import ContainerBuilder
+from riptide_engine_docker.tests.unit.util_test import frame
+
+
+class DetachedOutputTest(unittest.TestCase):
+
+    def test_stream_and_tail(self):
+        def chunks():
+            yield b'0123456789', None
+            yield b'abc', b'error'
+            yield None, b'!'
+            return 3
+
+        output = DetachedOutput(chunks(), tail_size=8)
+
+        self.assertListEqual([
+            (STDOUT, b'0123456789'),
+            (STDOUT, b'abc'),
+            (STDERR, b'error'),
+            (STDERR, b'!'),
+        ], list(output))
+        self.assertEqual(3, output.exit_code)
+        self.assertEqual(b'56789abc', output.tail(STDOUT))
+        self.assertEqual(b'error!', output.tail(STDERR))
+        self.assertEqual(b'56789abcerror!', output.tail())
+
+    def test_wait(self):
+        def chunks():
+            yield b'output', None
+            return 0
+
+        output = DetachedOutput(chunks())
+
+        self.assertEqual(0, output.wait())
+        self.assertEqual(b'output', output.tail())
+
+
+class ClaimTest(unittest.TestCase):
+
+    def setUp(self):
+        self.warm_pool = mock.Mock(enabled=True)
+        self.warm_pool.claim.return_value = True
+        self.project = {'name': 'project'}
+
+    def test_project_command(self):
+        builder = mock.Mock()
+
+        self.assertTrue(_claim(builder, self.project, {'$name': 'composer', 'image': 'img'}, 'n', self.warm_pool))
+
+        self.warm_pool.claim.assert_called_once_with(builder, 'project/detached/composer', 'n')
+        self.warm_pool.refill.assert_called_once_with(builder, 'project', 'project/detached/composer')
+
+    def test_ad_hoc_command(self):
+        self.assertFalse(_claim(mock.Mock(), self.project, {'image': 'img'}, 'n', self.warm_pool))
+
+        # Nothing is claimed, removed or created
+        self.warm_pool.claim.assert_not_called()
+        self.warm_pool.refill.assert_not_called()
+
+
+class SilentCommandTest(unittest.TestCase):
+    """Commands that don't print anything for longer than the read timeout of the client (eg. rm -rf)."""
+
+    def setUp(self):
+        self.client_end, container_end = socket.socketpair()
+        # The read timeout the Docker client leaves on the connection
+        self.client_end.settimeout(0.05)
+
+        def container():
+            time.sleep(0.3)
+            container_end.sendall(frame(1, b'done\n'))
+            container_end.close()
+
+        self.thread = threading.Thread(target=container)
+        self.thread.start()
+        self.client = mock.Mock()
+        self.warm_pool = mock.Mock(enabled=True)
+        self.builder = ContainerBuilder('img', 'rm -rf /big')
+
+    def tearDown(self):
+        self.thread.join()
+
+    @mock.patch('riptide_engine_docker.cmd_detached._create')
+    @mock.patch('riptide_engine_docker.cmd_detached._prepare')
+    def test_stream(self, prepare_mock, create_mock):
+        prepare_mock.return_value = (self.builder, 'name')
+        self.client.api.attach_socket.return_value = self.client_end
+        create_mock.return_value.wait.return_value = {'StatusCode': 0}
+
+        output = cmd_detached_stream(self.client, {'name': 'project'}, {'image': 'img'})
+
+        self.assertListEqual([(STDOUT, b'done\n')], list(output))
+        self.assertEqual(0, output.exit_code)
+
+    @mock.patch('riptide_engine_docker.cmd_detached._claim', return_value=True)
+    @mock.patch('riptide_engine_docker.cmd_detached._prepare')
+    def test_claimed(self, prepare_mock, claim_mock):
+        prepare_mock.return_value = (self.builder, 'name')
+        self.client.api.exec_start.return_value = self.client_end
+        self.client.api.exec_inspect.return_value = {'ExitCode': 0}
+
+        self.assertEqual((0, b'done\n'), cmd_detached(self.client, {'name': 'project'}, {'image': 'img'},
+                                                      warm_pool=self.warm_pool))
+
+        self.assertTrue(self.client.api.exec_start.call_args[1]['socket'])
+        self.warm_pool.release.assert_called_once_with('name')
@@ -11,7 +11,7 @@ from riptide.tests.stubs import ProjectStub
 from riptide_engine_docker.container_builder import ContainerBuilder, ENTRYPOINT_SH, ENTRYPOINT_CONTAINER_PATH, \
     EENV_ORIGINAL_ENTRYPOINT, EENV_DONT_RUN_CMD, EENV_COMMAND_LOG_PREFIX, EENV_USER, EENV_GROUP, \
     EENV_RUN_MAIN_CMD_AS_USER, RIPTIDE_DOCKER_LABEL_IS_RIPTIDE, RIPTIDE_DOCKER_LABEL_MAIN, RIPTIDE_DOCKER_LABEL_PROJECT, \
-    RIPTIDE_DOCKER_LABEL_SERVICE, RIPTIDE_DOCKER_LABEL_HTTP_PORT, EENV_USER_RUN, DOCKER_ENGINE_HTTP_PORT_BND_START, \
+    RIPTIDE_DOCKER_LABEL_SERVICE, RIPTIDE_DOCKER_LABEL_HTTP_PORT, EENV_USER_RUN, \
     EENV_ON_LINUX, EENV_HOST_SYSTEM_HOSTNAMES, EENV_OVERLAY_TARGETS, EENV_NAMED_VOLUMES
 
 IMAGE_NAME = 'unit/testimage'
@@ -297,7 +297,8 @@ class ContainerBuilderTest(unittest.TestCase):
 
         # Test API build
         self.expected_api_base.update({
-            'network': 'name'
+            'network': 'name',
+            'networking_config': {'name': {}}
         })
         actual_api = self.fix.build_docker_api()
         self.assertDictEqual(actual_api, self.expected_api_base)
@@ -312,6 +313,35 @@ class ContainerBuilderTest(unittest.TestCase):
         actual_cli = self.fix.build_docker_cli()
         self.assertListEqual(actual_cli, expected_cli)
 
+    def test_add_network(self):
+        self.fix.set_network('name', ['alias'])
+        self.fix.add_network('link1', ['alias'])
+        self.fix.add_network('link2')
+
+        # Test API build
+        self.expected_api_base.update({
+            'network': 'name',
+            'networking_config': {
+                'name': {'Aliases': ['alias']},
+                'link1': {'Aliases': ['alias']},
+                'link2': {}
+            }
+        })
+        actual_api = self.fix.build_docker_api()
+        self.assertDictEqual(actual_api, self.expected_api_base)
+
+        # Test CLI build
+        expected_cli = self.expected_cli_base + [
+            '--network', 'name=name,alias=alias',
+            '--network', 'name=link1,alias=alias',
+            '--network', 'link2',
+            '-e', EENV_ON_LINUX + '=1',
+            '--label', 'riptide=1',
+            IMAGE_NAME, COMMAND
+        ]
+        actual_cli = self.fix.build_docker_cli()
+        self.assertListEqual(actual_cli, expected_cli)
+
     def test_set_name(self):
         self.fix.set_name('blubbeldiblub')
 
@@ -1148,17 +1178,21 @@ class ContainerBuilderTest(unittest.TestCase):
         actual_cli = self.fix.build_docker_cli()
         self.assertListEqual(actual_cli, expected_cli)
 
-    @mock.patch('riptide_engine_docker.container_builder.find_open_port_starting_at',
-                return_value=9876)
-    def test_service_add_main_port(self, find_open_port_starting_at_mock: Mock):
+    def test_service_add_main_port(self):
 
         service_stub = YamlConfigDocumentStub({
+            '$name': 'SERVICENAME',
             'port': 4536
         })
+        service_stub.get_project = MagicMock(return_value=ProjectStub({
+            'name': 'PROJECTNAME'
+        }))
+        allocator_mock = Mock()
+        allocator_mock.allocate.return_value = 9876
 
-        self.fix.service_add_main_port(service_stub)
+        self.fix.service_add_main_port(service_stub, allocator_mock)
 
-        find_open_port_starting_at_mock.assert_called_once_with(DOCKER_ENGINE_HTTP_PORT_BND_START)
+        allocator_mock.allocate.assert_called_once_with('PROJECTNAME', 'SERVICENAME')
 
         # Test API build
         self.expected_api_base.update({
@@ -0,0 +1,109 @@
+import threading
+import unittest
+from unittest import mock
+
+from docker.errors import ImageNotFound
+
+from riptide_engine_docker.container_builder import ContainerBuilder
+from riptide_engine_docker.fg import AddNetLinks, _run_attached
+
+
+class EventsStub:
+    """Stand-in for the cancellable events stream of the Docker client."""
+    def __init__(self, events):
+        self.events = events
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        yield from self.events
+        self.closed.wait()
+
+    def close(self):
+        self.closed.set()
+
+
+class AddNetLinksTest(unittest.TestCase):
+
+    @mock.patch('riptide_engine_docker.fg.add_network_links')
+    def test_adds_links_once(self, add_network_links_mock):
+        client = mock.Mock()
+        client.events.return_value = EventsStub([
+            {'Action': 'create', 'Actor': {'ID': 'other', 'Attributes': {'name': 'other_container'}}},
+            {'Action': 'create', 'Actor': {'ID': 'id', 'Attributes': {'name': 'container'}}},
+            {'Action': 'start', 'Actor': {'ID': 'id', 'Attributes': {'name': 'container'}}},
+        ])
+
+        thread = AddNetLinks('container', client, ['link'])
+        thread.start()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        client.containers.get.assert_called_once_with('id')
+        add_network_links_mock.assert_called_once_with(client, client.containers.get.return_value, None, ['link'])
+
+    @mock.patch('riptide_engine_docker.fg.add_network_links')
+    def test_timeout(self, add_network_links_mock):
+        client = mock.Mock()
+        client.events.return_value = EventsStub([])
+
+        thread = AddNetLinks('container', client, ['link'], timeout=0.01)
+        thread.start()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        add_network_links_mock.assert_not_called()
+
+
+class RunAttachedTest(unittest.TestCase):
+
+    @mock.patch('riptide_engine_docker.fg.attach.relay')
+    @mock.patch('riptide_engine_docker.fg.network.create_container')
+    def test_run_attached(self, create_container_mock, relay_mock):
+        client = mock.Mock()
+        calls = mock.Mock()
+        container = create_container_mock.return_value
+        container.id = 'id'
+        container.start.side_effect = lambda: calls.start()
+        client.api.attach_socket.side_effect = lambda *args, **kwargs: (calls.attach(), 'socket')[1]
+        client.api.wait.return_value = {'StatusCode': 42}
+        builder = ContainerBuilder('image', 'command')
+        builder.set_name('container')
+        builder.set_network('riptide__project')
+        builder.add_network('riptide__linked')
+        builder.set_args(['arg'])
+
+        self.assertEqual(42, _run_attached(client, 'project', builder))
+
+        config = create_container_mock.call_args[0][1]
+        self.assertEqual(['command "arg"'], config['command'])
+        self.assertTrue(config['tty'])
+        self.assertTrue(config['stdin_open'])
+        self.assertListEqual(['riptide__project', 'riptide__linked'], list(config['networking_config'].keys()))
+        # Attached before start
+        self.assertListEqual([mock.call.attach(), mock.call.start()], calls.mock_calls)
+        self.assertEqual('socket', relay_mock.call_args[0][0])
+        # Ctrl-C is forwarded to the container
+        relay_mock.call_args[1]['interrupt']()
+        client.api.kill.assert_called_once_with('id', 'SIGINT')
+        container.remove.assert_called_once_with(force=True)
+
+    @mock.patch('riptide_engine_docker.fg.attach.relay')
+    @mock.patch('riptide_engine_docker.image_cache.get_image_config')
+    @mock.patch('riptide_engine_docker.image_cache.ImageConfigCache.invalidate')
+    @mock.patch('riptide_engine_docker.fg.network.create_container')
+    def test_run_attached_image_removed(self, create_container_mock, invalidate_mock, get_image_config_mock,
+                                        relay_mock):
+        client = mock.Mock()
+        container = mock.Mock(id='id')
+        create_container_mock.side_effect = [ImageNotFound('No such image'), container]
+        client.api.wait.return_value = {'StatusCode': 0}
+        builder = ContainerBuilder('image', 'command')
+        builder.set_name('container')
+        builder.set_network('riptide__project')
+
+        self.assertEqual(0, _run_attached(client, 'project', builder))
+
+        invalidate_mock.assert_called_once_with('image')
+        get_image_config_mock.assert_called_once_with(client, 'image')
+        self.assertEqual(2, create_container_mock.call_count)
+        container.start.assert_called_once_with()
@@ -0,0 +1,96 @@
+import unittest
+from unittest import mock
+
+from docker.errors import NotFound, APIError
+
+from riptide_engine_docker.helper import HelperService, container_path, get_helper_name, \
+    RIPTIDE_DOCKER_LABEL_HELPER_FOLDER, HELPER_EXITED_EXIT_CODE
+
+
+class HelperServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.client.api.exec_start.return_value = iter([(b'out', None)])
+        # The output of the hijacked exec connection
+        patcher = mock.patch('riptide_engine_docker.helper.socket_output', side_effect=lambda sock: sock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.api.exec_inspect.return_value = {'ExitCode': 0}
+        self.project = mock.MagicMock()
+        self.project.__getitem__.side_effect = lambda key: {'name': 'project'}[key]
+        self.project.folder.return_value = '/home/user/project'
+        self.helpers = HelperService(self.client, 'alpine', idle_timeout=60)
+
+    @mock.patch('riptide_engine_docker.helper.get_image_config')
+    def test_starts_helper(self, get_image_config_mock):
+        self.client.containers.get.side_effect = NotFound('not found')
+
+        output = self.helpers.exec(self.project, 'rm -rf /host/home/user/project/x')
+
+        # Nothing happens before the output is consumed
+        self.client.containers.run.assert_not_called()
+        self.assertEqual(0, output.wait())
+        self.assertEqual(b'out', output.tail())
+        run_kwargs = self.client.containers.run.call_args[1]
+        self.assertEqual(get_helper_name('project'), run_kwargs['name'])
+        self.assertTrue(run_kwargs['auto_remove'])
+        self.assertEqual('/host/home/user/project', run_kwargs['mounts'][0]['Target'])
+        self.assertEqual('/home/user/project', run_kwargs['labels'][RIPTIDE_DOCKER_LABEL_HELPER_FOLDER])
+        self.assertEqual('60', self.client.containers.run.call_args[0][1][-1])
+        self.assertEqual('rm -rf /host/home/user/project/x', self.client.api.exec_create.call_args[0][1][-1])
+
+    def test_uses_running_helper(self):
+        self.client.containers.get.return_value.status = 'running'
+        self.client.containers.get.return_value.labels = {RIPTIDE_DOCKER_LABEL_HELPER_FOLDER: '/home/user/project'}
+
+        self.helpers.exec(self.project, 'true').wait()
+
+        self.client.containers.run.assert_not_called()
+        self.assertTrue(self.client.api.exec_start.call_args[1]['socket'])
+
+    @mock.patch('riptide_engine_docker.helper.get_image_config')
+    def test_replaces_helper_of_other_folder(self, get_image_config_mock):
+        container = self.client.containers.get.return_value
+        container.status = 'running'
+        # The project was moved, or another project with the same name uses the helper
+        container.labels = {RIPTIDE_DOCKER_LABEL_HELPER_FOLDER: '/home/user/old_project'}
+
+        self.helpers.exec(self.project, 'true').wait()
+
+        container.remove.assert_called_once_with(force=True)
+        self.assertEqual('/home/user/project', self.client.containers.run.call_args[1]['mounts'][0]['Source'])
+
+    @mock.patch('riptide_engine_docker.helper.get_image_config')
+    def test_helper_exited_before_exec(self, get_image_config_mock):
+        container = self.client.containers.get.return_value
+        container.status = 'running'
+        container.labels = {RIPTIDE_DOCKER_LABEL_HELPER_FOLDER: '/home/user/project'}
+        response = mock.Mock(status_code=409)
+        self.client.api.exec_create.side_effect = [APIError('not running', response), 'exec']
+
+        self.helpers.exec(self.project, 'true').wait()
+
+        self.assertEqual(2, self.client.api.exec_create.call_count)
+        self.client.api.wait.assert_called_once_with(get_helper_name('project'), condition='removed')
+        container.remove.assert_not_called()
+
+    @mock.patch('riptide_engine_docker.helper.get_image_config')
+    def test_helper_exited_after_exec_create(self, get_image_config_mock):
+        container = self.client.containers.get.return_value
+        container.status = 'running'
+        container.labels = {RIPTIDE_DOCKER_LABEL_HELPER_FOLDER: '/home/user/project'}
+        self.client.api.exec_start.side_effect = [iter([]), iter([(b'out', None)])]
+        self.client.api.exec_inspect.side_effect = [{'ExitCode': HELPER_EXITED_EXIT_CODE}, {'ExitCode': 0}]
+
+        output = self.helpers.exec(self.project, 'true')
+
+        self.assertEqual(0, output.wait())
+        self.assertEqual(b'out', output.tail())
+        self.assertEqual(2, self.client.api.exec_create.call_count)
+        self.client.api.wait.assert_called_once_with(get_helper_name('project'), condition='removed')
+
+    def test_can_run(self):
+        self.assertTrue(self.helpers.can_run(self.project, ['/home/user/project/a', '/home/user/project/b']))
+        self.assertFalse(self.helpers.can_run(self.project, ['/home/user/project/a', '/home/user/other']))
+        self.assertEqual('/host/home/user/project/a', container_path('/home/user/project/a'))
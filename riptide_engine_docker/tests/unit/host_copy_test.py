@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from riptide_engine_docker.host_copy import copy_tree, supported
+
+
+class HostCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.source = os.path.join(self.dir.name, 'source')
+        self.target = os.path.join(self.dir.name, 'target')
+        os.makedirs(os.path.join(self.source, 'sub', 'subsub'))
+        with open(os.path.join(self.source, 'file'), 'w') as file:
+            file.write('content')
+        with open(os.path.join(self.source, 'sub', 'subsub', 'file'), 'w') as file:
+            file.write('nested' * 100000)
+        os.symlink('sub', os.path.join(self.source, 'link'))
+        os.utime(os.path.join(self.source, 'file'), (1000, 1000))
+        os.utime(os.path.join(self.source, 'sub'), (2000, 2000))
+
+    def test_copy_tree(self):
+        os.makedirs(self.target)
+        with open(os.path.join(self.target, 'file'), 'w') as file:
+            file.write('old content, will be overwritten')
+
+        self.assertListEqual([], copy_tree(self.source, self.target, workers=2))
+
+        with open(os.path.join(self.target, 'file')) as file:
+            self.assertEqual('content', file.read())
+        with open(os.path.join(self.target, 'sub', 'subsub', 'file')) as file:
+            self.assertEqual('nested' * 100000, file.read())
+        self.assertEqual('sub', os.readlink(os.path.join(self.target, 'link')))
+        self.assertEqual(1000, os.stat(os.path.join(self.target, 'file')).st_mtime)
+        self.assertEqual(2000, os.stat(os.path.join(self.target, 'sub')).st_mtime)
+
+    def test_copy_tree_not_owned(self):
+        with mock.patch('os.getuid', return_value=os.getuid() + 1):
+            remaining = copy_tree(self.source, self.target)
+
+        self.assertSetEqual({
+            (os.path.join(self.source, 'sub'), os.path.join(self.target, 'sub')),
+            (os.path.join(self.source, 'file'), os.path.join(self.target, 'file')),
+            (os.path.join(self.source, 'link'), os.path.join(self.target, 'link')),
+        }, set(remaining))
+        self.assertListEqual([], os.listdir(self.target))
+
+    def test_copy_tree_hard_links(self):
+        os.link(os.path.join(self.source, 'file'), os.path.join(self.source, 'sub', 'hard_link'))
+
+        self.assertListEqual([], copy_tree(self.source, self.target, workers=2))
+
+        self.assertTrue(os.path.samefile(os.path.join(self.target, 'file'),
+                                         os.path.join(self.target, 'sub', 'hard_link')))
+
+    @unittest.skipUnless(hasattr(os, 'getuid') and os.getuid() == 0, 'Changing the group to any group needs root')
+    def test_copy_tree_group(self):
+        os.chown(os.path.join(self.source, 'file'), -1, 12345)
+        os.chown(os.path.join(self.source, 'sub'), -1, 12346)
+
+        self.assertListEqual([], copy_tree(self.source, self.target))
+
+        self.assertEqual(12345, os.stat(os.path.join(self.target, 'file')).st_gid)
+        self.assertEqual(12346, os.stat(os.path.join(self.target, 'sub')).st_gid)
+
+    def test_copy_tree_group_not_allowed(self):
+        os.chown(os.path.join(self.source, 'file'), -1, os.getgid() + 1)
+
+        with mock.patch('os.chown', side_effect=PermissionError()):
+            remaining = copy_tree(self.source, self.target)
+
+        self.assertListEqual([(os.path.join(self.source, 'file'), os.path.join(self.target, 'file'))], remaining)
+
+    def test_copy_tree_xattrs(self):
+        try:
+            os.setxattr(os.path.join(self.source, 'file'), 'user.riptide', b'value')
+        except (AttributeError, OSError):
+            self.skipTest('Extended attributes not supported')
+
+        self.assertListEqual([], copy_tree(self.source, self.target))
+
+        self.assertEqual(b'value', os.getxattr(os.path.join(self.target, 'file'), 'user.riptide'))
+
+    def test_supported(self):
+        with mock.patch('platform.system', return_value='Linux'):
+            self.assertTrue(supported())
+        with mock.patch('platform.system', return_value='Darwin'):
+            self.assertFalse(supported())
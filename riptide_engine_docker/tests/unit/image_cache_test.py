@@ -0,0 +1,67 @@
+import tempfile
+import unittest
+from unittest import mock
+
+from docker.errors import ImageNotFound
+
+from riptide_engine_docker.image_cache import ImageConfigCache, with_image
+
+
+def inspect_result(image_id, cmd):
+    return {'Id': image_id, 'Config': {'Cmd': cmd, 'Entrypoint': None, 'User': '', 'Env': ['A=B']}}
+
+
+class ImageConfigCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch('riptide_engine_docker.image_cache.riptide_config_dir',
+                             return_value=self.config_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.config_dir.cleanup)
+        ImageConfigCache._images = None
+        self.client = mock.Mock()
+        self.client.api.inspect_image.return_value = inspect_result('sha256:1', ['run'])
+
+    def test_hit(self):
+        self.assertEqual(['run'], ImageConfigCache.get(self.client, 'image')['Cmd'])
+        self.assertEqual(['run'], ImageConfigCache.get(self.client, 'image:latest')['Cmd'])
+        # Also in a new process
+        ImageConfigCache._images = None
+        self.assertEqual(['run'], ImageConfigCache.get(self.client, 'image')['Cmd'])
+
+        # Cache hits don't ask the Docker daemon
+        self.client.api.inspect_image.assert_called_once_with('image')
+        self.client.api.images.assert_not_called()
+        # Only the used keys are cached
+        self.assertNotIn('Env', ImageConfigCache.get(self.client, 'image'))
+
+    def test_invalidate(self):
+        ImageConfigCache.get(self.client, 'image')
+        self.client.api.inspect_image.return_value = inspect_result('sha256:2', ['new'])
+
+        ImageConfigCache.after_pull('image', 'Status: Image is up to date for image:latest')
+        ImageConfigCache.invalidate('other')
+        self.assertEqual(['run'], ImageConfigCache.get(self.client, 'image')['Cmd'])
+
+        ImageConfigCache.after_pull('image', 'Status: Downloaded newer image for image:latest')
+        self.assertEqual(['new'], ImageConfigCache.get(self.client, 'image')['Cmd'])
+
+    def test_missing_image(self):
+        self.client.api.inspect_image.side_effect = ImageNotFound('not found')
+
+        with self.assertRaises(ImageNotFound):
+            ImageConfigCache.get(self.client, 'image')
+
+    def test_with_image_pulls_missing_image(self):
+        ImageConfigCache.get(self.client, 'image')
+        # The image was removed after the config was cached
+        self.client.api.inspect_image.side_effect = [ImageNotFound('not found'), inspect_result('sha256:1', ['run'])]
+        func = mock.Mock(side_effect=[ImageNotFound('not found'), 'container'])
+
+        self.assertEqual('container', with_image(self.client, 'image', func))
+
+        self.client.api.pull.assert_called_once_with('image:latest')
+        self.assertEqual(2, func.call_count)
+        self.assertEqual(3, self.client.api.inspect_image.call_count)
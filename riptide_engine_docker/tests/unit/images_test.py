@@ -0,0 +1,86 @@
+import json
+import threading
+import unittest
+from unittest import mock
+
+from docker.errors import APIError, NotFound
+
+from riptide_engine_docker.images import pull_all, collect_images, PullProgress
+
+
+class RegistryStub:
+    """Stand-in for a registry and the local image store, used as client.api."""
+    def __init__(self, remote, local):
+        self.remote = remote  # image -> digest in registry
+        self.local = local  # image -> local digest
+        self.pulls = []
+        self.lock = threading.Lock()
+
+    def inspect_image(self, image):
+        if image not in self.local:
+            raise NotFound('not found')
+        return {'Id': 'id', 'RepoDigests': [f"{image.split(':')[0]}@{self.local[image]}"], 'Config': {}}
+
+    def inspect_distribution(self, image):
+        if image not in self.remote:
+            raise APIError('404 Client Error: Not Found ')
+        return {'Descriptor': {'digest': self.remote[image]}}
+
+    def pull(self, image, stream=False):
+        with self.lock:
+            self.pulls.append(image)
+        if image not in self.remote:
+            raise APIError('404 Client Error: Not Found ')
+        self.local[image] = self.remote[image]
+        yield json.dumps({'status': 'Pulling from library/' + image, 'id': 'latest'})
+        yield json.dumps({'status': 'Downloading', 'id': 'l1', 'progressDetail': {'current': 5, 'total': 10}})
+        yield json.dumps({'status': 'Pull complete', 'id': 'l1', 'progressDetail': {}})
+        yield json.dumps({'status': 'Status: Downloaded newer image for ' + image})
+
+
+class ImagesTest(unittest.TestCase):
+
+    def test_collect_images_deduplicates(self):
+        project = {'app': {
+            'services': {'a': {'image': 'php'}, 'b': {'image': 'php:latest'}, 'c': {'image': 'node:12'}},
+            'commands': {'x': {'image': 'node:12'}, 'y': {'aliases': 'x'}}
+        }}
+        self.assertDictEqual({
+            'php:latest': ['service/a', 'service/b'],
+            'node:12': ['service/c', 'command/x']
+        }, dict(collect_images(project)))
+
+    @mock.patch('riptide_engine_docker.images.ImageConfigCache')
+    def test_pull_all(self, cache_mock):
+        registry = RegistryStub(
+            remote={'php:latest': 'sha256:new', 'node:12': 'sha256:same'},
+            local={'php:latest': 'sha256:old', 'node:12': 'sha256:same'}
+        )
+        client = mock.Mock(api=registry)
+        output = []
+
+        pull_all(client, {
+            'php:latest': ['service/a', 'service/b'],
+            'node:12': ['service/c'],
+            'missing:1': ['command/x']
+        }, 2, '\r', output.append)
+
+        self.assertListEqual(sorted(['php:latest', 'missing:1']), sorted(registry.pulls))
+        text = ''.join(output)
+        self.assertIn("[service/a, service/b] Pulling 'php:latest':\n    Done!\n", text)
+        self.assertIn("[service/c] Pulling 'node:12':\n    Already up to date.\n", text)
+        self.assertIn("[command/x] Pulling 'missing:1':\n    Warning: Image not found in repository.\n", text)
+        cache_mock.after_pull.assert_called_once_with('php:latest', 'Status: Downloaded newer image for php:latest')
+
+    def test_pull_progress(self):
+        progress = PullProgress()
+        self.assertEqual('Waiting', str(progress))
+        progress.update({'status': 'Pulling from library/php', 'id': 'latest'})
+        self.assertEqual('Pulling from library/php', str(progress))
+        progress.update({'status': 'Pulling fs layer', 'id': 'l1', 'progressDetail': {}})
+        progress.update({'status': 'Already exists', 'id': 'l2', 'progressDetail': {}})
+        progress.update({'status': 'Downloading', 'id': 'l1', 'progressDetail': {'current': 500000, 'total': 2000000}})
+        self.assertEqual('1/2 layers, 0.5/2.0 MB', str(progress))
+        progress.update({'status': 'Download complete', 'id': 'l1', 'progressDetail': {}})
+        progress.update({'status': 'Pull complete', 'id': 'l1', 'progressDetail': {}})
+        self.assertEqual('2/2 layers, 2.0/2.0 MB', str(progress))
@@ -0,0 +1,55 @@
+import tempfile
+import unittest
+from unittest import mock
+
+from riptide_engine_docker.link_groups import LinkGraph, get_group_network_name, migrate
+
+
+class LinkGroupsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch('riptide_engine_docker.link_groups.riptide_config_dir', return_value=self.config_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.config_dir.cleanup)
+        LinkGraph._links = None
+
+    def test_groups_from_link_graph(self):
+        self.assertTrue(LinkGraph.update('b', ['c']))
+        self.assertFalse(LinkGraph.update('b', ['c']))
+        LinkGraph.update('d', ['c'])
+        LinkGraph.update('x', [])
+
+        self.assertSetEqual({'b', 'c', 'd'}, LinkGraph.group_of('c'))
+        self.assertEqual('riptide__link__b', get_group_network_name('d'))
+        self.assertIsNone(get_group_network_name('x'))
+
+        # Connecting two groups changes the group
+        LinkGraph.update('a', ['d'])
+        self.assertEqual('riptide__link__a', get_group_network_name('c'))
+
+    def test_migrate(self):
+        LinkGraph.update('a', ['b'])
+        client = mock.Mock()
+        client.api.containers.return_value = [
+            {'Id': 'a_main', 'Labels': {'riptide_project': 'a'},
+             'NetworkSettings': {'Networks': {'riptide__a': {}, 'riptide__b': {}}}},
+            {'Id': 'b_main', 'Labels': {'riptide_project': 'b'},
+             'NetworkSettings': {'Networks': {'riptide__b': {}, 'riptide__link__old': {}}}},
+            {'Id': 'other', 'Labels': {'riptide_project': 'other'},
+             'NetworkSettings': {'Networks': {'riptide__other': {}, 'riptide__b': {}}}},
+        ]
+        client.api.networks.return_value = [
+            {'Id': 'n1', 'Name': 'riptide__link__a'},
+            {'Id': 'n2', 'Name': 'riptide__link__old'},
+        ]
+
+        self.assertListEqual(['riptide__link__old'], migrate(client, 'a'))
+        self.assertListEqual([
+            mock.call('a_main', 'riptide__link__a'), mock.call('b_main', 'riptide__link__a')
+        ], client.api.connect_container_to_network.call_args_list)
+        self.assertListEqual([
+            mock.call('a_main', 'riptide__b'), mock.call('b_main', 'riptide__link__old')
+        ], client.api.disconnect_container_from_network.call_args_list)
+        client.api.remove_network.assert_called_once_with('n2')
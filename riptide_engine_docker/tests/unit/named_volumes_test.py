@@ -0,0 +1,52 @@
+import unittest
+from unittest import mock
+
+from riptide_engine_docker.named_volumes import usage, VolumeUsageCache, NamedVolumeUsage
+
+DF = {
+    'Volumes': [
+        {'Name': 'riptide__db', 'Labels': {'riptide': '1'}, 'CreatedAt': '2020-01-01T00:00:00Z',
+         'UsageData': {'Size': 2048, 'RefCount': 1}},
+        {'Name': 'riptide__cache', 'Labels': {'riptide': '1'}, 'CreatedAt': '2020-01-01T00:00:00Z',
+         'UsageData': {'Size': 1024, 'RefCount': 1}},
+        {'Name': 'riptide__new', 'Labels': {'riptide': '1'}, 'CreatedAt': '2020-01-01T01:00:00+01:00',
+         'UsageData': {'Size': -1, 'RefCount': 0}},
+        {'Name': 'not_riptide', 'Labels': None, 'CreatedAt': '2020-01-01T00:00:00Z',
+         'UsageData': {'Size': 1, 'RefCount': 0}},
+    ],
+    'Containers': [
+        {'Names': ['/riptide__p__db'], 'State': 'running', 'Created': 100,
+         'Mounts': [{'Type': 'volume', 'Name': 'riptide__db'}, {'Type': 'bind'}]},
+        {'Names': ['/old_a'], 'State': 'exited', 'Created': 100,
+         'Mounts': [{'Type': 'volume', 'Name': 'riptide__cache'}]},
+        {'Names': ['/old_b'], 'State': 'exited', 'Created': 200,
+         'Mounts': [{'Type': 'volume', 'Name': 'riptide__cache'}]},
+    ]
+}
+
+
+class NamedVolumesTest(unittest.TestCase):
+
+    @mock.patch('riptide_engine_docker.named_volumes.time', return_value=1000)
+    def test_usage(self, time_mock):
+        client = mock.Mock()
+        client.df.return_value = DF
+
+        self.assertListEqual([
+            NamedVolumeUsage('db', 2048, 1000, ['riptide__p__db']),
+            NamedVolumeUsage('cache', 1024, 200, ['old_a', 'old_b']),
+            NamedVolumeUsage('new', None, 1577836800, []),
+        ], usage(client))
+
+    def test_usage_cache(self):
+        client = mock.Mock()
+        client.df.return_value = DF
+        cache = VolumeUsageCache(ttl=60)
+
+        cache.get(client)
+        cache.get(client)
+        self.assertEqual(1, client.df.call_count)
+
+        cache.invalidate()
+        cache.get(client)
+        self.assertEqual(2, client.df.call_count)
@@ -0,0 +1,109 @@
+import tempfile
+import unittest
+from unittest import mock
+
+from docker.errors import NotFound
+from docker.types import EndpointConfig, NetworkingConfig
+
+from riptide_engine_docker import network
+from riptide_engine_docker.network import NetworkRegistry, with_project_network
+
+
+class NetworkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch('riptide_engine_docker.network.riptide_config_dir', return_value=self.config_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.config_dir.cleanup)
+        NetworkRegistry._networks = None
+
+    def test_start_skips_lookup_of_known_networks(self):
+        client = mock.Mock()
+        client.networks.get.side_effect = NotFound('not found')
+
+        network.start(client, 'project')
+        client.networks.create.assert_called_once()
+        self.assertTrue(NetworkRegistry.exists('riptide__project'))
+
+        # Known from the registry file in a new process
+        NetworkRegistry._networks = None
+        client.reset_mock()
+        network.start(client, 'project')
+        client.networks.get.assert_not_called()
+        client.networks.create.assert_not_called()
+
+    def test_watch_restarts_after_stream_error(self):
+        client = mock.Mock()
+        client.events.side_effect = [ValueError('invalid JSON in the events stream'), iter([
+            {'Actor': {'Attributes': {'name': 'riptide__project'}}}
+        ])]
+        NetworkRegistry.add('riptide__project')
+        NetworkRegistry._watching = True
+
+        NetworkRegistry._watch(client)
+        self.assertFalse(NetworkRegistry._watching)
+        self.assertTrue(NetworkRegistry.exists('riptide__project'))
+
+        NetworkRegistry._watch(client)
+        self.assertFalse(NetworkRegistry.exists('riptide__project'))
+
+    def test_with_project_network_recreates_missing_network(self):
+        NetworkRegistry.add('riptide__project')
+        client = mock.Mock()
+        client.networks.get.side_effect = NotFound('not found')
+        func = mock.Mock(side_effect=[NotFound('network riptide__project not found'), 'container'])
+
+        self.assertEqual('container', with_project_network(client, 'project', func))
+        self.assertEqual(2, func.call_count)
+        client.networks.create.assert_called_once()
+
+    def test_with_project_network_other_errors(self):
+        client = mock.Mock()
+        func = mock.Mock(side_effect=NotFound('No such image: image:latest'))
+
+        with self.assertRaises(NotFound):
+            with_project_network(client, 'project', func)
+        client.networks.create.assert_not_called()
+
+    def test_create_container_attaches_all_networks(self):
+        client = mock.Mock()
+        client.api.api_version = '1.44'
+        config = {'network': 'main', 'networking_config': {'main': {'Aliases': ['a']}, 'link': {'Aliases': ['a']}}}
+
+        network.create_container(client, config)
+        client.containers.create.assert_called_once_with(**config)
+        client.api.connect_container_to_network.assert_not_called()
+
+    @mock.patch('riptide_engine_docker.network._client_supports_networking_config', return_value=False)
+    def test_create_container_older_clients(self, supports_mock):
+        client = mock.Mock()
+        client.api.api_version = '1.44'
+        client.api._version = '1.44'
+        client.api.create_networking_config.side_effect = NetworkingConfig
+        client.api.create_endpoint_config.side_effect = lambda aliases: EndpointConfig('1.44', aliases=aliases)
+        client.api.create_container.return_value = {'Id': 'id'}
+        config = {'image': 'image', 'name': 'c', 'network': 'main',
+                  'networking_config': {'main': {'Aliases': ['a']}, 'link': {}}}
+
+        self.assertEqual(client.containers.get.return_value, network.create_container(client, config))
+
+        client.containers.create.assert_not_called()
+        kwargs = client.api.create_container.call_args[1]
+        self.assertEqual('image', kwargs['image'])
+        self.assertEqual('main', kwargs['host_config']['NetworkMode'])
+        self.assertEqual({'EndpointsConfig': {'main': {'Aliases': ['a']}, 'link': {}}}, kwargs['networking_config'])
+        client.containers.get.assert_called_once_with('id')
+
+    def test_create_container_older_daemons(self):
+        client = mock.Mock()
+        client.api.api_version = '1.43'
+        client.containers.create.return_value.id = 'id'
+        config = {'network': 'main', 'networking_config': {'main': {'Aliases': ['a']}, 'link': {}}}
+
+        network.create_container(client, config)
+        client.containers.create.assert_called_once_with(
+            network='main', networking_config={'main': {'Aliases': ['a']}}
+        )
+        client.api.connect_container_to_network.assert_called_once_with('id', 'link', aliases=None)
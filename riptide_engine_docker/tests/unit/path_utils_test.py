@@ -0,0 +1,88 @@
+import os
+import shlex
+import tempfile
+import unittest
+from unittest import mock
+
+from riptide_engine_docker.cmd_detached import DetachedOutput
+from riptide_engine_docker.path_utils import rm_many, copy_many, PathResult, _batch_mounts, BATCH_SCRIPT_HEADER
+
+
+def detached_output(exit_code, stdout, stderr=None):
+    def chunks():
+        yield stdout, stderr
+        return exit_code
+    return DetachedOutput(chunks())
+
+
+class PathUtilsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.project_dir = os.path.join(self.dir.name, 'project')
+        for path in ['a/x', 'a/y', 'b/z']:
+            os.makedirs(os.path.join(self.project_dir, path))
+        self.project = mock.Mock()
+        self.project.folder.return_value = self.project_dir
+        self.engine = mock.Mock()
+        self.engine.helpers = None
+
+    def test_batch_mounts(self):
+        self.assertListEqual([
+            ('/p', 'rw'),
+        ], _batch_mounts(['/p/a/x', '/p/a/y/z', '/p/b-c/x'], ['/p/b/x', '/p/a/x/y']))
+        self.assertListEqual([
+            ('/p/a', 'rw'),
+            ('/q', 'ro'),
+        ], _batch_mounts(['/p/a/x', '/p/a/y'], ['/q/b/x', '/q/c/y']))
+        self.assertListEqual([('/p/a', 'rw')], _batch_mounts(['/p/a/x'], []))
+
+    def test_rm_many(self):
+        self.engine.cmd_detached_stream.return_value = detached_output(0, b'0 0 \n2 1 rm: permission denied \n')
+        paths = [os.path.join(self.project_dir, p) for p in ['a/x', 'a/missing', 'a/y']] + ['/etc']
+
+        results = rm_many(self.engine, paths, self.project)
+
+        self.assertEqual(PathResult(paths[0], True), results[0])
+        self.assertEqual(PathResult(paths[1], True), results[1])
+        self.assertEqual(PathResult(paths[2], False, 'rm: permission denied'), results[2])
+        self.assertFalse(results[3].success)
+        # One container for all paths, with the common parent mounted once
+        self.engine.cmd_detached_stream.assert_called_once()
+        command = self.engine.cmd_detached_stream.call_args[0][1]
+        self.assertEqual(1, len(command['additional_volumes']))
+        script = shlex.split(command['command'])[2]
+        self.assertIn('run 0 rm_path /cmd_target_0/x\n', script)
+        self.assertIn('run 2 rm_path /cmd_target_0/y\n', script)
+
+    def test_copy_many_container_failed(self):
+        self.engine.cmd_detached_stream.return_value = detached_output(125, None, b'error starting container')
+        copies = [
+            (os.path.join(self.project_dir, 'a/x'), os.path.join(self.project_dir, 'b/x')),
+            (os.path.join(self.project_dir, 'a/y'), os.path.join(self.project_dir, 'b/y')),
+        ]
+
+        results = copy_many(self.engine, copies, self.project)
+
+        self.assertListEqual([False, False], [r.success for r in results])
+        self.assertIn('error starting container', results[0].error)
+        volumes = self.engine.cmd_detached_stream.call_args[0][1]['additional_volumes']
+        self.assertListEqual(['rw', 'ro'], [v['mode'] for v in volumes.values()])
+
+    @mock.patch('riptide_engine_docker.path_utils.BATCH_SCRIPT_MAX_SIZE', len(BATCH_SCRIPT_HEADER) + 100)
+    def test_rm_many_split(self):
+        paths = [os.path.join(self.project_dir, 'a', str(i)) for i in range(5)]
+        for path in paths:
+            os.mkdir(path)
+        self.engine.cmd_detached_stream.side_effect = lambda project, command, **kwargs: detached_output(0, ''.join(
+            f'{line.split(" ")[1]} 0\n' for line in shlex.split(command['command'])[2].splitlines()
+            if line.startswith('run ')
+        ).encode())
+
+        results = rm_many(self.engine, paths, self.project)
+
+        self.assertTrue(all(r.success for r in results))
+        self.assertGreater(self.engine.cmd_detached_stream.call_count, 1)
+        for call in self.engine.cmd_detached_stream.call_args_list:
+            self.assertLessEqual(len(shlex.split(call[0][1]['command'])[2]), len(BATCH_SCRIPT_HEADER) + 100)
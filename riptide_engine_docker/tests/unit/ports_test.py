@@ -0,0 +1,99 @@
+import os
+import socket
+import tempfile
+import unittest
+from unittest import mock
+from unittest.mock import Mock
+
+from riptide_engine_docker.container_builder import RIPTIDE_DOCKER_LABEL_HTTP_PORT
+from riptide_engine_docker import ports
+from riptide_engine_docker.ports import PortAllocator, CONTAINER_PORTS_TTL, SERVICE_PORT_TTL, _is_free
+
+
+class PortAllocatorTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.config_dir = tempfile.TemporaryDirectory()
+        self.in_use = set()
+        self.containers = []
+        self.patches = [
+            mock.patch('riptide_engine_docker.ports.riptide_config_dir', return_value=self.config_dir.name),
+            mock.patch('riptide_engine_docker.ports._is_free', side_effect=lambda port: port not in self.in_use),
+            mock.patch('riptide_engine_docker.ports.PortsConfig.get', return_value={"ports": {"1002": True}})
+        ]
+        for patch in self.patches:
+            patch.start()
+        ports._container_ports_cache = (0.0, set())
+        client = Mock()
+        client.api.containers.side_effect = lambda **kwargs: self.containers
+        self.fix = PortAllocator(client, start_port=1000)
+
+    def tearDown(self) -> None:
+        for patch in self.patches:
+            patch.stop()
+        self.config_dir.cleanup()
+
+    def add_container(self, port):
+        self.containers.append({'Labels': {RIPTIDE_DOCKER_LABEL_HTTP_PORT: str(port)}})
+
+    def test_allocate_skips_reserved(self):
+        self.add_container(1000)
+        self.in_use.add(1001)
+
+        self.assertEqual(1003, self.fix.allocate('p', 'a'))
+        # leased, even without a container
+        self.assertEqual(1004, self.fix.allocate('p', 'b'))
+
+    def test_previous_port_kept(self):
+        self.assertEqual(1000, self.fix.allocate('p', 'a'))
+        self.assertEqual(1001, self.fix.allocate('p', 'b'))
+        # a restarts (it's own lease doesn't block it)
+        self.assertEqual(1000, self.fix.allocate('p', 'a'))
+        # port of b is now used by something else
+        self.in_use.add(1001)
+        self.assertEqual(1003, self.fix.allocate('p', 'b'))
+
+    def test_state_shared_between_allocators(self):
+        other = PortAllocator(Mock(), start_port=1000)
+        other.client.api.containers.return_value = []
+
+        self.assertEqual(1000, self.fix.allocate('p', 'a'))
+        self.assertEqual(1001, other.allocate('p', 'b'))
+
+    def test_expired_lease_released(self):
+        self.assertEqual(1000, self.fix.allocate('p', 'a'))
+        with mock.patch('riptide_engine_docker.ports.time', return_value=9999999999):
+            # Wraps around after the cursor, finds 1000 free again
+            with mock.patch('riptide_engine_docker.ports.MAX_PORT', 1001):
+                self.assertEqual(1001, self.fix.allocate('p', 'b'))
+                self.assertEqual(1000, self.fix.allocate('p', 'c'))
+
+    def test_container_ports_cached(self):
+        self.add_container(1000)
+
+        self.assertEqual(1001, self.fix.allocate('p', 'a'))
+        self.assertEqual(1003, self.fix.allocate('p', 'b'))
+        self.assertEqual(1, self.fix.client.api.containers.call_count)
+
+        with mock.patch('riptide_engine_docker.ports.time', return_value=ports.time() + CONTAINER_PORTS_TTL + 1):
+            self.fix.allocate('p', 'c')
+        self.assertEqual(2, self.fix.client.api.containers.call_count)
+
+    def test_unused_services_forgotten(self):
+        self.assertEqual(1000, self.fix.allocate('p', 'a'))
+        with mock.patch('riptide_engine_docker.ports.time', return_value=ports.time() + SERVICE_PORT_TTL + 1):
+            self.fix.allocate('p', 'b')
+
+        state = self.fix._load_state()
+        self.assertListEqual(['p/b'], list(state['services'].keys()))
+        # Written atomically
+        self.assertListEqual(['docker_ports.json', 'docker_ports.lock'], sorted(os.listdir(self.config_dir.name)))
+
+
+class IsFreeTest(unittest.TestCase):
+
+    def test_is_free(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            sock.listen()
+            self.assertFalse(_is_free(sock.getsockname()[1]))
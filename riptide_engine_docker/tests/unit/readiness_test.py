@@ -0,0 +1,127 @@
+import threading
+import unittest
+from unittest.mock import Mock
+
+from riptide_engine_docker.readiness import ReadinessCheck, ReadinessProbe, READY, CRASHED, TIMEOUT, \
+    image_has_healthcheck, default_probes, ReadinessSettings, EventsProbe, HealthcheckProbe, TcpProbe, LogProbe
+
+
+class ProbeStub(ReadinessProbe):
+    def __init__(self, state, required=True, delay=0.0, timeout=5.0):
+        super().__init__(timeout)
+        self.state = state
+        self.required = required
+        self.delay = delay
+        self.prepared = False
+        self.closed = False
+
+    def prepare(self, client, container):
+        self.prepared = True
+
+    def run(self, client, container, report, stop: threading.Event):
+        if stop.wait(self.delay):
+            return
+        if self.state is not None:
+            report(self.state, 'stub ' + self.state)
+
+    def close(self):
+        self.closed = True
+
+
+class ReadinessCheckTest(unittest.TestCase):
+
+    def test_all_required_ready(self):
+        probes = [ProbeStub(READY), ProbeStub(READY, delay=0.05), ProbeStub(None, required=False)]
+        check = ReadinessCheck(Mock(), Mock(), probes, grace_period=10)
+        self.assertTrue(all(p.prepared for p in probes))
+
+        result = check.wait()
+
+        self.assertEqual(READY, result.state)
+        self.assertListEqual([], result.messages)
+        self.assertTrue(all(p.closed for p in probes))
+
+    def test_crash_wins(self):
+        probes = [ProbeStub(None), ProbeStub(CRASHED, required=False, delay=0.05)]
+        result = ReadinessCheck(Mock(), Mock(), probes, grace_period=10).wait()
+
+        self.assertEqual(CRASHED, result.state)
+        self.assertListEqual(['stub crashed'], result.messages)
+
+    def test_timeout_is_ready_with_message(self):
+        probes = [ProbeStub(None, timeout=0.05)]
+        result = ReadinessCheck(Mock(), Mock(), probes, grace_period=0).wait()
+
+        self.assertEqual(READY, result.state)
+        self.assertEqual(1, len(result.messages))
+
+    def test_probe_failure(self):
+        probes = [ProbeStub(TIMEOUT)]
+        result = ReadinessCheck(Mock(), Mock(), probes, grace_period=0).wait()
+
+        self.assertEqual(READY, result.state)
+        self.assertListEqual(['stub timeout'], result.messages)
+
+    def test_no_required_probes_waits_grace_period(self):
+        probes = [ProbeStub(CRASHED, required=False, delay=0.05)]
+        result = ReadinessCheck(Mock(), Mock(), probes, grace_period=5).wait()
+        self.assertEqual(CRASHED, result.state)
+
+        probes = [ProbeStub(None, required=False)]
+        result = ReadinessCheck(Mock(), Mock(), probes, grace_period=0.05).wait()
+        self.assertEqual(READY, result.state)
+
+    def test_close_without_wait(self):
+        probes = [ProbeStub(READY), ProbeStub(READY)]
+        check = ReadinessCheck(Mock(), Mock(), probes)
+
+        # eg. the container could not be started
+        check.close()
+
+        self.assertTrue(all(p.closed for p in probes))
+
+    def test_prepare_failure_closes(self):
+        failing = ProbeStub(READY)
+        failing.prepare = Mock(side_effect=OSError())
+        probes = [ProbeStub(READY), failing]
+
+        with self.assertRaises(OSError):
+            ReadinessCheck(Mock(), Mock(), probes)
+
+        self.assertTrue(all(p.closed for p in probes))
+
+    def test_probe_must_implement_run(self):
+        with self.assertRaises(TypeError):
+            ReadinessProbe()
+
+    def test_image_has_healthcheck(self):
+        self.assertFalse(image_has_healthcheck({}))
+        self.assertFalse(image_has_healthcheck({'Healthcheck': None}))
+        self.assertFalse(image_has_healthcheck({'Healthcheck': {'Test': ['NONE']}}))
+        self.assertTrue(image_has_healthcheck({'Healthcheck': {'Test': ['CMD-SHELL', 'true']}}))
+
+
+class DefaultProbesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.service = {'$name': 'web'}
+
+    def test_events_only_by_default(self):
+        probes = default_probes(self.service, {}, 8080, ReadinessSettings())
+
+        self.assertListEqual([EventsProbe], [type(p) for p in probes])
+        self.assertFalse(probes[0].required)
+
+    def test_healthcheck(self):
+        probes = default_probes(self.service, {'Healthcheck': {'Test': ['CMD-SHELL', 'true']}}, 8080,
+                                ReadinessSettings())
+
+        self.assertListEqual([HealthcheckProbe], [type(p) for p in probes])
+
+    def test_opt_in(self):
+        settings = ReadinessSettings(log_patterns={'web': 'ready'}, tcp_services=['web'])
+
+        probes = default_probes(self.service, {}, 8080, settings)
+
+        self.assertListEqual([EventsProbe, TcpProbe, LogProbe], [type(p) for p in probes])
+        self.assertListEqual([EventsProbe, LogProbe], [type(p) for p in default_probes(self.service, {}, None, settings)])
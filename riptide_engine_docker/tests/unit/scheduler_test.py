@@ -0,0 +1,136 @@
+import threading
+import unittest
+from time import sleep
+
+from riptide_engine_docker.scheduler import DependencyScheduler, service_dependencies
+
+
+class DependencySchedulerTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.lock = threading.Lock()
+        self.order = []
+        self.skipped = {}
+        self.running = 0
+        self.max_running = 0
+
+    def task(self, name, result=True, duration=0.01):
+        def func():
+            with self.lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            sleep(duration)
+            with self.lock:
+                self.running -= 1
+                self.order.append(name)
+            return result
+        return func
+
+    def skip(self, name):
+        return lambda reason: self.skipped.__setitem__(name, reason)
+
+    def test_dependencies_ordered(self):
+        fix = DependencyScheduler(max_workers=4)
+        fix.add('app', self.task('app'), ['db', 'cache'], self.skip('app'))
+        fix.add('worker', self.task('worker'), ['app'], self.skip('worker'))
+        fix.add('db', self.task('db', duration=0.05), [], self.skip('db'))
+        fix.add('cache', self.task('cache'), [], self.skip('cache'))
+
+        report = fix.run()
+
+        self.assertEqual({}, self.skipped)
+        self.assertLess(self.order.index('db'), self.order.index('app'))
+        self.assertLess(self.order.index('cache'), self.order.index('app'))
+        self.assertLess(self.order.index('app'), self.order.index('worker'))
+        self.assertListEqual(['db', 'app', 'worker'], report.critical_path)
+        self.assertAlmostEqual(
+            report.durations['db'] + report.durations['app'] + report.durations['worker'],
+            report.critical_path_time
+        )
+        self.assertSetEqual({'app', 'worker', 'db', 'cache'}, set(report.durations.keys()))
+
+    def test_unknown_dependencies_ignored(self):
+        fix = DependencyScheduler(max_workers=1)
+        fix.add('app', self.task('app'), ['not_started'], self.skip('app'))
+
+        fix.run()
+
+        self.assertListEqual(['app'], self.order)
+
+    def test_max_workers(self):
+        fix = DependencyScheduler(max_workers=2)
+        for i in range(6):
+            fix.add(str(i), self.task(str(i), duration=0.02), [], self.skip(str(i)))
+
+        fix.run()
+
+        self.assertEqual(6, len(self.order))
+        self.assertEqual(2, self.max_running)
+
+    def test_failed_dependency_skips_dependents(self):
+        fix = DependencyScheduler(max_workers=4)
+        fix.add('db', self.task('db', result=False), [], self.skip('db'))
+        fix.add('app', self.task('app'), ['db'], self.skip('app'))
+        fix.add('worker', self.task('worker'), ['app'], self.skip('worker'))
+        fix.add('other', self.task('other'), [], self.skip('other'))
+
+        report = fix.run()
+
+        self.assertSetEqual({'db', 'other'}, set(self.order))
+        self.assertSetEqual({'app', 'worker'}, set(self.skipped.keys()))
+        self.assertIn("'db'", self.skipped['worker'])
+        self.assertNotIn('app', report.durations)
+
+    def test_cycle_skipped(self):
+        fix = DependencyScheduler(max_workers=4)
+        fix.add('a', self.task('a'), ['b'], self.skip('a'))
+        fix.add('b', self.task('b'), ['a'], self.skip('b'))
+        fix.add('c', self.task('c'), ['a'], self.skip('c'))
+        fix.add('d', self.task('d'), [], self.skip('d'))
+
+        fix.run()
+
+        self.assertListEqual(['d'], self.order)
+        self.assertSetEqual({'a', 'b', 'c'}, set(self.skipped.keys()))
+
+    def test_longest_chain_first(self):
+        fix = DependencyScheduler(max_workers=1)
+        fix.add('single', self.task('single'), [], self.skip('single'))
+        fix.add('chain1', self.task('chain1'), [], self.skip('chain1'))
+        fix.add('chain2', self.task('chain2'), ['chain1'], self.skip('chain2'))
+
+        fix.run()
+
+        self.assertEqual('chain1', self.order[0])
+
+
+class ServiceDependenciesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.project = {'app': {'services': {
+            'db': {'roles': ['db']},
+            'web': {'roles': ['main', 'src']},
+            'worker': {'roles': []},
+        }}}
+
+    def test_default_no_dependencies(self):
+        self.assertListEqual([], service_dependencies(self.project, 'web', {}))
+        self.assertListEqual(['web'], service_dependencies(self.project, 'worker', {'worker': ['web']}))
+
+    def test_db_first(self):
+        self.assertListEqual(['db'], service_dependencies(self.project, 'web', {}, db_first=True))
+        self.assertListEqual([], service_dependencies(self.project, 'db', {}, db_first=True))
+        self.assertListEqual(['web'], service_dependencies(self.project, 'worker', {'worker': ['web']}, db_first=True))
+
+    def test_failing_db_does_not_skip_other_services(self):
+        started = []
+        skipped = []
+        fix = DependencyScheduler(max_workers=2)
+        for name in self.project['app']['services'].keys():
+            fix.add(name, lambda name=name: started.append(name) or name != 'db',
+                    service_dependencies(self.project, name, {}), skipped.append)
+
+        fix.run()
+
+        self.assertSetEqual({'db', 'web', 'worker'}, set(started))
+        self.assertListEqual([], skipped)
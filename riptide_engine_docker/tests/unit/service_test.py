@@ -0,0 +1,220 @@
+import unittest
+from unittest import mock
+
+from docker.errors import ContainerError, NotFound
+from riptide.engine.results import StartStopResultStep
+
+from riptide_engine_docker.readiness import ReadinessResult, READY
+from riptide_engine_docker.service import status_by_project, _run_pre_start_batched, _plan_post_start, \
+    _run_post_start_group, PRE_START_MARKER, start, PostStartResult, PostStartFailedStep
+from riptide_engine_docker.state import StateSnapshot
+
+
+def container(name, state, labels):
+    return {'Id': name, 'Names': ['/' + name], 'State': state, 'Labels': labels}
+
+
+class StatusByProjectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.client.api.containers.return_value = [
+            container('riptide__p__main', 'running',
+                      {'riptide': '1', 'riptide_project': 'p', 'riptide_service': 'main'}),
+            container('riptide__p__db', 'exited',
+                      {'riptide': '1', 'riptide_project': 'p', 'riptide_service': 'db'}),
+            # Command containers of the project have no service label
+            container('riptide__p__cmd', 'running', {'riptide': '1', 'riptide_project': 'p'}),
+        ]
+
+    def test_project(self):
+        result = status_by_project(self.client, 'p')
+
+        self.client.api.containers.assert_called_once_with(all=True, filters={'label': 'riptide_project=p'})
+        # Stopped services are not running, missing services are not contained
+        self.assertDictEqual({'p': {'main': True, 'db': False}}, result)
+        self.assertNotIn('redis', result['p'])
+
+    def test_all_projects(self):
+        self.client.api.containers.return_value.append(
+            container('riptide__q__main', 'created',
+                      {'riptide': '1', 'riptide_project': 'q', 'riptide_service': 'main'}),
+        )
+
+        result = status_by_project(self.client)
+
+        self.client.api.containers.assert_called_once_with(all=True, filters={'label': 'riptide_project'})
+        self.assertDictEqual({'p': {'main': True, 'db': False}, 'q': {'main': True}}, result)
+
+    def test_no_containers(self):
+        self.client.api.containers.return_value = []
+
+        self.assertDictEqual({}, status_by_project(self.client, 'p'))
+
+    def test_snapshot(self):
+        containers = {c['Id']: c for c in self.client.api.containers.return_value}
+        containers['other'] = container('other', 'running',
+                                        {'riptide': '1', 'riptide_project': 'other', 'riptide_service': 'main'})
+        snapshot = StateSnapshot(1, containers, frozenset(), frozenset())
+
+        result = status_by_project(self.client, 'p', snapshot)
+
+        self.client.api.containers.assert_not_called()
+        self.assertDictEqual({'p': {'main': True, 'db': False}}, result)
+
+
+class PreStartBatchedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.marker = PRE_START_MARKER + 'abc'
+        self.container = mock.Mock()
+        self.container.wait.return_value = {'StatusCode': 0}
+        self.queue = mock.Mock()
+        for target, kwargs in [('uuid.uuid4', {'return_value': mock.Mock(hex='abc')}),
+                               ('_create', {'return_value': self.container}),
+                               ('_remove_container_if_exists', {}),
+                               ('_pre_start_config', {})]:
+            patcher = mock.patch('riptide_engine_docker.service.' + target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_batched(self, commands, chunks):
+        self.container.logs.return_value = iter(chunks)
+        return _run_pre_start_batched(mock.Mock(), 'p', {'pre_start': commands, 'image': 'image'},
+                                      mock.Mock(), 'n', self.queue, 2, 10)
+
+    def texts(self):
+        return [(c[0][0].current_step, c[0][0].text) for c in self.queue.put.call_args_list]
+
+    def test_output_without_newline(self):
+        m = self.marker
+        current_step = self.run_batched(['printf foo', 'echo bar; echo'], [
+            f'\n{m} start 0\nfoo\n{m} ex'.encode(),
+            f'it 0 0\n\n{m} start 1\nbar\n\n\n{m} exit 1 0\n'.encode()
+        ])
+
+        self.assertEqual(4, current_step)
+        self.assertListEqual([
+            (3, 'Pre Start: printf foo'),
+            (3, 'Pre Start: printf foo: foo'),
+            (4, 'Pre Start: echo bar; echo'),
+            (4, 'Pre Start: echo bar; echo: bar'),
+            (4, 'Pre Start: echo bar; echo: '),
+        ], self.texts())
+        self.container.remove.assert_called_once_with(force=True)
+
+    def test_stops_at_first_failure(self):
+        m = self.marker
+        self.container.wait.return_value = {'StatusCode': 3}
+
+        with self.assertRaises(ContainerError) as ctx:
+            self.run_batched(['true', 'echo err; exit 3', 'never'], [
+                f'\n{m} start 0\n\n{m} exit 0 0\n'.encode(),
+                f'\n{m} start 1\nerr\n\n{m} exit 1 3\n'.encode(),
+            ])
+
+        self.assertEqual('echo err; exit 3', ctx.exception.command)
+        self.assertEqual(3, ctx.exception.exit_status)
+        self.assertEqual('err', ctx.exception.stderr)
+        self.assertNotIn((5, 'Pre Start: never'), self.texts())
+        self.container.remove.assert_called_once_with(force=True)
+
+    def test_marker_like_output(self):
+        m = self.marker
+        current_step = self.run_batched(['cat log'], [
+            f'\n{m} start 0\n{m} exit 0 1 trailing\n{m} start 5\n{m} exit 0\n'.encode(),
+            f'{PRE_START_MARKER}other start 1\n\n{m} exit 0 0\n'.encode()
+        ])
+
+        self.assertEqual(3, current_step)
+        self.assertListEqual([
+            (3, 'Pre Start: cat log'),
+            (3, f'Pre Start: cat log: {m} exit 0 1 trailing'),
+            (3, f'Pre Start: cat log: {m} start 5'),
+            (3, f'Pre Start: cat log: {m} exit 0'),
+            (3, f'Pre Start: cat log: {PRE_START_MARKER}other start 1'),
+        ], self.texts())
+
+    def test_script_prints_markers_on_own_lines(self):
+        self.run_batched(['printf foo'], [])
+
+        script = self.container.put_archive.call_args[0][1]
+        self.assertIn(f"printf '\\n%s\\n' '{self.marker} start 0'".encode(), script)
+        self.assertIn(f"printf '\\n%s\\n' \"{self.marker} exit 0 $rc\"".encode(), script)
+
+
+class PostStartTest(unittest.TestCase):
+
+    def test_plan_post_start(self):
+        self.assertListEqual([['a'], ['b', 'c'], ['d', 'e'], ['f']], _plan_post_start(
+            ['a', 'b', 'c', 'd', 'e', 'f'], [['b', 'c', 'f'], ['d', 'e']]
+        ))
+        self.assertListEqual([['a'], ['b']], _plan_post_start(['a', 'b'], []))
+        self.assertListEqual([], _plan_post_start([], [['a']]))
+
+    def test_run_post_start_group(self):
+        client = mock.Mock()
+        client.api.exec_create.side_effect = lambda container_id, cmd, **kwargs: cmd[2]
+        client.api.exec_start.side_effect = lambda exec_id, **kwargs: exec_id
+        client.api.exec_inspect.side_effect = lambda exec_id: {'ExitCode': 1 if exec_id == 'b' else 0}
+        queue = mock.Mock()
+
+        with mock.patch('riptide_engine_docker.service.socket_output',
+                        side_effect=lambda sock: iter([(sock.encode() + b' out\n', None)])):
+            results = _run_post_start_group(client, mock.Mock(id='c'), {'run_as_current_user': False},
+                                            ['a', 'b'], queue, 3, 10)
+
+        self.assertListEqual(['a', 'b'], [r.command for r in results])
+        self.assertListEqual([0, 1], [r.exit_code for r in results])
+        texts = [(c[0][0].current_step, c[0][0].text) for c in queue.put.call_args_list]
+        self.assertIn((4, 'Post Start: a: a out'), texts)
+        self.assertIn((5, 'Post Start: b: b out'), texts)
+
+
+class StartTest(unittest.TestCase):
+
+    def setUp(self):
+        for target, kwargs in [('ImageConfigCache.get', {'return_value': {'Cmd': 'cmd'}}),
+                               ('ContainerBuilder', {}),
+                               ('add_link_networks', {}),
+                               ('PortAllocator', {}),
+                               ('_create', {}),
+                               ('default_probes', {})]:
+            patcher = mock.patch('riptide_engine_docker.service.' + target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch('riptide_engine_docker.service.ReadinessCheck')
+        readiness_check = patcher.start()
+        self.addCleanup(patcher.stop)
+        readiness_check.return_value.wait.return_value = ReadinessResult(READY, [])
+        self.client = mock.Mock()
+        self.client.containers.get.side_effect = NotFound('not running')
+        data = {'$name': 'web', 'image': 'image', 'pre_start': [], 'post_start': ['a', 'b'],
+                'run_as_current_user': False}
+        self.service = mock.MagicMock()
+        self.service.__getitem__.side_effect = data.__getitem__
+        self.service.__contains__.side_effect = data.__contains__
+        self.queue = mock.Mock()
+
+    def start_with_exit_codes(self, exit_codes):
+        with mock.patch('riptide_engine_docker.service._run_post_start_group', side_effect=lambda *args: [
+            PostStartResult(cmd, exit_codes[cmd], 0.0, None) for cmd in args[3]
+        ]):
+            self.assertTrue(start('p', self.service, self.client, self.queue))
+        self.queue.end.assert_called_once_with()
+        return self.queue.put.call_args[0][0]
+
+    def test_started(self):
+        last_step = self.start_with_exit_codes({'a': 0, 'b': 0})
+
+        self.assertEqual(StartStopResultStep, type(last_step))
+        self.assertEqual('Started!', last_step.text)
+
+    def test_post_start_command_failed(self):
+        last_step = self.start_with_exit_codes({'a': 0, 'b': 1})
+
+        # The service still runs, the failure can be told apart by the type of the step
+        self.assertIsInstance(last_step, PostStartFailedStep)
+        self.assertListEqual(['b'], last_step.failed_commands)
+        self.assertEqual('Started! (1 post start command(s) failed)', last_step.text)
+        self.assertEqual(last_step.steps, last_step.current_step)
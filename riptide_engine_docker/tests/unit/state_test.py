@@ -0,0 +1,93 @@
+import unittest
+from unittest import mock
+
+from docker.errors import NotFound
+
+from riptide_engine_docker.state import StateTracker, containers_with_label
+
+
+def container(container_id, name, state, labels):
+    return {'Id': container_id, 'Names': ['/' + name], 'State': state, 'Labels': labels}
+
+
+class StateTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = mock.Mock()
+        self.client.api.containers.return_value = [
+            container('c1', 'riptide__p__main', 'running', {'riptide': '1', 'riptide_project': 'p'})
+        ]
+        self.client.api.networks.return_value = [{'Name': 'riptide__p'}]
+        self.client.api.volumes.return_value = {'Volumes': [{'Name': 'riptide__vol'}]}
+        self.labels = {'riptide__new': {'riptide': '1'}, 'custom_name': {'riptide': '1'}, 'riptide__foreign': None}
+        self.client.api.inspect_volume.side_effect = lambda name: {'Labels': self.labels[name]}
+        self.client.api.inspect_network.side_effect = lambda network_id: {'Labels': {}}
+        self.tracker = StateTracker(self.client)
+        self.tracker._seed()
+        self.tracker._ready.set()
+
+    def test_seed(self):
+        snapshot = self.tracker.snapshot()
+        self.assertEqual('running', snapshot.container_by_name('riptide__p__main')['State'])
+        self.assertEqual(frozenset({'riptide__p'}), snapshot.networks)
+        self.assertEqual(frozenset({'riptide__vol'}), snapshot.volumes)
+
+    def test_not_ready(self):
+        self.tracker._ready.clear()
+        self.assertIsNone(self.tracker.snapshot())
+
+    def test_container_events(self):
+        before = self.tracker.snapshot()
+        self.tracker._apply({'Type': 'container', 'Action': 'die',
+                             'Actor': {'ID': 'c1', 'Attributes': {'riptide': '1'}}})
+        self.tracker._apply({'Type': 'container', 'Action': 'start',
+                             'Actor': {'ID': 'foreign', 'Attributes': {'name': 'not_riptide'}}})
+        after = self.tracker.snapshot()
+
+        self.assertEqual('exited', after.container_by_name('riptide__p__main')['State'])
+        self.assertGreater(after.version, before.version)
+        # Snapshots are not changed afterwards
+        self.assertEqual('running', before.container_by_name('riptide__p__main')['State'])
+
+        self.client.api.containers.return_value = [
+            container('c2', 'riptide__p__cmd', 'created', {'riptide': '1'})
+        ]
+        self.tracker._apply({'Type': 'container', 'Action': 'create',
+                             'Actor': {'ID': 'c2', 'Attributes': {'riptide': '1'}}})
+        self.tracker._apply({'Type': 'container', 'Action': 'rename',
+                             'Actor': {'ID': 'c2', 'Attributes': {'riptide': '1', 'name': 'renamed'}}})
+        self.tracker._apply({'Type': 'container', 'Action': 'destroy',
+                             'Actor': {'ID': 'c1', 'Attributes': {'riptide': '1'}}})
+        snapshot = self.tracker.snapshot()
+        self.assertListEqual(['c2'], list(snapshot.containers.keys()))
+        self.assertIsNotNone(snapshot.container_by_name('renamed'))
+        self.assertListEqual([], containers_with_label(snapshot, 'riptide_project=p'))
+
+    def test_network_and_volume_events(self):
+        self.tracker._apply({'Type': 'network', 'Action': 'destroy', 'Actor': {'Attributes': {'name': 'riptide__p'}}})
+        self.tracker._apply({'Type': 'network', 'Action': 'create',
+                             'Actor': {'ID': 'n2', 'Attributes': {'name': 'other'}}})
+        self.tracker._apply({'Type': 'volume', 'Action': 'create', 'Actor': {'ID': 'riptide__new'}})
+        snapshot = self.tracker.snapshot()
+        self.assertEqual(frozenset(), snapshot.networks)
+        self.assertEqual(frozenset({'riptide__vol', 'riptide__new'}), snapshot.volumes)
+
+    def test_volumes_by_label(self):
+        # Like the listing, events use the label, not the name
+        self.tracker._apply({'Type': 'volume', 'Action': 'create', 'Actor': {'ID': 'custom_name'}})
+        self.tracker._apply({'Type': 'volume', 'Action': 'create', 'Actor': {'ID': 'riptide__foreign'}})
+        self.client.api.inspect_volume.side_effect = NotFound('removed again')
+        self.tracker._apply({'Type': 'volume', 'Action': 'create', 'Actor': {'ID': 'riptide__gone'}})
+        self.tracker._apply({'Type': 'volume', 'Action': 'destroy', 'Actor': {'ID': 'riptide__foreign'}})
+
+        self.assertEqual(frozenset({'riptide__vol', 'custom_name'}), self.tracker.snapshot().volumes)
+
+    def test_record_volume(self):
+        self.tracker.record_volume('riptide__new', True)
+        self.tracker.record_volume('riptide__vol', False)
+        self.assertEqual(frozenset({'riptide__new'}), self.tracker.snapshot().volumes)
+
+        # The events of the changes arrive later
+        self.tracker._apply({'Type': 'volume', 'Action': 'create', 'Actor': {'ID': 'riptide__new'}})
+        self.tracker._apply({'Type': 'volume', 'Action': 'destroy', 'Actor': {'ID': 'riptide__vol'}})
+        self.assertEqual(frozenset({'riptide__new'}), self.tracker.snapshot().volumes)
@@ -0,0 +1,39 @@
+import socket
+import struct
+import threading
+import time
+import unittest
+
+from riptide_engine_docker.util import socket_output, stream_lines
+
+
+def frame(stream: int, data: bytes) -> bytes:
+    return struct.pack('>BxxxL', stream, len(data)) + data
+
+
+class SocketOutputTest(unittest.TestCase):
+
+    def test_silent_longer_than_timeout(self):
+        client_end, container_end = socket.socketpair()
+        # The read timeout the Docker client leaves on the connection
+        client_end.settimeout(0.05)
+
+        def container():
+            container_end.sendall(frame(1, b'start\n'))
+            # eg. rm -rf of a large directory
+            time.sleep(0.3)
+            container_end.sendall(frame(2, b'error\n') + frame(1, b'done\n'))
+            container_end.close()
+
+        thread = threading.Thread(target=container)
+        thread.start()
+        try:
+            output = list(socket_output(client_end))
+        finally:
+            thread.join()
+
+        self.assertListEqual([(b'start\n', None), (None, b'error\n'), (b'done\n', None)], output)
+        self.assertEqual(-1, client_end.fileno())
+
+    def test_stream_lines(self):
+        self.assertListEqual(['a', 'bc', 'd'], list(stream_lines([b'a\nb', b'c\r\n', b'd'])))
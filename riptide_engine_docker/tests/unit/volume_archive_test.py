@@ -0,0 +1,60 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from riptide.engine.abstract import ExecError
+from riptide_engine_docker.volume_archive import snapshot, restore, CHECKSUM_SUFFIX
+
+
+class VolumeArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, 'volume.tar.gz')
+        self.client = mock.Mock()
+        self.container = self.client.containers.create.return_value
+        self.builder = mock.Mock()
+        self.builder.build_docker_api.return_value = {}
+
+    def test_snapshot_and_restore(self):
+        chunks = [b'riptide_volume/' * 1000, b'content' * 1000]
+        self.container.get_archive.return_value = (iter(chunks), {})
+
+        result = snapshot(self.client, self.builder, self.path)
+
+        self.assertEqual(len(b''.join(chunks)), result.size)
+        self.assertEqual(os.path.getsize(self.path), result.compressed_size)
+        with open(self.path + CHECKSUM_SUFFIX) as file:
+            self.assertEqual(f'{result.checksum}  volume.tar.gz\n', file.read())
+        self.container.remove.assert_called_once_with(force=True)
+
+        restored = []
+        self.container.put_archive.side_effect = lambda path, data: restored.extend(data) or True
+
+        restore(self.client, self.builder, self.path)
+
+        self.assertEqual(b''.join(chunks), b''.join(restored))
+
+    def test_snapshot_failure_removes_file(self):
+        def failing_stream():
+            yield b'data'
+            raise OSError('connection lost')
+        self.container.get_archive.return_value = (failing_stream(), {})
+
+        with self.assertRaises(ExecError):
+            snapshot(self.client, self.builder, self.path)
+
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + CHECKSUM_SUFFIX))
+
+    def test_restore_corrupted(self):
+        self.container.get_archive.return_value = (iter([b'data']), {})
+        snapshot(self.client, self.builder, self.path)
+        with open(self.path, 'ab') as file:
+            file.write(b'garbage')
+
+        with self.assertRaises(ExecError):
+            restore(self.client, self.builder, self.path)
+        self.container.put_archive.assert_not_called()
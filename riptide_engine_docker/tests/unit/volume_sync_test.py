@@ -0,0 +1,119 @@
+import tempfile
+import unittest
+from unittest import mock
+
+from riptide_engine_docker.volume_sync import plan, parse_listing, Entry, save_manifest, load_manifest, \
+    delete_manifest, _apply_cached_hashes, _mkdir, TYPE_FILE, TYPE_DIR, TYPE_LINK, CHOWN_SCRIPT, MKDIR_SCRIPT
+
+
+class VolumeSyncTest(unittest.TestCase):
+
+    def test_parse_listing(self):
+        manifest = parse_listing([
+            'directory|4096|100|1|3|.',
+            'directory|4096|100|2|2|./dir',
+            'regular file|12|200|3|2|./dir/a|b.txt',
+            'regular empty file|0|300|4|1|./empty',
+            'symbolic link|5|400|5|1|./link',
+            'garbage',
+        ])
+        self.assertDictEqual({
+            'dir': Entry(TYPE_DIR, 4096, 100, None, 2, 2),
+            'dir/a|b.txt': Entry(TYPE_FILE, 12, 200, None, 3, 2),
+            'empty': Entry(TYPE_FILE, 0, 300, None, 4, 1),
+            'link': Entry(TYPE_LINK, 5, 400, None, 5, 1),
+        }, manifest)
+
+    def test_plan(self):
+        source = {
+            'dir': Entry(TYPE_DIR, 4096, 1),
+            'dir/new': Entry(TYPE_FILE, 1, 1),
+            'same': Entry(TYPE_FILE, 1, 1),
+            'resized': Entry(TYPE_FILE, 2, 1),
+            'touched': Entry(TYPE_FILE, 1, 2),
+            'touched_same_hash': Entry(TYPE_FILE, 1, 2, 'abc'),
+            'touched_other_hash': Entry(TYPE_FILE, 1, 2, 'abc'),
+            'was_dir': Entry(TYPE_FILE, 1, 1),
+        }
+        target = {
+            'same': Entry(TYPE_FILE, 1, 1),
+            'resized': Entry(TYPE_FILE, 1, 1),
+            'touched': Entry(TYPE_FILE, 1, 1),
+            'touched_same_hash': Entry(TYPE_FILE, 1, 1, 'abc'),
+            'touched_other_hash': Entry(TYPE_FILE, 1, 1, 'def'),
+            'was_dir': Entry(TYPE_DIR, 4096, 1),
+            'was_dir/file': Entry(TYPE_FILE, 1, 1),
+            'gone': Entry(TYPE_DIR, 4096, 1),
+            'gone/file': Entry(TYPE_FILE, 1, 1),
+        }
+        result = plan(source, target)
+
+        self.assertListEqual(['dir'], result.mkdir)
+        self.assertListEqual(['dir/new', 'resized', 'touched_other_hash', 'was_dir'], result.copy)
+        self.assertListEqual(['gone', 'was_dir'], result.delete)
+        self.assertListEqual(['touched'], result.compare)
+        self.assertListEqual(['touched_same_hash'], result.touch)
+
+    def test_plan_hard_links(self):
+        source = {
+            # New: The first path is copied, the others are linked
+            'new_a': Entry(TYPE_FILE, 1, 1, None, 10, 3),
+            'new_b': Entry(TYPE_FILE, 1, 1, None, 10, 3),
+            'new_c': Entry(TYPE_FILE, 1, 1, None, 10, 3),
+            # Unchanged, but not linked in the target: Only linked
+            'unlinked_a': Entry(TYPE_FILE, 1, 1, None, 20, 2),
+            'unlinked_b': Entry(TYPE_FILE, 1, 1, None, 20, 2),
+            # Unchanged and linked
+            'linked_a': Entry(TYPE_FILE, 1, 1, None, 30, 2),
+            'linked_b': Entry(TYPE_FILE, 1, 1, None, 30, 2),
+            # Only one of the links is in the volume
+            'single': Entry(TYPE_FILE, 1, 1, None, 40, 2),
+        }
+        target = {
+            'unlinked_a': Entry(TYPE_FILE, 1, 1, None, 21, 1),
+            'unlinked_b': Entry(TYPE_FILE, 1, 1, None, 22, 1),
+            'linked_a': Entry(TYPE_FILE, 1, 1, None, 31, 2),
+            'linked_b': Entry(TYPE_FILE, 1, 1, None, 31, 2),
+        }
+        result = plan(source, target)
+
+        self.assertListEqual(['new_a', 'single'], result.copy)
+        self.assertListEqual([('new_a', 'new_b'), ('new_a', 'new_c'), ('unlinked_a', 'unlinked_b')], result.link)
+
+    def test_mkdir(self):
+        container = mock.Mock()
+        with mock.patch('riptide_engine_docker.volume_sync._run_with_list') as run_with_list:
+            run_with_list.side_effect = lambda client, c, script, args, paths: [
+                '0:0|755|a', '1000:1000|700|a/b', '0:0|755|c'
+            ] if paths == ['a', 'a/b', 'c'] and script != MKDIR_SCRIPT else []
+
+            _mkdir(mock.Mock(), container, ['a', 'a/b', 'c'])
+
+        calls = [c[0][2:] for c in run_with_list.call_args_list]
+        # All directories are created at once, owner and mode are set once for each combination
+        self.assertIn((MKDIR_SCRIPT, [], ['a', 'a/b', 'c']), calls)
+        self.assertIn((CHOWN_SCRIPT, ['0:0', '755'], ['a', 'c']), calls)
+        self.assertIn((CHOWN_SCRIPT, ['1000:1000', '700'], ['a/b']), calls)
+        self.assertEqual(4, len(calls))
+
+    def test_cached_hashes(self):
+        with tempfile.TemporaryDirectory() as config_dir:
+            with mock.patch('riptide_engine_docker.volume_sync.riptide_config_dir', return_value=config_dir):
+                save_manifest('vol', {
+                    'unchanged': Entry(TYPE_FILE, 1, 1, 'abc'),
+                    'changed': Entry(TYPE_FILE, 1, 1, 'def'),
+                })
+                cached = load_manifest('vol')
+                delete_manifest('vol')
+
+                self.assertDictEqual({}, load_manifest('vol'))
+
+        manifest = _apply_cached_hashes({
+            'unchanged': Entry(TYPE_FILE, 1, 1),
+            'changed': Entry(TYPE_FILE, 1, 2),
+            'new': Entry(TYPE_FILE, 1, 1),
+        }, cached)
+
+        self.assertEqual('abc', manifest['unchanged'].hash)
+        self.assertIsNone(manifest['changed'].hash)
+        self.assertIsNone(manifest['new'].hash)
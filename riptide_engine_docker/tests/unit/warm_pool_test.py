@@ -0,0 +1,72 @@
+import unittest
+from time import time
+from unittest import mock
+
+from docker.errors import APIError
+
+from riptide_engine_docker.container_builder import ContainerBuilder, EENV_RUN_MAIN_CMD_AS_USER, EENV_USER, \
+    EENV_GROUP
+from riptide_engine_docker.warm_pool import WarmPool, exec_user, docker_cli_exec, RIPTIDE_DOCKER_LABEL_POOL_EXPIRES, \
+    CLAIM_MARGIN, ABANDONED_AFTER
+
+
+class WarmPoolTest(unittest.TestCase):
+
+    def _container(self, name, expires):
+        return {'Id': name, 'Names': ['/' + name], 'Labels': {RIPTIDE_DOCKER_LABEL_POOL_EXPIRES: str(int(expires))}}
+
+    def test_claim_skips_expiring_and_taken_containers(self):
+        client = mock.Mock()
+        client.api.containers.return_value = [
+            self._container('expiring', time() + CLAIM_MARGIN / 2),
+            self._container('taken', time() + 500),
+            self._container('free', time() + 300),
+        ]
+
+        def rename(old, new):
+            if old == 'taken':
+                raise APIError('Conflict')
+        client.api.rename.side_effect = rename
+
+        self.assertTrue(WarmPool(client, 2).claim(ContainerBuilder('image', 'cmd'), 'project/cmd', 'target'))
+        self.assertListEqual([mock.call('taken', 'target'), mock.call('free', 'target')],
+                             client.api.rename.call_args_list)
+
+    def test_claim_empty_pool(self):
+        client = mock.Mock()
+        client.api.containers.return_value = []
+        self.assertFalse(WarmPool(client, 2).claim(ContainerBuilder('image', 'cmd'), 'project/cmd', 'target'))
+
+    @mock.patch('riptide_engine_docker.warm_pool.WarmPool._create')
+    def test_refill(self, create_mock):
+        client = mock.Mock()
+        abandoned = dict(self._container('abandoned', time() + 300), Created=int(time() - ABANDONED_AFTER - 1))
+        creating = dict(self._container('creating', time() + 300), Created=int(time()))
+        client.api.containers.side_effect = lambda all, filters: [abandoned, creating] if all else []
+
+        thread = WarmPool(client, 2).refill(ContainerBuilder('image', 'cmd'), 'project', 'project/cmd')
+        thread.join()
+
+        # The process doesn't wait for the refill before exiting
+        self.assertTrue(thread.daemon)
+        client.api.remove_container.assert_called_once_with('abandoned', force=True)
+        self.assertEqual(2, create_mock.call_count)
+
+    def test_disabled_by_default(self):
+        self.assertFalse(WarmPool(mock.Mock()).enabled)
+
+    def test_docker_cli_exec(self):
+        builder = ContainerBuilder('image', 'cmd')
+        builder.set_workdir('/src/sub')
+        builder.set_args(['a b'])
+        self.assertIsNone(exec_user(builder))
+
+        builder.set_env(EENV_RUN_MAIN_CMD_AS_USER, 'yes')
+        builder.set_env(EENV_USER, '1000')
+        builder.set_env(EENV_GROUP, '100')
+        shell = docker_cli_exec(builder, 'target')
+        self.assertListEqual(
+            ['docker', 'exec', '-it', '-u', '1000:100', '-e', 'HOME=/home/riptide', '-w', '/src/sub', 'target'],
+            shell[:10]
+        )
+        self.assertEqual('cmd "a b"', shell[-1])
@@ -0,0 +1,45 @@
+"""Helpers for exchanging data with containers."""
+import io
+import tarfile
+from typing import Generator, Tuple, Union
+
+from docker.utils.socket import frames_iter, demux_adaptor
+
+
+def tar_single_file(path: str, content: bytes) -> bytes:
+    """Creates an uncompressed tar archive containing one executable file, readable by everyone."""
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode='w') as tar:
+        info = tarfile.TarInfo(path)
+        info.size = len(content)
+        info.mode = 0o755
+        tar.addfile(info, io.BytesIO(content))
+    return stream.getvalue()
+
+
+def stream_lines(stream) -> Generator[str, None, None]:
+    """Splits a stream of bytes chunks into lines"""
+    buffer = b''
+    for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            yield line.decode('utf-8', 'replace').rstrip('\r')
+    if buffer != b'':
+        yield buffer.decode('utf-8', 'replace').rstrip('\r')
+
+
+def socket_output(sock, tty=False) -> Generator[Tuple[Union[bytes, None], Union[bytes, None]], None, None]:
+    """
+    Reads the output of a hijacked connection (exec_start or attach_socket with socket=True) until it ends.
+    Yields (stdout, stderr) tuples like the demux option of the Docker client. Closes the connection.
+
+    Use this instead of exec_start / attach with stream=True: The Docker client keeps the read timeout of
+    the client on those, which aborts commands that don't print anything for a while (eg. rm -rf or cp).
+    """
+    getattr(sock, '_sock', sock).settimeout(None)
+    try:
+        for stream, data in frames_iter(sock, tty):
+            yield demux_adaptor(stream, data)
+    finally:
+        sock.close()
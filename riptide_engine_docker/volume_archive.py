@@ -0,0 +1,151 @@
+"""
+Snapshots of named volumes as compressed files on the host.
+
+The volume is mounted into a helper container that is created but never started. The content of the volume
+is streamed through the archive API of the container (a tar stream) and compressed directly into the
+snapshot file while it is received; restoring streams the decompressed file back into a new volume.
+Nothing is held in memory or written to temporary files, memory usage does not depend on the volume size.
+
+Snapshots ending with .zst are compressed with zstd (requires the zstandard package), all others with gzip.
+A SHA-256 checksum of the snapshot file is written next to it (<snapshot>.sha256, in the format of sha256sum)
+and verified before restoring.
+"""
+import gzip
+import hashlib
+import os
+from typing import BinaryIO, Generator, NamedTuple
+
+from docker import DockerClient
+
+from riptide.engine.abstract import ExecError
+from riptide_engine_docker.container_builder import ContainerBuilder
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_MOUNT = '/riptide_volume'
+CHECKSUM_SUFFIX = '.sha256'
+ZSTD_SUFFIX = '.zst'
+CHUNK_SIZE = 1024 * 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+class SnapshotResult(NamedTuple):
+    # Size of the uncompressed tar stream
+    size: int
+    # Size of the snapshot file
+    compressed_size: int
+    checksum: str
+
+
+class _HashingWriter:
+    """File-like object that writes to a file and hashes and counts everything written."""
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.hash.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+
+def snapshot(client: DockerClient, builder: ContainerBuilder, path: str) -> SnapshotResult:
+    """
+    Writes the content of the volume mounted to ARCHIVE_MOUNT by the builder into the snapshot file path.
+
+    :raises: ExecError: If reading the volume failed. No snapshot file is left behind in this case.
+    """
+    _check_compression(path)
+    container = client.containers.create(**builder.build_docker_api())
+    try:
+        stream, _ = container.get_archive(ARCHIVE_MOUNT, chunk_size=CHUNK_SIZE)
+        size = 0
+        with open(path, 'wb') as file:
+            writer = _HashingWriter(file)
+            with _compressor(path, writer) as compressor:
+                for chunk in stream:
+                    size += len(chunk)
+                    compressor.write(chunk)
+        checksum = writer.hash.hexdigest()
+        with open(path + CHECKSUM_SUFFIX, 'w') as file:
+            file.write(f'{checksum}  {os.path.basename(path)}\n')
+        return SnapshotResult(size, writer.size, checksum)
+    except Exception as err:
+        for created_file in [path, path + CHECKSUM_SUFFIX]:
+            try:
+                os.remove(created_file)
+            except OSError:
+                pass
+        raise ExecError(f"Error creating the snapshot {path}: {err}") from err
+    finally:
+        container.remove(force=True)
+
+
+def restore(client: DockerClient, builder: ContainerBuilder, path: str) -> None:
+    """
+    Writes the content of the snapshot file path into the volume mounted to ARCHIVE_MOUNT by the builder.
+
+    :raises: ExecError: If the checksum doesn't match or writing the volume failed.
+    """
+    _check_compression(path)
+    verify(path)
+    container = client.containers.create(**builder.build_docker_api())
+    try:
+        # The archive contains the mount directory itself
+        if not container.put_archive('/', _read_decompressed(path)):
+            raise ExecError(f"Error restoring the snapshot {path}.")
+    except ExecError:
+        raise
+    except Exception as err:
+        raise ExecError(f"Error restoring the snapshot {path}: {err}") from err
+    finally:
+        container.remove(force=True)
+
+
+def verify(path: str) -> None:
+    """
+    Compares the snapshot file with it's checksum file. Snapshots without checksum file are accepted.
+
+    :raises: ExecError: If the checksum doesn't match.
+    """
+    try:
+        with open(path + CHECKSUM_SUFFIX, 'r') as file:
+            expected = file.read().split(' ', 1)[0].strip()
+    except FileNotFoundError:
+        return
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            file_hash.update(chunk)
+    if file_hash.hexdigest() != expected:
+        raise ExecError(f"The snapshot {path} is corrupted: The checksum does not match {path + CHECKSUM_SUFFIX}.")
+
+
+def _read_decompressed(path: str) -> Generator[bytes, None, None]:
+    with open(path, 'rb') as file:
+        if path.endswith(ZSTD_SUFFIX):
+            reader = zstandard.ZstdDecompressor().stream_reader(file)
+        else:
+            reader = gzip.GzipFile(fileobj=file, mode='rb')
+        with reader:
+            for chunk in iter(lambda: reader.read(CHUNK_SIZE), b''):
+                yield chunk
+
+
+def _compressor(path: str, writer: _HashingWriter):
+    if path.endswith(ZSTD_SUFFIX):
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(writer, closefd=False)
+    return gzip.GzipFile(filename='', fileobj=writer, mode='wb', compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _check_compression(path: str):
+    if path.endswith(ZSTD_SUFFIX) and zstandard is None:
+        raise ExecError(f"Snapshots in the zstd format ({ZSTD_SUFFIX}) require the Python package 'zstandard'.")
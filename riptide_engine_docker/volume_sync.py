@@ -0,0 +1,378 @@
+"""
+Incremental synchronization of named volumes.
+
+Both volumes are mounted into one helper container. The files of both volumes are listed (type, size,
+modification time) and compared:
+
+- Entries missing in the target, or with a different type or size, are copied.
+- Entries with the same size and modification time are unchanged.
+- Regular files with the same size but a different modification time are hashed on both sides and only copied
+  if the hashes differ. Hashes are stored in manifests in the Riptide configuration directory and reused as
+  long as size and modification time of the file didn't change.
+- Entries of the target that don't exist in the source are deleted.
+- Hard links are kept: Of files with multiple links, only the first path is copied. The other paths are
+  linked to it in the target, unless they already are.
+
+Hashing and copying is done by multiple workers (xargs -P) inside the helper container. Progress is reported
+to an optional callback. Since only changed files are copied, a sync that was interrupted continues where it
+stopped when it is run again.
+"""
+import json
+import os
+from itertools import groupby
+from typing import NamedTuple, Dict, List, Callable, Union, Tuple
+
+from docker import DockerClient
+from docker.models.containers import Container
+
+from riptide.config.files import riptide_config_dir
+from riptide.engine.abstract import ExecError
+from riptide_engine_docker.container_builder import ContainerBuilder
+from riptide_engine_docker.util import stream_lines, tar_single_file, socket_output
+
+# Default number of parallel workers in the helper container.
+DEFAULT_SYNC_WORKERS = 4
+# Number of files passed to one worker invocation at once.
+SYNC_BATCH_SIZE = 32
+MANIFEST_DIR = 'docker_volume_manifests'
+
+SYNC_FROM = '/copy_from'
+SYNC_TO = '/copy_to'
+LIST_FILE = '/tmp/riptide_sync_list'
+ERROR_FILE = '/tmp/riptide_sync_errors'
+
+TYPE_FILE = 'f'
+TYPE_DIR = 'd'
+TYPE_LINK = 'l'
+TYPE_OTHER = 'o'
+
+PHASE_SCANNING = 'scanning'
+PHASE_HASHING = 'hashing'
+PHASE_COPYING = 'copying'
+PHASE_DELETING = 'deleting'
+
+# Lists all entries of the directory $1 as "<type>|<size>|<mtime>|<inode>|<number of links>|./<path>"
+LIST_SCRIPT = 'cd "$1" && find . -xdev -exec stat -c "%F|%s|%Y|%i|%h|%n" {} +'
+# Hashes the NUL separated paths of the list file in the directory $1 with $2 workers
+HASH_SCRIPT = f'cd "$1" && xargs -0 -P "$2" -n {SYNC_BATCH_SIZE} md5sum < {LIST_FILE}'
+# Prints owner and mode of the NUL separated directories of the list file in the source as "<uid>:<gid>|<mode>|<path>"
+DIR_ATTRIBUTES_SCRIPT = f'cd {SYNC_FROM} && xargs -0 stat -c "%u:%g|%a|%n" < {LIST_FILE} 2> {ERROR_FILE}'
+# Creates the NUL separated directories of the list file in the target
+MKDIR_SCRIPT = f'cd {SYNC_TO} && xargs -0 mkdir -p < {LIST_FILE} 2> {ERROR_FILE}'
+# Sets owner $1 and mode $2 of the NUL separated directories of the list file in the target
+CHOWN_SCRIPT = f'cd {SYNC_TO} && xargs -0 chown "$1" < {LIST_FILE} 2> {ERROR_FILE} ' \
+               f'&& xargs -0 chmod "$2" < {LIST_FILE} 2>> {ERROR_FILE}'
+# Copies the NUL separated paths of the list file with $1 workers. Prints each path that was copied.
+COPY_SCRIPT = f'''cd {SYNC_FROM} && xargs -0 -P "$1" -n {SYNC_BATCH_SIZE} sh -c '
+for f; do rm -rf "{SYNC_TO}/$f" && cp -a "$f" "{SYNC_TO}/$f" && echo "$f"; done
+' sh < {LIST_FILE} 2> {ERROR_FILE}'''
+# Sets the modification time of the NUL separated paths in the target to the one of the source
+TOUCH_SCRIPT = f'''cd {SYNC_FROM} && xargs -0 -n 1 sh -c 'touch -r "$0" "{SYNC_TO}/$0"' < {LIST_FILE} 2> {ERROR_FILE}'''
+# Deletes the NUL separated paths of the list file in the target
+DELETE_SCRIPT = f'cd {SYNC_TO} && xargs -0 rm -rf < {LIST_FILE} 2> {ERROR_FILE}'
+# Hard links the NUL separated pairs of paths (existing path, new path) of the list file in the target
+LINK_SCRIPT = f'cd {SYNC_TO} && xargs -0 -n 2 ln -f < {LIST_FILE} 2> {ERROR_FILE}'
+
+
+class Entry(NamedTuple):
+    type: str
+    size: int
+    mtime: int
+    hash: Union[str, None] = None
+    inode: int = 0
+    links: int = 1
+
+
+# Relative path -> entry
+Manifest = Dict[str, Entry]
+
+
+class SyncProgress(NamedTuple):
+    phase: str
+    done: int
+    total: int
+    path: Union[str, None] = None
+
+
+class SyncPlan(NamedTuple):
+    mkdir: List[str]
+    copy: List[str]
+    delete: List[str]
+    # Files with the same size but different modification times, to be decided by hash
+    compare: List[str]
+    # Files with the same content but different modification times
+    touch: List[str]
+    # (existing path, path) pairs of hard links to create after copying
+    link: List[Tuple[str, str]]
+
+
+class SyncResult(NamedTuple):
+    copied: int
+    deleted: int
+    unchanged: int
+
+
+ProgressCallback = Callable[[SyncProgress], None]
+
+
+def sync(client: DockerClient, builder: ContainerBuilder, from_name: str, target_name: str,
+         progress: ProgressCallback = None, workers: int = DEFAULT_SYNC_WORKERS) -> SyncResult:
+    """
+    Makes the content of the target volume equal to the source volume, only copying what changed.
+
+    :param builder:     Builder for the helper container, mounting the source to SYNC_FROM
+                        and the target to SYNC_TO.
+    :param from_name:   Name of the source volume (used for the manifest)
+    :param target_name: Name of the target volume (used for the manifest)
+    :param progress:    Called with the progress of each phase.
+    :param workers:     Number of parallel workers for hashing and copying.
+    :raises: ExecError: If the sync failed.
+    """
+    if progress is None:
+        progress = _no_progress
+    container = client.containers.create(**builder.build_docker_api())
+    try:
+        container.start()
+
+        progress(SyncProgress(PHASE_SCANNING, 0, 2))
+        source = _list(client, container, SYNC_FROM)
+        progress(SyncProgress(PHASE_SCANNING, 1, 2))
+        target = _list(client, container, SYNC_TO)
+        progress(SyncProgress(PHASE_SCANNING, 2, 2))
+
+        source = _apply_cached_hashes(source, load_manifest(from_name))
+        target = _apply_cached_hashes(target, load_manifest(target_name))
+
+        to_compare = plan(source, target).compare
+        if len(to_compare) > 0:
+            _hash(client, container, source, target, to_compare, workers, progress)
+        result_plan = plan(source, target)
+
+        if len(result_plan.delete) > 0:
+            progress(SyncProgress(PHASE_DELETING, 0, len(result_plan.delete)))
+            _run_with_list(client, container, DELETE_SCRIPT, [], result_plan.delete)
+            progress(SyncProgress(PHASE_DELETING, len(result_plan.delete), len(result_plan.delete)))
+        if len(result_plan.mkdir) > 0:
+            _mkdir(client, container, result_plan.mkdir)
+        if len(result_plan.touch) > 0:
+            _run_with_list(client, container, TOUCH_SCRIPT, [], result_plan.touch)
+        if len(result_plan.copy) > 0:
+            done = 0
+            progress(SyncProgress(PHASE_COPYING, done, len(result_plan.copy)))
+
+            def on_copied(path: str):
+                nonlocal done
+                done += 1
+                progress(SyncProgress(PHASE_COPYING, done, len(result_plan.copy), path))
+
+            _run_with_list(client, container, COPY_SCRIPT, [str(workers)], result_plan.copy, on_copied)
+        if len(result_plan.link) > 0:
+            _run_with_list(client, container, LINK_SCRIPT, [], [p for pair in result_plan.link for p in pair])
+
+        save_manifest(from_name, source)
+        # The target now has the same entries as the source (directories keep their own mtime)
+        save_manifest(target_name, source)
+        copied = len(result_plan.copy) + len(result_plan.link)
+        unchanged = len([p for p, e in source.items() if e.type != TYPE_DIR]) - copied
+        return SyncResult(copied, len(result_plan.delete), unchanged)
+    finally:
+        container.remove(force=True)
+
+
+def plan(source: Manifest, target: Manifest) -> SyncPlan:
+    """Decides what to do for each entry, see module documentation."""
+    mkdir = []
+    copy = []
+    delete = []
+    compare = []
+    touch = []
+    for path, entry in source.items():
+        existing = target.get(path)
+        if existing is not None and existing.type != entry.type:
+            delete.append(path)
+            existing = None
+        if entry.type == TYPE_DIR:
+            if existing is None:
+                mkdir.append(path)
+        elif existing is None or existing.size != entry.size:
+            copy.append(path)
+        elif existing.mtime != entry.mtime:
+            if entry.type != TYPE_FILE:
+                copy.append(path)
+            elif entry.hash is None or existing.hash is None:
+                compare.append(path)
+            elif entry.hash != existing.hash:
+                copy.append(path)
+            else:
+                touch.append(path)
+    for path in target.keys():
+        if path not in source:
+            delete.append(path)
+    link = _plan_hard_links(source, target, copy, compare, touch)
+    return SyncPlan(sorted(mkdir), sorted(copy), _top_level_only(delete), sorted(compare), sorted(touch), link)
+
+
+def _plan_hard_links(source: Manifest, target: Manifest, copy: List[str], compare: List[str],
+                     touch: List[str]) -> List[Tuple[str, str]]:
+    """
+    Changes the plan for files with multiple hard links in the source: If the paths of an inode are not
+    unchanged and linked in the target, only the first path is copied (if needed) and the others are linked to it.
+    Returns the links to create.
+    """
+    links = []
+    linked_files = sorted((e.inode, p) for p, e in source.items() if e.type == TYPE_FILE and e.links > 1)
+    for _, group in groupby(linked_files, key=lambda inode_and_path: inode_and_path[0]):
+        first, *others = [path for _, path in group]
+        if len(others) == 0 or first in compare or any(p in compare for p in others):
+            # Decided after hashing
+            continue
+        target_inodes = {target[p].inode if p in target else None for p in [first] + others}
+        if first not in copy and len(target_inodes) == 1 and None not in target_inodes:
+            # Unchanged and linked
+            continue
+        for path in others:
+            if path in copy:
+                copy.remove(path)
+            if path in touch:
+                touch.remove(path)
+            links.append((first, path))
+    return links
+
+
+def parse_listing(lines: List[str]) -> Manifest:
+    """Parses the output of LIST_SCRIPT."""
+    manifest = {}
+    for line in lines:
+        parts = line.split('|', 5)
+        if len(parts) != 6 or not parts[5].startswith('./'):
+            continue
+        file_type, size, mtime, inode, links, path = parts
+        if file_type == 'directory':
+            file_type = TYPE_DIR
+        elif file_type.startswith('regular'):
+            file_type = TYPE_FILE
+        elif file_type == 'symbolic link':
+            file_type = TYPE_LINK
+        else:
+            file_type = TYPE_OTHER
+        manifest[path[2:]] = Entry(file_type, int(size), int(mtime), None, int(inode), int(links))
+    return manifest
+
+
+def load_manifest(volume_name: str) -> Manifest:
+    try:
+        with open(_manifest_file(volume_name), mode='r') as file:
+            return {path: Entry(*entry) for path, entry in json.load(file).items()}
+    except (OSError, ValueError, TypeError):
+        return {}
+
+
+def save_manifest(volume_name: str, manifest: Manifest) -> None:
+    path = _manifest_file(volume_name)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', mode='w') as file:
+            json.dump({p: list(entry) for p, entry in manifest.items()}, file)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        # Manifests only save hashing work for the next sync
+        pass
+
+
+def delete_manifest(volume_name: str) -> None:
+    try:
+        os.remove(_manifest_file(volume_name))
+    except OSError:
+        pass
+
+
+def _apply_cached_hashes(manifest: Manifest, cached: Manifest) -> Manifest:
+    """Takes the hashes of the cached manifest for all files where size and modification time are the same."""
+    result = {}
+    for path, entry in manifest.items():
+        old = cached.get(path)
+        if old is not None and old.hash is not None and old[:3] == entry[:3]:
+            entry = entry._replace(hash=old.hash)
+        result[path] = entry
+    return result
+
+
+def _hash(client: DockerClient, container: Container, source: Manifest, target: Manifest, paths: List[str],
+          workers: int, progress: ProgressCallback):
+    """Hashes the paths in source and target, if they don't have a hash yet. Updates the manifests."""
+    missing = {
+        SYNC_FROM: [p for p in paths if source[p].hash is None],
+        SYNC_TO: [p for p in paths if target[p].hash is None]
+    }
+    total = len(missing[SYNC_FROM]) + len(missing[SYNC_TO])
+    done = 0
+    progress(SyncProgress(PHASE_HASHING, done, total))
+    for base, manifest in [(SYNC_FROM, source), (SYNC_TO, target)]:
+        if len(missing[base]) == 0:
+            continue
+        for line in _run_with_list(client, container, HASH_SCRIPT, [base, str(workers)], missing[base]):
+            file_hash, _, path = line.partition('  ')
+            path = path[2:] if path.startswith('./') else path
+            if path in manifest:
+                manifest[path] = manifest[path]._replace(hash=file_hash)
+                done += 1
+                progress(SyncProgress(PHASE_HASHING, done, total, path))
+
+
+def _mkdir(client: DockerClient, container: Container, paths: List[str]):
+    """Creates the directories in the target, with owner and mode of the source. One command per owner and mode."""
+    attributes = {}
+    for line in _run_with_list(client, container, DIR_ATTRIBUTES_SCRIPT, [], paths):
+        owner, mode, path = line.split('|', 2)
+        attributes.setdefault((owner, mode), []).append(path)
+    _run_with_list(client, container, MKDIR_SCRIPT, [], paths)
+    for (owner, mode), group in attributes.items():
+        _run_with_list(client, container, CHOWN_SCRIPT, [owner, mode], group)
+
+
+def _list(client: DockerClient, container: Container, base: str) -> Manifest:
+    exit_code, lines = _exec(client, container, LIST_SCRIPT, [base])
+    if exit_code != 0:
+        raise ExecError(f"Error listing files in {base}: {' '.join(lines[-5:])}")
+    return parse_listing(lines)
+
+
+def _run_with_list(client: DockerClient, container: Container, script: str, args: List[str], paths: List[str],
+                   on_line: Callable[[str], None] = None) -> List[str]:
+    """Runs script with a NUL separated list of paths in LIST_FILE."""
+    content = b''.join(p.encode('utf-8') + b'\0' for p in paths)
+    container.put_archive('/', tar_single_file(LIST_FILE.lstrip('/'), content))
+    exit_code, lines = _exec(client, container, script, args, on_line)
+    if exit_code != 0:
+        _, errors = _exec(client, container, f'cat {ERROR_FILE}', [])
+        raise ExecError(f"Error synchronizing named volume: {' '.join(errors[-5:])}")
+    return lines
+
+
+def _exec(client: DockerClient, container: Container, script: str, args: List[str],
+          on_line: Callable[[str], None] = None) -> Tuple[int, List[str]]:
+    exec_instance = client.api.exec_create(container.id, ['/bin/sh', '-c', script, 'sh'] + args)
+    lines = []
+    output = socket_output(client.api.exec_start(exec_instance, socket=True))
+    for line in stream_lines(stdout or stderr for stdout, stderr in output):
+        lines.append(line)
+        if on_line is not None:
+            on_line(line)
+    return client.api.exec_inspect(exec_instance)['ExitCode'], lines
+
+
+def _top_level_only(paths: List[str]) -> List[str]:
+    """Removes paths whose parent directory is also in the list."""
+    result = []
+    for path in sorted(set(paths)):
+        if len(result) == 0 or not path.startswith(result[-1] + '/'):
+            result.append(path)
+    return result
+
+
+def _manifest_file(volume_name: str) -> str:
+    return os.path.join(riptide_config_dir(), MANIFEST_DIR, volume_name + '.json')
+
+
+def _no_progress(progress: SyncProgress):
+    pass
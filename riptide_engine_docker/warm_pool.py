@@ -0,0 +1,208 @@
+"""
+Pool of pre-started ("warm") command containers.
+
+Starting a command container takes a while: The container is created and started, then the Riptide entrypoint
+creates the user and sets up mounts. Warm containers are created from the same configuration as the command
+container, but their main process only waits to be claimed. They are created attached to the project and link
+networks and their entrypoint already ran.
+
+To run a command, a warm container is claimed by renaming it (which only one process can do), the command is then
+run in it via exec and the container is removed afterwards. Claimed containers are replaced in the background.
+
+Warm containers exit (and are removed) on their own if they weren't claimed after the idle TTL.
+Containers are only used for commands with the exact same configuration, others are removed when refilling.
+
+The refill doesn't delay the exit of the process: If the process exits before the refill is done, the pool is
+filled up by the next refill. Containers that were created but not started by an interrupted refill are
+removed by later refills.
+"""
+import hashlib
+import json
+import threading
+import uuid
+from time import time
+from typing import Union, List
+
+from docker import DockerClient
+from docker.errors import APIError, NotFound
+
+from riptide_engine_docker.container_builder import ContainerBuilder, EENV_ORIGINAL_ENTRYPOINT, \
+    EENV_RUN_MAIN_CMD_AS_USER, EENV_USER, EENV_USER_RUN, EENV_GROUP
+from riptide_engine_docker.network import create_container
+from riptide_engine_docker.util import tar_single_file
+
+RIPTIDE_DOCKER_LABEL_POOL = 'riptide_pool'
+RIPTIDE_DOCKER_LABEL_POOL_CONFIG = 'riptide_pool_config'
+RIPTIDE_DOCKER_LABEL_POOL_EXPIRES = 'riptide_pool_expires'
+
+# The original entrypoint of the image, the entrypoint script runs the idle script instead.
+EENV_POOL_ORIGINAL_ENTRYPOINT = 'RIPTIDE__DOCKER_POOL_ORIGINAL_ENTRYPOINT'
+
+POOL_IDLE_SCRIPT_PATH = '/riptide_pool_idle.sh'
+POOL_READY_FILE = '/tmp/.riptide_pool_ready'
+POOL_CLAIMED_FILE = '/tmp/.riptide_pool_claimed'
+
+# Default number of warm containers per project and command. 0 disables the pool.
+DEFAULT_WARM_POOL_SIZE = 0
+# Default time warm containers wait to be claimed, in seconds.
+DEFAULT_WARM_POOL_TTL = 600
+# Containers expiring in less than this number of seconds are not claimed anymore.
+CLAIM_MARGIN = 15
+# Pool containers that were created, but not started for this number of seconds, were left behind by a refill.
+ABANDONED_AFTER = 60
+
+HOME_IN_CONTAINER = '/home/riptide'
+
+# Main process of warm containers. Waits for the claim file until the TTL is over.
+# After being claimed, keeps the container running until it is removed.
+IDLE_SCRIPT = f'''touch {POOL_READY_FILE}
+i=0
+while [ $i -lt $1 ]; do
+    if [ -f {POOL_CLAIMED_FILE} ]; then
+        exec tail -f /dev/null
+    fi
+    sleep 1
+    i=$((i+1))
+done
+'''
+
+# Run via exec in a claimed container, with the command string as argument.
+# Runs the command just like the entrypoint script would.
+EXEC_SCRIPT = f'while [ ! -f {POOL_READY_FILE} ]; do sleep 0.05; done; ' \
+              f'touch {POOL_CLAIMED_FILE}; ' \
+              f'eval exec ${EENV_POOL_ORIGINAL_ENTRYPOINT} $1'
+
+
+class WarmPool:
+    """Pool of warm command containers. Disabled if size is 0."""
+
+    def __init__(self, client: DockerClient, size: int = DEFAULT_WARM_POOL_SIZE, ttl: int = DEFAULT_WARM_POOL_TTL):
+        self.client = client
+        self.size = size
+        self.ttl = ttl
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def claim(self, builder: ContainerBuilder, pool_key: str, name: str) -> bool:
+        """
+        Claims a warm container for the configuration of the builder and renames it to name.
+        Returns False if no container could be claimed.
+
+        :param builder:     Builder of the command container
+        :param pool_key:    Identifier for the pool, eg. project and command name
+        :param name:        Name of the claimed container
+        """
+        config_hash = _config_hash(builder)
+        candidates = sorted(
+            self._list(pool_key, config_hash),
+            key=lambda c: int(c['Labels'][RIPTIDE_DOCKER_LABEL_POOL_EXPIRES]),
+            reverse=True
+        )
+        for container in candidates:
+            if int(container['Labels'][RIPTIDE_DOCKER_LABEL_POOL_EXPIRES]) < time() + CLAIM_MARGIN:
+                continue
+            try:
+                # Renaming by the old name fails if another process claimed the container already.
+                self.client.api.rename(container['Names'][0].lstrip('/'), name)
+                return True
+            except APIError:
+                pass
+        return False
+
+    def release(self, name: str) -> None:
+        """Removes a claimed container after the command is done."""
+        try:
+            self.client.api.remove_container(name, force=True)
+        except NotFound:
+            pass
+
+    def refill(self, builder: ContainerBuilder, project_name: str, pool_key: str) -> threading.Thread:
+        """
+        Fills the pool up to it's size in a new thread and returns the thread. The thread is a daemon thread,
+        the process doesn't wait for it before exiting.
+        """
+        config = builder.build_docker_api()
+        config_hash = _config_hash(builder)
+        thread = threading.Thread(target=self._refill, args=(config, config_hash, project_name, pool_key),
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def _refill(self, config: dict, config_hash: str, project_name: str, pool_key: str):
+        try:
+            # Remove containers with an outdated configuration
+            for container in self._list(pool_key):
+                if container['Labels'].get(RIPTIDE_DOCKER_LABEL_POOL_CONFIG) != config_hash:
+                    self.release(container['Id'])
+            # Remove containers of refills that were interrupted between create and start
+            for container in self._list(pool_key, status='created'):
+                if container['Created'] < time() - ABANDONED_AFTER:
+                    self.release(container['Id'])
+            usable = [c for c in self._list(pool_key, config_hash)
+                      if int(c['Labels'][RIPTIDE_DOCKER_LABEL_POOL_EXPIRES]) >= time() + CLAIM_MARGIN]
+            for _ in range(self.size - len(usable)):
+                self._create(config, config_hash, project_name, pool_key)
+        except APIError:
+            # The pool is only an optimization, commands also run without it.
+            pass
+
+    def _create(self, config: dict, config_hash: str, project_name: str, pool_key: str):
+        config = config.copy()
+        config['name'] = f'riptide__{project_name}__pool__{uuid.uuid4().hex[:12]}'
+        config['labels'] = dict(config['labels'])
+        config['labels'][RIPTIDE_DOCKER_LABEL_POOL] = pool_key
+        config['labels'][RIPTIDE_DOCKER_LABEL_POOL_CONFIG] = config_hash
+        config['labels'][RIPTIDE_DOCKER_LABEL_POOL_EXPIRES] = str(int(time()) + self.ttl)
+        config['environment'] = dict(config['environment'])
+        config['environment'][EENV_POOL_ORIGINAL_ENTRYPOINT] = config['environment'].get(EENV_ORIGINAL_ENTRYPOINT, '')
+        config['environment'][EENV_ORIGINAL_ENTRYPOINT] = '/bin/sh ' + POOL_IDLE_SCRIPT_PATH
+        # The command is passed to the idle script
+        config['command'] = str(self.ttl)
+        config['auto_remove'] = True
+        config.pop('working_dir', None)
+
+        container = create_container(self.client, config)
+        container.put_archive('/', tar_single_file(POOL_IDLE_SCRIPT_PATH.lstrip('/'), IDLE_SCRIPT.encode('utf-8')))
+        container.start()
+
+    def _list(self, pool_key: str, config_hash: str = None, status='running'):
+        labels = [RIPTIDE_DOCKER_LABEL_POOL + '=' + pool_key]
+        if config_hash is not None:
+            labels.append(RIPTIDE_DOCKER_LABEL_POOL_CONFIG + '=' + config_hash)
+        return self.client.api.containers(all=status != 'running', filters={'label': labels, 'status': status})
+
+
+def exec_command(builder: ContainerBuilder) -> List[str]:
+    """Command to exec in a claimed container, to run the command of the builder."""
+    return ['/bin/sh', '-c', EXEC_SCRIPT, 'riptide', builder.build_command_string()]
+
+
+def exec_user(builder: ContainerBuilder) -> Union[str, None]:
+    """User to exec the command as, the same user the entrypoint would run the command with. None for root."""
+    if EENV_RUN_MAIN_CMD_AS_USER not in builder.env:
+        return None
+    user = builder.env.get(EENV_USER_RUN, builder.env.get(EENV_USER))
+    if EENV_GROUP in builder.env:
+        return user + ':' + builder.env[EENV_GROUP]
+    return user
+
+
+def docker_cli_exec(builder: ContainerBuilder, name: str) -> List[str]:
+    """Interactive docker exec CLI command to run the command of the builder in the claimed container name."""
+    shell = ["docker", "exec", "-it"]
+    user = exec_user(builder)
+    if user is not None:
+        shell += ["-u", user, "-e", "HOME=" + HOME_IN_CONTAINER]
+    if builder.work_dir:
+        shell += ["-w", builder.work_dir]
+    return shell + [name] + exec_command(builder)
+
+
+def _config_hash(builder: ContainerBuilder) -> str:
+    """Hash of the container configuration, without the parts that change for each run of a command."""
+    config = builder.build_docker_api()
+    for key in ['name', 'command', 'working_dir']:
+        config.pop(key, None)
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode('utf-8')).hexdigest()
@@ -19,8 +19,12 @@ setup(
     url='https://github.com/Parakoopa/riptide-engine-docker/',
     install_requires=[
         'riptide-lib >= 0.5, < 0.6',
-        'docker >= 4.1'
+        'docker >= 4.3'
     ],
+    extras_require={
+        # Snapshots of named volumes in the zstd format
+        'zstd': ['zstandard >= 0.15'],
+    },
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Programming Language :: Python',
@@ -28,7 +32,6 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
-        'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
     ],
     entry_points='''